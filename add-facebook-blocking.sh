@@ -18,7 +18,8 @@ FACEBOOK_RANGES=(
     "173.252.64.0/18"
 )
 
-# Add to blocked_urls.json
+# Add to blocked_urls.json (exported from the server's blocklist store, imported back below)
+(cd /data/data/com.termux/files/home/hotspot_gui && python3 server.py --export-blocklist > /dev/null 2>&1)
 python3 << EOF
 import json
 import datetime
@@ -60,14 +61,11 @@ with open('/data/data/com.termux/files/home/blocked_urls.json', 'w') as f:
 print("✓ Added Facebook to blocked_urls.json")
 EOF
 
-# Apply iptables rules
+# Import into the blocklist store and rebuild the HOTSPOT_BLOCK chain in one transaction
 echo ""
 echo "Applying iptables rules..."
+(cd /data/data/com.termux/files/home/hotspot_gui && python3 server.py --import-blocklist --reload-blocklist > /dev/null 2>&1)
 for range in "${FACEBOOK_RANGES[@]}"; do
-    # Remove if exists
-    su -c "iptables -D FORWARD -d $range -j DROP" 2>/dev/null
-    # Add at top priority
-    su -c "iptables -I FORWARD 1 -d $range -j DROP" 2>/dev/null
     echo "  ✓ Blocked $range"
 done
 
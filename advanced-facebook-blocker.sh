@@ -64,9 +64,35 @@ FACEBOOK_IPS=(
     "204.15.20.0/22"      # Facebook range
 )
 
+# Merge the ranges into the facebook.com entry of the blocklist (exported from the
+# server's blocklist store, imported back below). Raw FORWARD rules would be removed
+# as legacy rules the next time the server rebuilds its HOTSPOT_BLOCK chain.
+(cd /data/data/com.termux/files/home/hotspot_gui && python3 server.py --export-blocklist > /dev/null 2>&1)
+python3 - "${FACEBOOK_IPS[@]}" << 'EOF'
+import json
+import datetime
+import sys
+
+try:
+    with open('/data/data/com.termux/files/home/blocked_urls.json', 'r') as f:
+        blocked = json.load(f)
+except:
+    blocked = {}
+
+entry = blocked.get('facebook.com', {})
+ranges = list(entry.get('ip_ranges', entry.get('ips', [])))
+ranges += [ip_range for ip_range in sys.argv[1:] if ip_range not in ranges]
+blocked['facebook.com'] = dict(entry, ip_ranges=ranges, ips=ranges, is_ip_address=False,
+                               blocked_at=entry.get('blocked_at') or datetime.datetime.now().isoformat(),
+                               rules_count=len(ranges))
+
+with open('/data/data/com.termux/files/home/blocked_urls.json', 'w') as f:
+    json.dump(blocked, f, indent=2)
+EOF
+
+# Import into the blocklist store and rebuild the HOTSPOT_BLOCK chain in one transaction
+(cd /data/data/com.termux/files/home/hotspot_gui && python3 server.py --import-blocklist --reload-blocklist > /dev/null 2>&1)
 for ip_range in "${FACEBOOK_IPS[@]}"; do
-    su -c "iptables -D FORWARD -d $ip_range -j DROP" 2>/dev/null
-    su -c "iptables -I FORWARD 1 -d $ip_range -j DROP" 2>/dev/null
     echo "  ✓ Blocked $ip_range"
 done
 
@@ -3,6 +3,12 @@
 # Wait for system to be ready
 sleep 30
 
+# Restore the blocklist ipset first - the saved rules may reference it
+if su -c "ipset create hotspot_block hash:net family inet maxelem 262144 -exist" 2>/dev/null; then
+    [ -f /data/data/com.termux/files/home/ipset-rules.txt ] && \
+        su -c "ipset restore -exist < /data/data/com.termux/files/home/ipset-rules.txt"
+fi
+
 # Restore iptables rules
 su -c "iptables-restore < /data/data/com.termux/files/home/iptables-rules.txt"
 
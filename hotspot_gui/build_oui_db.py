@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Build the offline MAC vendor database (oui.bin) for the Hotspot GUI server
+from the IEEE registry CSV files (MA-L oui.csv, MA-M mam.csv, MA-S oui36.csv):
+
+    python3 build_oui_db.py oui.csv mam.csv oui36.csv -o ~/oui.bin
+    python3 build_oui_db.py --download -o ~/oui.bin
+
+File layout (all integers big-endian):
+
+    header   b'OUI1', record count (uint32), string table offset (uint32)
+    records  count x (key uint64, name offset uint32), sorted by key
+    strings  vendor names, each a length byte followed by UTF-8
+
+A key is the assigned prefix left-aligned in 48 bits, shifted left by 8 and
+or-ed with the prefix length (24, 28 or 36), so nested assignments sort
+right after their parent. server.py memory-maps the file and bisects it.
+"""
+
+import csv
+import io
+import os
+import re
+import struct
+import sys
+import urllib.request
+
+IEEE_CSV_URLS = [
+    'https://standards-oui.ieee.org/oui/oui.csv',
+    'https://standards-oui.ieee.org/oui28/mam.csv',
+    'https://standards-oui.ieee.org/oui36/oui36.csv',
+]
+MAGIC = b'OUI1'
+HEADER = struct.Struct('>4sII')
+RECORD = struct.Struct('>QI')
+SUFFIXES = re.compile(r'[,.]?\s+(Inc|Co|Ltd|Corp|Corporation|Limited|LLC|GmbH|AG|S\.?A|B\.?V|Co\.,\s*Ltd)\.?$',
+                      re.IGNORECASE)
+
+
+def short_name(name):
+    """Organization name without trailing company suffixes"""
+    name = ' '.join(name.split())
+    while True:
+        shorter = SUFFIXES.sub('', name).rstrip(' ,')
+        if shorter == name or not shorter:
+            return name
+        name = shorter
+
+
+def read_assignments(rows):
+    """(prefix, bits, name) for each Registry,Assignment,Organization Name row"""
+    for row in rows:
+        if len(row) < 3 or row[0] == 'Registry':
+            continue
+        assignment = row[1].strip().upper()
+        if len(assignment) not in (6, 7, 9) or not re.fullmatch(r'[0-9A-F]+', assignment):
+            continue
+        yield int(assignment, 16), len(assignment) * 4, short_name(row[2])
+
+
+def build(assignments):
+    """Serialize assignments into the oui.bin format"""
+    names = {}
+    strings = bytearray()
+    records = {}
+    for prefix, bits, name in assignments:
+        encoded = name.encode('utf-8')[:255]
+        if encoded not in names:
+            names[encoded] = len(strings)
+            strings += bytes([len(encoded)]) + encoded
+        records[(prefix << (48 - bits)) << 8 | bits] = names[encoded]
+
+    keys = sorted(records)
+    table_offset = HEADER.size + RECORD.size * len(keys)
+    out = bytearray(HEADER.pack(MAGIC, len(keys), table_offset))
+    for key in keys:
+        out += RECORD.pack(key, records[key])
+    return bytes(out + strings), len(keys), len(names)
+
+
+def main():
+    args = sys.argv[1:]
+    output = 'oui.bin'
+    if '-o' in args:
+        i = args.index('-o')
+        output = args[i + 1]
+        del args[i:i + 2]
+
+    sources = []
+    if '--download' in args:
+        args.remove('--download')
+        for url in IEEE_CSV_URLS:
+            print(f"Downloading {url}...")
+            req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
+            with urllib.request.urlopen(req, timeout=60) as response:
+                sources.append(io.StringIO(response.read().decode('utf-8')))
+    for path in args:
+        sources.append(open(path, newline='', encoding='utf-8'))
+    if not sources:
+        print(__doc__)
+        sys.exit(1)
+
+    assignments = []
+    for source in sources:
+        assignments.extend(read_assignments(csv.reader(source)))
+        source.close()
+
+    data, count, unique = build(assignments)
+    with open(output + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(output + '.tmp', output)
+    print(f"Wrote {output}: {count} prefixes, {unique} vendor names, {len(data)} bytes")
+
+
+if __name__ == '__main__':
+    main()
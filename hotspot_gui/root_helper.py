@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Root command helper for the Hotspot GUI server
+Long-lived process started once through su. Reads argv-style commands as
+JSON lines on stdin and writes one JSON reply per command to stdout:
+
+    {"id": 7, "argv": ["iptables-save", "-t", "filter"], "input": null, "timeout": 30}
+    {"id": 7, "stdout": "...", "stderr": "", "code": 0}
+
+Commands run concurrently, so a slow command does not hold up the others.
+The helper exits when the server closes its stdin.
+"""
+
+import json
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+WRITE_LOCK = threading.Lock()
+
+
+def reply(message):
+    """Write one reply line (replies from worker threads must not interleave)"""
+    with WRITE_LOCK:
+        sys.stdout.write(json.dumps(message) + '\n')
+        sys.stdout.flush()
+
+
+def run_request(request):
+    """Execute one command and send its result"""
+    response = {"id": request.get("id"), "stdout": "", "stderr": "", "code": 0}
+    try:
+        result = subprocess.run(request["argv"], input=request.get("input"),
+                                capture_output=True, text=True,
+                                timeout=request.get("timeout", 30))
+        response.update(stdout=result.stdout, stderr=result.stderr, code=result.returncode)
+    except subprocess.TimeoutExpired:
+        response.update(stderr="timeout", code=124)
+    except Exception as e:
+        response.update(stderr=str(e), code=127)
+    reply(response)
+
+
+def main():
+    pool = ThreadPoolExecutor(max_workers=8)
+    for line in sys.stdin:
+        try:
+            request = json.loads(line)
+        except ValueError:
+            continue
+        if not isinstance(request.get("argv"), list) or not request["argv"]:
+            reply({"id": request.get("id"), "stdout": "", "stderr": "invalid argv", "code": 2})
+            continue
+        pool.submit(run_request, request)
+    pool.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    main()
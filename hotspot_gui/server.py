@@ -5,24 +5,96 @@ Simple HTTP server with API endpoints for hotspot management
 """
 
 import json
+import array
+import bisect
+import errno
+import fcntl
+import ipaddress
+import math
+import mmap
 import subprocess
 import os
+import random
 import re
+import shlex
 import socket
+import sqlite3
+import struct
+import sys
+import threading
 import urllib.request
 import time
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 
 PORT = 8080
 WEBROOT = "/data/data/com.termux/files/home/hotspot_gui"
 BLOCKLIST = "/data/data/com.termux/files/home/blocked_urls.txt"
 BLOCKLIST_JSON = "/data/data/com.termux/files/home/blocked_urls.json"
+BLOCKLIST_DB = "/data/data/com.termux/files/home/blocklist.db"
+USAGE_DB = "/data/data/com.termux/files/home/usage.db"
+USAGE_JSON = "/data/data/com.termux/files/home/device_usage.json"
 CACHE_FILE = "/data/data/com.termux/files/home/mac_cache.json"
+OUI_DB = "/data/data/com.termux/files/home/oui.bin"
+DHCP_LEASES_FILE = "/data/misc/dhcp/dnsmasq.leases"
+CONNTRACK_FILES = ["/proc/net/nf_conntrack", "/proc/net/ip_conntrack"]
 DEVICE_INFO_FILE = "/data/data/com.termux/files/home/device_info.json"
 MONITOR_CONFIG_FILE = "/data/data/com.termux/files/home/monitor_config.json"
 MONITOR_LOG_FILE = "/data/data/com.termux/files/home/monitor_log.txt"
 
+# Dedicated chain holding all blocklist rules, jumped to from the top of these chains
+BLOCK_CHAIN = "HOTSPOT_BLOCK"
+BLOCK_CHAIN_PARENTS = ['FORWARD', 'OUTPUT']
+IPTABLES_RULES_FILE = "/data/data/com.termux/files/home/iptables-rules.txt"
+
+# Optional ipset backend: one hash:net set matched by a single rule in HOTSPOT_BLOCK
+IPSET_NAME = "hotspot_block"
+IPSET_RULES_FILE = "/data/data/com.termux/files/home/ipset-rules.txt"
+IPSET_AVAILABLE = False
+# Progress of the background startup restore, reported by /api/health
+RESTORE_STATUS = {'state': 'pending', 'total': 0, 'applied': 0, 'error': '',
+                  'started_at': None, 'finished_at': None, 'elapsed_ms': 0}
+SERVER_STARTED = time.time()
+
+# Serializes blocklist edits (JSON + firewall) with the background restore
+BLOCKLIST_LOCK = threading.RLock()
+# Desired-state reconciler (see reconcile_firewall)
+RECONCILE_INTERVAL = 300
+HOTSPOT_INTERFACES = ['wlan0', 'swlan0', 'ap0', 'softap0']
+RECONCILE_WAKEUP = threading.Event()
+ACCOUNTING_RULE = re.compile(r'^(-s \S+ -m mac --mac-source \S+|-d \S+)$')
+# Per-device accounting: one jump from FORWARD to HOTSPOT_ACCT, which dispatches
+# each client's traffic to its own ACCT_<MAC> chain; chains of devices not seen
+# for ACCOUNTING_GC_AFTER seconds are removed by the reconciler
+ACCOUNTING_CHAIN = "HOTSPOT_ACCT"
+ACCOUNTING_GC_AFTER = 3600
+ACCOUNTING_SEEN = {}
+LEGACY_BLOCK_RULE = re.compile(r'^-d \S+ -j (DROP|REJECT --reject-with icmp-host-unreachable)$')
+# Re-resolution of blocked domains: every entry is refreshed once per interval
+# (changes are collected and applied in one batch at most every REFRESH_APPLY_INTERVAL)
+REFRESH_INTERVAL = 3600
+REFRESH_APPLY_INTERVAL = 300
+REFRESH_SOURCES = ('resolved', 'refresh')
+# Bulk blocklist import (/api/bulk-import): limits and progress for /api/import-status
+IMPORT_MAX_ENTRIES = 200000
+IMPORT_LOCK = threading.Lock()
+IMPORT_RESOLVE_DEADLINE = 30
+IMPORT_STATUS = {'state': 'idle', 'lines': 0, 'domains': 0, 'cidrs': 0, 'duplicates': 0, 'invalid': 0, 'skipped': 0,
+                 'resolved': 0, 'unresolved': 0, 'rules_applied': 0, 'error': '',
+                 'started_at': None, 'finished_at': None, 'elapsed_ms': 0}
+# MAC vendor lookups (MacVendorLookup); HOTSPOT_MAC_VENDOR_API points tests at a local stub
+MAC_VENDOR_API = os.environ.get('HOTSPOT_MAC_VENDOR_API', 'https://api.macvendors.com/')
+MAC_ADDRESS = re.compile(r'^[0-9A-Fa-f]{2}(:[0-9A-Fa-f]{2}){5}$')
+# Special-purpose IPv4 blocks (RFC 6890); feed ranges touching them would cut off the
+# hotspot clients or the phone itself, as HOTSPOT_BLOCK also hangs off OUTPUT
+NON_GLOBAL_NETWORKS = [ipaddress.IPv4Network(network) for network in (
+    '0.0.0.0/8', '10.0.0.0/8', '100.64.0.0/10', '127.0.0.0/8', '169.254.0.0/16', '172.16.0.0/12',
+    '192.0.0.0/24', '192.0.2.0/24', '192.168.0.0/16', '198.18.0.0/15', '198.51.100.0/24',
+    '203.0.113.0/24', '224.0.0.0/4', '240.0.0.0/4')]
+HOST_NAME = re.compile(r'^(?=.{1,253}$)([a-z0-9_]([a-z0-9_-]{0,61}[a-z0-9])?\.)+[a-z][a-z0-9-]{0,62}$')
+
 # Ensure blocklist exists
 open(BLOCKLIST, 'a').close()
 
@@ -35,17 +107,12 @@ try:
 except:
     pass
 
-# Load MAC lookup cache
-MAC_LOOKUP_CACHE = {}
-try:
-    if os.path.exists(CACHE_FILE):
-        with open(CACHE_FILE, 'r') as f:
-            MAC_LOOKUP_CACHE = json.load(f)
-except:
-    pass
-
 # Load monitoring configuration
 MONITOR_CONFIG = {'enabled': False, 'max_logs': 500}
+MONITOR_RUNNING = False
+# tcpdump of the traffic monitor; restarted when the hotspot interface changes
+MONITOR_PROCESS = None
+MONITOR_RESTART = threading.Event()
 try:
     if os.path.exists(MONITOR_CONFIG_FILE):
         with open(MONITOR_CONFIG_FILE, 'r') as f:
@@ -525,14 +592,6 @@ MAC_VENDORS = {
     'fc:fc:48': 'Apple',
 }
 
-def save_mac_cache():
-    """Save MAC lookup cache to file"""
-    try:
-        with open(CACHE_FILE, 'w') as f:
-            json.dump(MAC_LOOKUP_CACHE, f)
-    except:
-        pass
-
 def save_device_info():
     """Save device info to file"""
     try:
@@ -587,37 +646,41 @@ def parse_dns_query(packet_data):
 
 def monitor_traffic_thread():
     """Background thread to monitor network traffic using tcpdump with full packet capture"""
-    global MONITOR_RUNNING, REQUEST_LOG
-    import subprocess
-    import threading
+    global MONITOR_RUNNING, MONITOR_PROCESS, REQUEST_LOG
 
     MONITOR_RUNNING = True
+    MONITOR_RESTART.clear()
 
-    # Get hotspot interface
-    hotspot_iface = None
-    for iface in ['wlan0', 'swlan0', 'ap0', 'softap0']:
-        try:
-            result = subprocess.run(f"ip addr show {iface} 2>/dev/null | grep 'inet '",
-                                  shell=True, capture_output=True, text=True, timeout=2)
-            if result.stdout and '192.168' in result.stdout:
-                hotspot_iface = iface
-                break
-        except:
-            continue
+    while MONITOR_RUNNING:
+        hotspot_iface, _ = detect_hotspot_interface()
+        if not hotspot_iface:
+            print("No hotspot interface found for monitoring")
+            break
 
-    if not hotspot_iface:
-        print("No hotspot interface found for monitoring")
-        MONITOR_RUNNING = False
-        return
+        print(f"Starting traffic monitor on interface: {hotspot_iface}")
+        monitor_capture(hotspot_iface)
 
-    print(f"Starting traffic monitor on interface: {hotspot_iface}")
+        # Captures end for good unless the hotspot moved or restarted meanwhile
+        if not MONITOR_RESTART.is_set():
+            break
+        MONITOR_RESTART.clear()
+        time.sleep(1)
+
+    MONITOR_RUNNING = False
+    MONITOR_PROCESS = None
+    print("Traffic monitor stopped")
+
+
+def monitor_capture(hotspot_iface):
+    """Run the monitor's tcpdump on one interface until it exits or monitoring stops"""
+    global MONITOR_PROCESS
 
     # Start tcpdump with full packet capture (-A for ASCII, -s0 for full packets)
     # Capture DNS (port 53), HTTP (port 80), HTTPS (port 443)
     tcpdump_cmd = f"tcpdump -i {hotspot_iface} -l -n -A -s 0 'src net 192.168.0.0/16 and (port 53 or port 80 or port 443)' 2>/dev/null"
 
     try:
-        process = subprocess.Popen(
+        process = MONITOR_PROCESS = subprocess.Popen(
             tcpdump_cmd,
             shell=True,
             stdout=subprocess.PIPE,
@@ -663,9 +726,6 @@ def monitor_traffic_thread():
     except Exception as e:
         print(f"Failed to start traffic monitoring: {e}")
 
-    MONITOR_RUNNING = False
-    print("Traffic monitor stopped")
-
 
 def parse_full_packet(packet_lines):
     """Parse full packet capture with HTTP headers"""
@@ -758,7 +818,7 @@ def extract_dns_query(packet_data):
         # Look for common domain patterns in the packet
         import re
         # Simple regex to find domain-like strings
-        matches = re.findall(r'([a-zA-Z0-9-]+\.)+[a-zA-Z]{2,}', packet_data)
+        matches = re.findall(r'(?:[a-zA-Z0-9-]+\.)+[a-zA-Z]{2,}', packet_data)
         if matches:
             return matches[0]
     except:
@@ -834,7 +894,7 @@ def extract_sni_from_tls(packet_data):
         # SNI is typically readable in the ClientHello message
         import re
         # Simple pattern matching for domain names in TLS data
-        matches = re.findall(r'([a-zA-Z0-9-]+\.)+[a-zA-Z]{2,}', packet_data)
+        matches = re.findall(r'(?:[a-zA-Z0-9-]+\.)+[a-zA-Z]{2,}', packet_data)
         for match in matches:
             # Filter out common false positives
             if not any(x in match.lower() for x in ['mozilla', 'firefox', 'chrome', 'safari', 'windows']):
@@ -844,78 +904,3136 @@ def extract_sni_from_tls(packet_data):
     return None
 
 
+class BlocklistStore:
+    """SQLite (WAL) store for the blocklist, replacing whole-file JSON rewrites.
+
+    Tables:
+      domains    - one row per blocked entry (domain or IP) with its timestamps
+      ranges     - the entry's IP ranges in their original order
+      provenance - where each range came from (manual, resolved, import, ...)
+
+    put() and delete() touch a single entry in one transaction. load()
+    returns the whole blocklist in the old blocked_urls.json shape from an
+    in-memory cache that is re-read only when another process (a shell script
+    importing JSON) has committed changes. blocked_urls.json stays the
+    interchange format: export_json() writes it atomically and import_json()
+    applies it as a diff.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS domains (
+            url TEXT PRIMARY KEY,
+            is_ip_address INTEGER NOT NULL DEFAULT 0,
+            blocked_at TEXT NOT NULL DEFAULT '',
+            updated_at TEXT NOT NULL DEFAULT '',
+            extra TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE TABLE IF NOT EXISTS ranges (
+            url TEXT NOT NULL REFERENCES domains(url) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            cidr TEXT NOT NULL,
+            PRIMARY KEY (url, position)
+        );
+        CREATE TABLE IF NOT EXISTS provenance (
+            url TEXT NOT NULL REFERENCES domains(url) ON DELETE CASCADE,
+            cidr TEXT NOT NULL,
+            source TEXT NOT NULL,
+            added_at TEXT NOT NULL,
+            PRIMARY KEY (url, cidr)
+        );
+    """
+    # Entry keys kept in their own columns; anything else is stored in domains.extra
+    COLUMNS = ("ips", "ip_ranges", "is_ip_address", "blocked_at", "updated_at", "rules_count")
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.cache = None
+        self.data_version = None
+        self.lock = threading.RLock()
+
+    def _connect(self):
+        """Open the database on first use, importing blocked_urls.json once"""
+        if self.conn is not None:
+            return self.conn
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(self.SCHEMA)
+        empty = self.conn.execute("SELECT COUNT(*) FROM domains").fetchone()[0] == 0
+        if empty and os.path.exists(BLOCKLIST_JSON):
+            try:
+                count = self.import_json(BLOCKLIST_JSON)
+                print(f"Imported {count} blocked URLs from {BLOCKLIST_JSON}")
+            except Exception as e:
+                print(f"Could not import {BLOCKLIST_JSON}: {e}")
+        return self.conn
+
+    def _read_all(self):
+        """Build the url -> entry dict from the tables"""
+        entries = {}
+        for url, is_ip, blocked_at, updated_at, extra in self.conn.execute(
+                "SELECT url, is_ip_address, blocked_at, updated_at, extra FROM domains"):
+            entry = json.loads(extra)
+            entry.update(ips=[], ip_ranges=[], is_ip_address=bool(is_ip), blocked_at=blocked_at)
+            if updated_at:
+                entry["updated_at"] = updated_at
+            entries[url] = entry
+        for url, cidr in self.conn.execute("SELECT url, cidr FROM ranges ORDER BY url, position"):
+            entries[url]["ip_ranges"].append(cidr)
+        for entry in entries.values():
+            entry["ips"] = entry["ip_ranges"]
+            entry.setdefault("rules_count", len(entry["ip_ranges"]))
+        return entries
+
+    def _cached(self):
+        """The cached blocklist, re-read if another connection committed changes"""
+        conn = self._connect()
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if self.cache is None or version != self.data_version:
+            self.cache = self._read_all()
+            self.data_version = version
+        return self.cache
+
+    def changed(self):
+        """True if another process modified the blocklist since the last load()"""
+        with self.lock:
+            conn = self._connect()
+            return conn.execute("PRAGMA data_version").fetchone()[0] != self.data_version
+
+    def load(self):
+        """The whole blocklist as {url: entry}; entries may be modified by the caller"""
+        with self.lock:
+            return {url: dict(entry) for url, entry in self._cached().items()}
+
+    def get(self, url):
+        """One entry, or None"""
+        with self.lock:
+            entry = self._cached().get(url)
+            return dict(entry) if entry is not None else None
+
+    def _write(self, url, entry, source):
+        """Upsert one entry inside the current transaction"""
+        ranges = list(entry.get("ip_ranges", entry.get("ips", [])))
+        extra = {key: value for key, value in entry.items() if key not in self.COLUMNS}
+        if "rules_count" in entry and entry["rules_count"] != len(ranges):
+            extra["rules_count"] = entry["rules_count"]
+        self.conn.execute(
+            "INSERT INTO domains (url, is_ip_address, blocked_at, updated_at, extra) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(url) DO UPDATE SET is_ip_address=excluded.is_ip_address, "
+            "blocked_at=excluded.blocked_at, updated_at=excluded.updated_at, extra=excluded.extra",
+            (url, int(bool(entry.get("is_ip_address"))), entry.get("blocked_at", ""),
+             entry.get("updated_at", ""), json.dumps(extra)))
+        self.conn.execute("DELETE FROM ranges WHERE url = ?", (url,))
+        self.conn.executemany("INSERT INTO ranges (url, position, cidr) VALUES (?, ?, ?)",
+                              [(url, i, cidr) for i, cidr in enumerate(ranges)])
+        # Provenance is kept for ranges that stay, added for new ones
+        self.conn.execute(f"DELETE FROM provenance WHERE url = ? AND cidr NOT IN ({','.join('?' * len(ranges))})",
+                          [url] + ranges)
+        now = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.conn.executemany("INSERT OR IGNORE INTO provenance (url, cidr, source, added_at) VALUES (?, ?, ?, ?)",
+                              [(url, cidr, source, now) for cidr in ranges])
+        return ranges
+
+    def put(self, url, entry, source='manual'):
+        """Insert or replace one entry (a single small transaction)"""
+        with self.lock:
+            self._cached()
+            with self.conn:
+                self.conn.execute("BEGIN IMMEDIATE")
+                ranges = self._write(url, entry, source)
+            cached = dict(entry, ip_ranges=ranges, ips=ranges)
+            cached.setdefault("rules_count", len(ranges))
+            self.cache[url] = cached
+            self.data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def put_many(self, items, refreshed=None):
+        """Insert or replace many (url, entry, source) items in one transaction.
+
+        refreshed maps further urls to a new last_refresh time, set in the
+        same transaction without rewriting their ranges.
+        """
+        with self.lock:
+            self._cached()
+            with self.conn:
+                self.conn.execute("BEGIN IMMEDIATE")
+                for url, entry, source in items:
+                    ranges = self._write(url, entry, source)
+                    cached = dict(entry, ip_ranges=ranges, ips=ranges)
+                    cached.setdefault("rules_count", len(ranges))
+                    self.cache[url] = cached
+                written = set(url for url, _, _ in items)
+                touched = [(when, url) for url, when in (refreshed or {}).items()
+                           if url in self.cache and url not in written]
+                self.conn.executemany("UPDATE domains SET extra = json_set(extra, '$.last_refresh', ?) WHERE url = ?",
+                                      touched)
+                for when, url in touched:
+                    self.cache[url] = dict(self.cache[url], last_refresh=when)
+            self.data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def delete(self, url):
+        """Remove one entry with its ranges and provenance"""
+        with self.lock:
+            self._cached()
+            with self.conn:
+                self.conn.execute("BEGIN IMMEDIATE")
+                self.conn.execute("DELETE FROM domains WHERE url = ?", (url,))
+            self.cache.pop(url, None)
+            self.data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def provenance(self, url):
+        """{cidr: {source, added_at}} for one entry"""
+        with self.lock:
+            rows = self._connect().execute(
+                "SELECT cidr, source, added_at FROM provenance WHERE url = ?", (url,)).fetchall()
+            return {cidr: {"source": source, "added_at": added_at} for cidr, source, added_at in rows}
+
+    def page(self, offset=0, limit=100, search=''):
+        """One page of entries sorted by url, plus the total matching count"""
+        with self.lock:
+            conn = self._connect()
+            pattern = f"%{search.lower()}%"
+            total = conn.execute("SELECT COUNT(*) FROM domains WHERE url LIKE ?", (pattern,)).fetchone()[0]
+            urls = [row[0] for row in conn.execute(
+                "SELECT url FROM domains WHERE url LIKE ? ORDER BY url LIMIT ? OFFSET ?", (pattern, limit, offset))]
+            cached = self._cached()
+            return [(url, dict(cached[url])) for url in urls if url in cached], total
+
+    def import_json(self, path, source='import'):
+        """Make the store match a blocked_urls.json file, writing only entries that differ"""
+        with open(path, 'r') as f:
+            data = json.load(f)
+        with self.lock:
+            conn = self._connect()
+            current = self._read_all()
+            changed = 0
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                for url, entry in data.items():
+                    old = current.get(url)
+                    if old is None or any(old.get(key) != value for key, value in (
+                            ("ip_ranges", entry.get("ip_ranges", entry.get("ips", []))),
+                            ("is_ip_address", bool(entry.get("is_ip_address"))),
+                            ("blocked_at", entry.get("blocked_at", "")))):
+                        self._write(url, entry, source)
+                        changed += 1
+                for url in set(current) - set(data):
+                    conn.execute("DELETE FROM domains WHERE url = ?", (url,))
+                    changed += 1
+            self.cache = None
+            return changed
+
+    def export_json(self, path):
+        """Write the blocklist as blocked_urls.json (atomic rename), plus the plain domain list"""
+        data = self.load()
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, path)
+        tmp = f"{BLOCKLIST}.tmp"
+        with open(tmp, 'w') as f:
+            f.write(''.join(url + '\n' for url in sorted(data)))
+        os.replace(tmp, BLOCKLIST)
+        return len(data)
+
+
+BLOCKLIST_STORE = BlocklistStore(BLOCKLIST_DB)
+
+
+class CidrTrie:
+    """Binary radix trie over IPv4 for longest-prefix-match lookups in at most 32 steps"""
+
+    def __init__(self):
+        # Node layout: [child for bit 0, child for bit 1, value or None]
+        self.root = [None, None, None]
+        self.size = 0
+
+    def insert(self, cidr, value):
+        """Store value for a CIDR (replaces the value of an identical prefix)"""
+        address, prefixlen = parse_ip_range(cidr)
+        node = self.root
+        for i in range(prefixlen):
+            bit = (address >> (31 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None:
+            self.size += 1
+        node[2] = value
+
+    def covers(self, cidr):
+        """True if a stored prefix contains the whole of cidr"""
+        address, prefixlen = parse_ip_range(cidr)
+        node = self.root
+        for i in range(prefixlen + 1):
+            if node[2] is not None:
+                return True
+            if i == prefixlen:
+                break
+            node = node[(address >> (31 - i)) & 1]
+            if node is None:
+                return False
+        return False
+
+    def lookup(self, ip):
+        """Value of the longest prefix containing ip, or None"""
+        try:
+            address = int(ipaddress.IPv4Address(ip))
+        except ValueError:
+            return None
+        node = self.root
+        match = node[2]
+        for i in range(32):
+            node = node[(address >> (31 - i)) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                match = node[2]
+        return match
+
+
+def get_domain_variations(url):
+    """Get known domain variations for popular sites"""
+    variations = []
+
+    # YouTube variations
+    if 'youtube' in url:
+        variations.extend(['youtu.be', 'youtubei.googleapis.com', 'ytimg.com', 'yt3.ggpht.com'])
+
+    # Facebook variations
+    elif 'facebook' in url:
+        variations.extend(['fb.com', 'fbcdn.net', 'facebook.net', 'fb.me'])
+
+    # Instagram variations
+    elif 'instagram' in url:
+        variations.extend(['cdninstagram.com', 'ig.me'])
+
+    # Twitter/X variations
+    elif 'twitter' in url or url == 'x.com':
+        variations.extend(['twitter.com', 'x.com', 't.co', 'twimg.com'])
+
+    # TikTok variations
+    elif 'tiktok' in url:
+        variations.extend(['tiktokcdn.com', 'tiktokv.com', 'musical.ly'])
+
+    # WhatsApp variations
+    elif 'whatsapp' in url:
+        variations.extend(['wa.me'])
+
+    # Netflix variations
+    elif 'netflix' in url:
+        variations.extend(['nflxext.com', 'nflximg.net', 'nflxvideo.net'])
+
+    return variations
+
+
+class DnsResolver:
+    """Concurrent IPv4 resolver with a positive/negative answer cache.
+
+    Names are resolved with getaddrinfo on a shared thread pool, so a domain
+    and all its variations are looked up in parallel and a batch returns
+    within its deadline. getaddrinfo does not expose record TTLs, so answers
+    are cached for POSITIVE_TTL seconds and failures for NEGATIVE_TTL.
+    Lookups still running at the deadline keep going in the background and
+    fill the cache for the next call; concurrent requests for the same name
+    share one lookup.
+    """
+
+    POSITIVE_TTL = 300
+    NEGATIVE_TTL = 60
+    MAX_ENTRIES = 4096
+
+    def __init__(self, max_workers=16):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.cache = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def _lookup(self, name):
+        """Blocking lookup of one name; caches and returns its sorted IPv4 addresses"""
+        try:
+            ips = sorted(set(info[4][0] for info in socket.getaddrinfo(name, 80, socket.AF_INET)))
+        except (OSError, UnicodeError):
+            ips = []
+        ttl = self.POSITIVE_TTL if ips else self.NEGATIVE_TTL
+        with self.lock:
+            if len(self.cache) >= self.MAX_ENTRIES:
+                now = time.time()
+                self.cache = {n: entry for n, entry in self.cache.items() if entry[1] > now}
+                if len(self.cache) >= self.MAX_ENTRIES:
+                    self.cache.clear()
+            self.cache[name] = (ips, time.time() + ttl)
+            self.pending.pop(name, None)
+        return ips
+
+    def cached(self, name):
+        """Cached answer for a name, or None if unknown or expired"""
+        with self.lock:
+            entry = self.cache.get(name)
+        if entry and entry[1] > time.time():
+            return entry[0]
+        return None
+
+    def resolve_many(self, names, deadline=5.0, fresh=False):
+        """Resolve names concurrently: {name: [ips]} (None for lookups that missed the deadline)"""
+        results = {}
+        futures = {}
+        for name in dict.fromkeys(name.strip().lower().rstrip('.') for name in names):
+            if not name:
+                continue
+            ips = None if fresh else self.cached(name)
+            if ips is not None:
+                results[name] = ips
+                continue
+            with self.lock:
+                future = self.pending.get(name)
+                if future is None:
+                    future = self.pending[name] = self.pool.submit(self._lookup, name)
+            futures[future] = name
+        if futures:
+            done, _ = wait(futures, timeout=deadline)
+            for future, name in futures.items():
+                results[name] = future.result() if future in done else None
+        return results
+
+    def resolve(self, name, deadline=5.0):
+        """Resolve one name ([] on failure or timeout)"""
+        return self.resolve_many([name], deadline).get(name.strip().lower().rstrip('.')) or []
+
+    def resolve_family(self, domain, deadline=5.0, fresh=False):
+        """Resolve a domain together with its www. host and known variations.
+
+        Returns (ips, answers): the sorted union of all addresses and the
+        per-name results from resolve_many().
+        """
+        names = [domain, f"www.{domain}"] + get_domain_variations(domain)
+        answers = self.resolve_many(names, deadline, fresh)
+        ips = sorted(set(ip for found in answers.values() if found for ip in found),
+                     key=lambda ip: ipaddress.IPv4Address(ip))
+        return ips, answers
+
+
+RESOLVER = DnsResolver()
+
+
+class DomainTrie:
+    """Suffix trie of blocked domains keyed by reversed labels (com -> facebook -> www).
+
+    A domain matches if it equals a blocked domain or is a subdomain of one,
+    so fb.com matches m.fb.com but not notfb.company.net. Lookups cost one
+    dict step per label. Each blocked entry owns its domain plus its known
+    variations, and entries can be added or removed individually while the
+    capture thread keeps matching without a lock (see add()).
+    """
+
+    OWNERS = ''  # never a real label
+
+    def __init__(self, entries=()):
+        # Node layout: {label: child node, OWNERS: frozenset of blocklist entries ending here}
+        self.root = {}
+        self.owned = {}
+        # Built in place: nobody can be reading a trie that is still being constructed
+        for owner, domains in entries:
+            self.owned[owner] = set(d for d in domains if self.labels(d))
+            for domain in self.owned[owner]:
+                node = self.root
+                for label in self.labels(domain):
+                    node = node.setdefault(label, {})
+                node[self.OWNERS] = node.get(self.OWNERS, frozenset()) | {owner}
+
+    @staticmethod
+    def labels(domain):
+        """Reversed, normalized labels of a domain name"""
+        domain = domain.strip().lower().rstrip('.')
+        return [label for label in reversed(domain.split('.')) if label]
+
+    @staticmethod
+    def _copy_child(node, label, copied):
+        """node[label], replaced by a private copy the first time it is touched in this change"""
+        child = node.get(label)
+        if child is None or id(child) not in copied:
+            child = dict(child or {})
+            copied.add(id(child))
+            node[label] = child
+        return child
+
+    def add(self, owner, domains):
+        """Register the domains blocked by one blocklist entry (replaces its previous set).
+
+        Copy-on-write: the nodes on the changed paths are copied and the new
+        root is published in one assignment, so a concurrent match() walks
+        either the old or the new trie, never a node being changed.
+        """
+        root = dict(self.root)
+        copied = {id(root)}
+        self._remove_paths(root, owner, copied)
+        self.owned[owner] = set(d for d in domains if self.labels(d))
+        for domain in self.owned[owner]:
+            node = root
+            for label in self.labels(domain):
+                node = self._copy_child(node, label, copied)
+            node[self.OWNERS] = node.get(self.OWNERS, frozenset()) | {owner}
+        self.root = root
+
+    def remove(self, owner):
+        """Drop every domain registered by a blocklist entry, pruning empty branches (copy-on-write)"""
+        if owner not in self.owned:
+            return
+        root = dict(self.root)
+        self._remove_paths(root, owner, {id(root)})
+        self.root = root
+
+    def _remove_paths(self, root, owner, copied):
+        for domain in self.owned.pop(owner, ()):
+            path = [root]
+            labels = self.labels(domain)
+            for label in labels:
+                path.append(self._copy_child(path[-1], label, copied))
+            owners = path[-1].get(self.OWNERS, frozenset()) - {owner}
+            if owners:
+                path[-1][self.OWNERS] = owners
+            else:
+                path[-1].pop(self.OWNERS, None)
+            for i in range(len(labels), 0, -1):
+                if path[i]:
+                    break
+                del path[i - 1][labels[i - 1]]
+
+    def match(self, domain):
+        """Blocklist entries owning domain or one of its parent domains"""
+        owners = set()
+        node = self.root
+        for label in self.labels(domain):
+            node = node.get(label)
+            if node is None:
+                break
+            owners |= node.get(self.OWNERS, set())
+        return sorted(owners)
+
+    def __len__(self):
+        return len(self.owned)
+
+
+def blocked_domain_names(url):
+    """Domain names blocked by one blocklist entry: the domain and its known variations"""
+    return [url] + get_domain_variations(url)
+
+
+class BlockIndex:
+    """In-memory view of the blocklist for classifying captured packets.
+
+    Rebuilt from the blocklist whenever the server changes it; changes made
+    by other processes (the shell scripts) are picked up by checking the
+    store's data version at most every RECHECK_INTERVAL seconds, so the
+    capture loop never reads the blocklist per packet.
+    """
+
+    RECHECK_INTERVAL = 5
+
+    def __init__(self):
+        self.trie = CidrTrie()
+        self.domains = DomainTrie()
+        self.compiled = ([], {})
+        self.checked_at = 0
+
+    def rebuild(self, blocked_data):
+        """Recompile the index from blocklist data"""
+        self.domains = DomainTrie((url, blocked_domain_names(url)) for url, info in blocked_data.items()
+                                  if not info.get("is_ip_address"))
+        self.rebuild_ranges(blocked_data)
+
+    def rebuild_ranges(self, blocked_data):
+        """Recompile only the CIDR trie (the blocklist's ranges changed)"""
+        cidrs, owners = compile_blocklist(blocked_data)
+        trie = CidrTrie()
+        for cidr in cidrs:
+            trie.insert(cidr, sorted(set(url for url, _ in owners[cidr])))
+        self.trie = trie
+        self.compiled = (cidrs, owners)
+        self.checked_at = time.time()
+
+    def block(self, url, blocked_data):
+        """Apply one blocked (or edited) entry without rebuilding the domain trie"""
+        if not blocked_data[url].get("is_ip_address"):
+            self.domains.add(url, blocked_domain_names(url))
+        self.rebuild_ranges(blocked_data)
+
+    def unblock(self, url, blocked_data):
+        """Remove one entry without rebuilding the domain trie"""
+        self.domains.remove(url)
+        self.rebuild_ranges(blocked_data)
+
+    def refresh(self):
+        """Reload if the blocklist was changed behind our back (or never loaded)"""
+        now = time.time()
+        if now - self.checked_at < self.RECHECK_INTERVAL:
+            return
+        initial = self.checked_at == 0
+        self.checked_at = now
+        try:
+            if initial or BLOCKLIST_STORE.changed():
+                self.rebuild(BLOCKLIST_STORE.load())
+        except:
+            pass
+
+    def match(self, dst_ip, domain=''):
+        """Blocked domains that a request to dst_ip/domain falls under (empty if allowed)"""
+        self.refresh()
+        owners = self.trie.lookup(dst_ip)
+        if owners:
+            return owners
+        if domain:
+            return self.domains.match(domain)
+        return []
+
+
+BLOCK_INDEX = BlockIndex()
+
+
 def is_request_blocked(dst_ip, port, domain=''):
     """Check if a request should be blocked based on current rules"""
+    return bool(BLOCK_INDEX.match(dst_ip, domain))
+
+class MacVendorLookup:
+    """Vendor names from the macvendors.com API, resolved on a background queue.
+
+    name() only reads the cache and queues unknown MACs, so the device list
+    never waits on the network. One worker drains the queue at most one
+    request per MIN_INTERVAL (the free API allows about one per second), each
+    MAC is queued once however often it is asked for, and failures are retried
+    with exponential backoff instead of being cached forever. The cache is an
+    LRU bounded to MAX_ENTRIES and is written to disk in batches.
+    """
+
+    MIN_INTERVAL = 1.1
+    MAX_ENTRIES = 2048
+    FAILURE_BACKOFF = 300
+    MAX_BACKOFF = 86400
+    NOT_FOUND_TTL = 7 * 86400
+    FLUSH_INTERVAL = 30
+
+    def __init__(self, path, api_url=MAC_VENDOR_API):
+        self.path = path
+        self.api_url = api_url
+        self.cache = OrderedDict()
+        self.queue = deque()
+        self.queued = set()
+        self.cond = threading.Condition()
+        self.worker = None
+        self.dirty = False
+        self.last_flush = time.time()
+        self.next_request = 0
+        try:
+            with open(path, 'r') as f:
+                for mac, entry in json.load(f).items():
+                    self.cache[mac] = entry
+        except (OSError, ValueError):
+            pass
+
+    def name(self, mac):
+        """Cached vendor name for a MAC, or None; queues a lookup if unknown or due for retry"""
+        mac = mac.lower().replace('-', ':')
+        # Randomized (locally administered) MACs have no registered vendor
+        if len(mac) != 17 or mac[1] in '26ae':
+            return None
+        with self.cond:
+            entry = self.cache.get(mac)
+            if entry is not None:
+                self.cache.move_to_end(mac)
+                if entry.get('name') or time.time() < entry.get('retry_at', 0):
+                    return entry.get('name')
+            if mac not in self.queued:
+                self.queued.add(mac)
+                self.queue.append(mac)
+                if self.worker is None:
+                    self.worker = threading.Thread(target=self._loop, daemon=True)
+                    self.worker.start()
+                self.cond.notify()
+        return entry.get('name') if entry else None
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    # Idle: write out pending results once they are due
+                    due = self.last_flush + self.FLUSH_INTERVAL - time.time() if self.dirty else None
+                    if due is not None and due <= 0:
+                        break
+                    self.cond.wait(due)
+                mac = self.queue.popleft() if self.queue else None
+            if mac is None:
+                self.flush()
+                continue
+            time.sleep(max(self.next_request - time.time(), 0))
+            self.lookup(mac)
+            with self.cond:
+                self.queued.discard(mac)
+            if time.time() - self.last_flush >= self.FLUSH_INTERVAL:
+                self.flush()
+
+    def lookup(self, mac):
+        """Query the API for one MAC and store the outcome; returns the name or None"""
+        now = time.time()
+        self.next_request = now + self.MIN_INTERVAL
+        with self.cond:
+            previous = self.cache.get(mac) or {}
+        name, retry_after, source = None, None, 'api'
+        try:
+            req = urllib.request.Request(self.api_url + mac, headers={
+                'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36'
+            })
+            with urllib.request.urlopen(req, timeout=5) as response:
+                name = self._clean(response.read().decode('utf-8').strip())
+            if name is None:
+                source = 'failed'
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                # Unregistered prefix: a definite answer, rechecked rarely
+                source, retry_after = 'not_found', self.NOT_FOUND_TTL
+            else:
+                source = 'failed'
+                if e.code == 429:
+                    # Rate limited: hold the whole queue back
+                    self.next_request = now + self.FAILURE_BACKOFF
+        except Exception:
+            source = 'failed'
+
+        entry = {'name': name, 'timestamp': now, 'source': source}
+        if name is None:
+            failures = previous.get('failures', 0) + 1
+            if retry_after is None:
+                retry_after = min(self.FAILURE_BACKOFF * 2 ** (failures - 1), self.MAX_BACKOFF)
+            entry.update(failures=failures, retry_at=now + retry_after)
+        with self.cond:
+            self.cache[mac] = entry
+            self.cache.move_to_end(mac)
+            while len(self.cache) > self.MAX_ENTRIES:
+                self.cache.popitem(last=False)
+            self.dirty = True
+        return name
+
+    @staticmethod
+    def _clean(device_name):
+        """Vendor name without company suffixes, or None for an error page"""
+        # Check if it's an error message
+        if not device_name or device_name.startswith('<!') or device_name.startswith('{') \
+                or 'error' in device_name.lower():
+            return None
+        device_name = device_name.replace(' Inc.', '').replace(' Co.', '').replace(' Ltd.', '')
+        device_name = device_name.replace(' Corporation', '').replace(' Corp.', '')
+        device_name = device_name.replace(' Limited', '').replace(', Ltd', '')
+        return device_name.strip() or None
+
+    def flush(self):
+        """Write the cache to disk if it changed (atomic rename)"""
+        with self.cond:
+            if not self.dirty:
+                return
+            data = dict(self.cache)
+            self.dirty = False
+            self.last_flush = time.time()
+        try:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Error saving MAC cache: {e}")
+
+
+MAC_VENDOR_LOOKUP = MacVendorLookup(CACHE_FILE)
+
+
+def root_helper_command():
+    """Command line that starts the root helper.
+
+    HOTSPOT_ROOT_HELPER=fake runs the helper without su, so the server can
+    be exercised on plain Linux (with fake iptables/ipset on PATH).
+    """
+    helper = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'root_helper.py')
+    if os.environ.get('HOTSPOT_ROOT_HELPER') == 'fake':
+        return [sys.executable, '-u', helper]
+    return ['su', '-c', f"{shlex.quote(sys.executable)} -u {shlex.quote(helper)}"]
+
+
+def root_command(argv):
+    """argv wrapped in su, for long-running root processes whose output is streamed (tcpdump)"""
+    if os.environ.get('HOTSPOT_ROOT_HELPER') == 'fake':
+        return list(argv)
+    return ['su', '-c', shlex.join(argv)]
+
+
+class RootHelper:
+    """Persistent privileged command channel.
+
+    Starts root_helper.py once through su and talks to it over a pipe
+    instead of forking a shell and a fresh su for every command. Requests
+    carry an id, so several threads can wait on it at once; the helper is
+    restarted if it dies.
+    """
+
+    def __init__(self, command=None):
+        self.command = command
+        self.process = None
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.next_id = 0
+
+    def _start(self):
+        """Start the helper process and its reply reader (called with lock held)"""
+        self.process = subprocess.Popen(self.command or root_helper_command(),
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL, text=True, bufsize=1)
+        threading.Thread(target=self._read_replies, args=(self.process,), daemon=True).start()
+
+    def _read_replies(self, process):
+        """Hand each reply to the caller waiting on its id"""
+        for line in process.stdout:
+            try:
+                reply = json.loads(line)
+            except ValueError:
+                continue
+            waiter = self.pending.pop(reply.get("id"), None)
+            if waiter:
+                waiter["reply"] = reply
+                waiter["event"].set()
+
+        # Helper died - fail everything that was sent to this process
+        with self.lock:
+            for request_id, waiter in list(self.pending.items()):
+                if waiter["process"] is process:
+                    del self.pending[request_id]
+                    waiter["event"].set()
+
+    def run(self, argv, input_data=None, timeout=30):
+        """Run a command as root, returns (stdout, stderr, exit code)"""
+        waiter = {"event": threading.Event(), "reply": None}
+        for attempt in range(2):
+            with self.lock:
+                request_id = None
+                sent = False
+                try:
+                    if self.process is None or self.process.poll() is not None:
+                        self._start()
+                    # Registered only once there is a helper to answer it
+                    self.next_id += 1
+                    request_id = self.next_id
+                    waiter["process"] = self.process
+                    self.pending[request_id] = waiter
+                    self.process.stdin.write(json.dumps({"id": request_id, "argv": argv,
+                                                         "input": input_data, "timeout": timeout}) + '\n')
+                    self.process.stdin.flush()
+                    sent = True
+                    break
+                except (OSError, ValueError) as e:
+                    # Helper could not start or broken pipe: drop it and retry once with a new one
+                    self.process = None
+                    if attempt:
+                        return "", str(e), 1
+                finally:
+                    if not sent and request_id is not None:
+                        self.pending.pop(request_id, None)
+
+        if not waiter["event"].wait(timeout + 5):
+            self.pending.pop(request_id, None)
+            return "", "root helper timeout", 124
+        reply = waiter["reply"]
+        if reply is None:
+            return "", "root helper exited", 1
+        return reply.get("stdout", ""), reply.get("stderr", ""), reply.get("code", 1)
+
+
+ROOT_HELPER = RootHelper()
+
+
+def run_root(argv, input_data=None, timeout=30):
+    """Run an argv-style command as root through the shared helper"""
+    return ROOT_HELPER.run(argv, input_data, timeout)
+
+
+def firewall_save_command():
+    """Shell command that saves the firewall state for restore at boot"""
+    cmd = f"iptables-save > {IPTABLES_RULES_FILE}"
+    if IPSET_AVAILABLE:
+        cmd = f"ipset save {IPSET_NAME} > {IPSET_RULES_FILE} && " + cmd
+    return cmd
+
+
+# Order in which iptables-save prints the basic matches, before any -m/-j
+SAVE_OPTION_ORDER = {'-s': 0, '-d': 1, '-i': 2, '-o': 3, '-p': 4}
+
+
+def normalize_rule_spec(rule_spec):
+    """Normalize a rule spec the way iptables-save prints it.
+
+    Addresses get their prefix length (1.2.3.4 -> 1.2.3.4/32) and the
+    leading basic matches are put in iptables-save order, so
+    "-i wlan0 -d 10.0.0.0/24 ..." compares equal to the saved
+    "-d 10.0.0.0/24 -i wlan0 ...".
+    """
+    parts = rule_spec.split()
+    for i in range(len(parts) - 1):
+        if parts[i] == '--mac-source':
+            parts[i + 1] = parts[i + 1].upper()
+        elif parts[i] in ('-s', '-d'):
+            parsed = parse_ip_range(parts[i + 1])
+            if parsed is not None:
+                parts[i + 1] = format_ip_range(*parsed)
+
+    # Split off the leading basic matches (each optionally negated with "!")
+    basic = []
+    i = 0
+    while i < len(parts):
+        negated = parts[i] == '!'
+        option = parts[i + 1] if negated and i + 1 < len(parts) else parts[i]
+        end = i + (3 if negated else 2)
+        if option not in SAVE_OPTION_ORDER or end > len(parts):
+            break
+        basic.append((SAVE_OPTION_ORDER[option], parts[i:end]))
+        i = end
+    basic.sort(key=lambda match: match[0])
+    return ' '.join([part for _, match in basic for part in match] + parts[i:])
+
+
+class FirewallState:
+    """Structured model of one iptables-save snapshot: tables -> chains and rules.
+
+    Snapshots taken with counters (iptables-save -c) also carry the
+    [packets:bytes] of every rule, summed over duplicate copies.
+    """
+
+    def __init__(self, text=''):
+        self.tables = {}
+        table = None
+        for line in text.split('\n'):
+            if line.startswith('*'):
+                table = self.tables.setdefault(line[1:].strip(), {"chains": {}, "rules": [], "counters": {}})
+            elif table is None:
+                continue
+            elif line.startswith(':'):
+                fields = line[1:].split()
+                table["chains"][fields[0]] = fields[1] if len(fields) > 1 else '-'
+            else:
+                counts = None
+                if line.startswith('['):
+                    counts, _, line = line.partition('] ')
+                if not line.startswith('-A '):
+                    continue
+                chain, _, spec = line[3:].partition(' ')
+                rule = (chain, spec.strip())
+                table["rules"].append(rule)
+                if counts:
+                    packets, _, byte_count = counts[1:].partition(':')
+                    previous = table["counters"].get(rule, (0, 0))
+                    table["counters"][rule] = (previous[0] + int(packets), previous[1] + int(byte_count))
+
+    @classmethod
+    def load(cls, table=None, counters=False):
+        """Read the live ruleset with a single iptables-save call"""
+        stdout, _, _ = run_root(['iptables-save'] + (['-c'] if counters else []) +
+                                (['-t', table] if table else []))
+        return cls(stdout)
+
+    def counters(self, table, chain, rule_spec):
+        """(packets, bytes) of a rule in a counters snapshot, (0, 0) if absent"""
+        return self.tables.get(table, {}).get("counters", {}).get((chain, normalize_rule_spec(rule_spec)), (0, 0))
+
+    def chains(self, table):
+        """Chain names of a table"""
+        return set(self.tables.get(table, {}).get("chains", {}))
+
+    def rules(self, table, chain=None):
+        """(chain, spec) pairs of a table, optionally limited to one chain"""
+        rules = self.tables.get(table, {}).get("rules", [])
+        if chain:
+            return [rule for rule in rules if rule[0] == chain]
+        return list(rules)
+
+
+class RuleTransaction:
+    """Collect iptables rule changes and apply them in one iptables-restore call.
+
+    Deletes are resolved against a single iptables-save snapshot, so only
+    rules that actually exist are removed (iptables-restore aborts the whole
+    batch on a missing rule). The batch is committed with
+    iptables-restore --noflush, which applies every change or none of them.
+    """
+
+    def __init__(self, table='filter', state=None):
+        self.table = table
+        self.chains = []
+        self.existing_chains = set()
+        self.changes = []
+        self.started = time.time()
+        self._rules = None
+        if state is not None:
+            self._use_state(state)
+
+    def _use_state(self, state):
+        self._rules = state.rules(self.table)
+        self.existing_chains = state.chains(self.table)
+
+    def snapshot(self):
+        """Current rules of the table as a list of (chain, spec), loaded once"""
+        if self._rules is None:
+            self._use_state(FirewallState.load(self.table))
+        return self._rules
+
+    def has_chain(self, chain):
+        """Check if a chain exists in the snapshot"""
+        self.snapshot()
+        return chain in self.existing_chains or chain in self.chains
+
+    def exists(self, chain, rule_spec):
+        """Check if a rule is present in the snapshot"""
+        return (chain, normalize_rule_spec(rule_spec)) in self.snapshot()
+
+    def chain_rules(self, chain):
+        """Rule specs of one chain in order"""
+        return [spec for c, spec in self.snapshot() if c == chain]
+
+    def flush_chain(self, chain):
+        """Declare a user chain: created if missing, emptied if it exists"""
+        self.chains.append(chain)
+        self._rules = [rule for rule in self.snapshot() if rule[0] != chain]
+
+    def insert(self, chain, rule_spec, position=1):
+        """Queue an insert at the given position"""
+        self.changes.append(f"-I {chain} {position} {rule_spec}")
+        rules = self.snapshot()
+        index = len(rules)
+        seen = 0
+        for i, (c, _) in enumerate(rules):
+            if c == chain:
+                if seen == position - 1:
+                    index = i
+                    break
+                seen += 1
+        rules.insert(index, (chain, normalize_rule_spec(rule_spec)))
+
+    def append(self, chain, rule_spec):
+        """Queue an append to the end of the chain"""
+        self.changes.append(f"-A {chain} {rule_spec}")
+        self.snapshot().append((chain, normalize_rule_spec(rule_spec)))
+
+    def dedupe(self, chain, rule_spec):
+        """Queue deletion of extra copies of a rule so exactly one remains"""
+        rule = (chain, normalize_rule_spec(rule_spec))
+        rules = self.snapshot()
+        extra = rules.count(rule) - 1
+        for i in range(max(extra, 0)):
+            self.changes.append(f"-D {chain} {rule_spec}")
+            rules.remove(rule)
+        return max(extra, 0)
+
+    def delete(self, chain, rule_spec):
+        """Queue deletion of every copy of a rule, returns the number of copies"""
+        rule = (chain, normalize_rule_spec(rule_spec))
+        rules = self.snapshot()
+        count = rules.count(rule)
+        for i in range(count):
+            self.changes.append(f"-D {chain} {rule_spec}")
+            rules.remove(rule)
+        return count
+
+    def delete_chain(self, chain):
+        """Queue removal of a user chain and its rules (rules jumping to it must be deleted first)"""
+        self.changes.append(f"-F {chain}")
+        self.changes.append(f"-X {chain}")
+        self._rules = [rule for rule in self.snapshot() if rule[0] != chain]
+        self.existing_chains.discard(chain)
+
+    def commit(self, persist=False):
+        """Apply all queued changes atomically.
+
+        With persist=True the resulting ruleset is also saved to
+        iptables-rules.txt in the same root call.
+        """
+        result = {"success": True, "rules_applied": len(self.changes), "elapsed_ms": 0, "error": ""}
+        if self.chains or self.changes:
+            payload = f"*{self.table}\n"
+            payload += ''.join(f":{chain} - [0:0]\n" for chain in self.chains)
+            payload += ''.join(f"{change}\n" for change in self.changes) + "COMMIT\n"
+            cmd = "iptables-restore --noflush"
+            if persist:
+                cmd += " && " + firewall_save_command()
+            stdout, stderr, code = run_root(['sh', '-c', cmd], payload)
+            if code != 0:
+                result.update(success=False, rules_applied=0,
+                              error=(stderr or stdout).strip() or "iptables-restore failed")
+        result["elapsed_ms"] = round((time.time() - self.started) * 1000, 1)
+        return result
+
+
+def normalize_ip_range(ip_range):
+    """Return canonical CIDR text for an IP or range, or None if invalid"""
+    try:
+        return str(ipaddress.IPv4Network(str(ip_range).strip(), strict=False))
+    except ValueError:
+        return None
+
+
+def parse_ip_range(ip_range):
+    """Parse an IP or CIDR into (network int, prefix length), or None if invalid.
+
+    Plain dotted quads with an optional numeric prefix are parsed with integer
+    arithmetic (compile_blocklist runs this for every range in the blocklist);
+    anything else goes through ipaddress.
+    """
+    text = str(ip_range).strip()
+    address, _, prefix = text.partition('/')
+    parts = address.split('.')
+    if (len(parts) == 4 and all(p.isdigit() and len(p) <= 3 and (p == '0' or p[0] != '0') for p in parts)
+            and (not prefix or (prefix.isdigit() and len(prefix) <= 2))):
+        octets = [int(p) for p in parts]
+        prefixlen = int(prefix) if prefix else 32
+        if max(octets) <= 255 and prefixlen <= 32:
+            value = (octets[0] << 24) | (octets[1] << 16) | (octets[2] << 8) | octets[3]
+            mask = (0xFFFFFFFF << (32 - prefixlen)) & 0xFFFFFFFF
+            return value & mask, prefixlen
+        return None
+    network = normalize_ip_range(text)
+    if network is None:
+        return None
+    network = ipaddress.IPv4Network(network)
+    return int(network.network_address), network.prefixlen
+
+
+def format_ip_range(start, prefixlen):
+    """CIDR text for (network int, prefix length)"""
+    return f"{start >> 24}.{(start >> 16) & 255}.{(start >> 8) & 255}.{start & 255}/{prefixlen}"
+
+
+def compile_blocklist(blocked_data):
+    """Compile the blocklist into the minimal set of CIDRs to emit as rules.
+
+    Adjacent prefixes are merged and ranges covered by a larger one are
+    dropped, across all blocked domains. Returns (cidrs, owners) where
+    owners maps each compiled CIDR to the (domain, original range) pairs it
+    covers, so per-domain edits still know which domain owns what.
+    """
+    sources = []
+    for url, info in blocked_data.items():
+        for ip_range in info.get("ip_ranges", info.get("ips", [])):
+            parsed = parse_ip_range(ip_range)
+            if parsed is None:
+                print(f"  Skipping invalid range {ip_range!r} for {url}")
+                continue
+            sources.append((parsed[0], parsed[0] + (1 << (32 - parsed[1])) - 1, parsed[1], url))
+
+    # Merge overlapping/adjacent intervals, then split each back into aligned CIDRs
+    # (same result as ipaddress.collapse_addresses, without per-range objects)
+    merged = []
+    for start, end, _, _ in sorted(sources):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    compiled = []
+    for start, end in merged:
+        while start <= end:
+            size = (start & -start) if start else 1 << 32
+            while size > end - start + 1:
+                size >>= 1
+            compiled.append((start, 33 - size.bit_length()))
+            start += size
+
+    starts = [start for start, _ in compiled]
+    cidrs = [format_ip_range(start, prefixlen) for start, prefixlen in compiled]
+    owners = {cidr: [] for cidr in cidrs}
+    for start, _, prefixlen, url in sources:
+        # compiled is sorted and non-overlapping
+        owners[cidrs[bisect.bisect_right(starts, start) - 1]].append((url, format_ip_range(start, prefixlen)))
+
+    return cidrs, owners
+
+
+def blocklist_ranges(blocked_data):
+    """Minimal list of CIDRs that covers every range in the blocklist"""
+    return compile_blocklist(blocked_data)[0]
+
+
+def detect_ipset():
+    """Enable the ipset backend if the ipset tool and kernel support are present"""
+    global IPSET_AVAILABLE
+    _, _, code = run_root(['ipset', 'create', IPSET_NAME, 'hash:net', 'family', 'inet',
+                           'maxelem', '262144', '-exist'], timeout=10)
+    IPSET_AVAILABLE = code == 0
+    print(f"Blocklist backend: {'ipset hash:net' if IPSET_AVAILABLE else 'iptables rules'}")
+    return IPSET_AVAILABLE
+
+
+def run_ipset_batch(lines, persist=False):
+    """Feed commands to one 'ipset restore' call, returns (success, error)"""
+    cmd = "ipset restore -exist"
+    if persist:
+        cmd += " && " + firewall_save_command()
+    stdout, stderr, code = run_root(['sh', '-c', cmd], ''.join(f"{line}\n" for line in lines))
+    if code != 0:
+        return False, (stderr or stdout).strip() or "ipset restore failed"
+    return True, ""
+
+
+def migrate_legacy_block_rules(tx):
+    """Queue removal of per-range rules (plain "-d <range> -j DROP/REJECT") from FORWARD/OUTPUT"""
+    for parent in BLOCK_CHAIN_PARENTS:
+        for spec in tx.chain_rules(parent):
+            if LEGACY_BLOCK_RULE.match(spec):
+                tx.delete(parent, spec)
+
+
+def ensure_block_jumps(tx):
+    """Queue changes so each parent chain has exactly one jump to HOTSPOT_BLOCK, at position 1"""
+    jump = f'-j {BLOCK_CHAIN}'
+    for parent in BLOCK_CHAIN_PARENTS:
+        parent_rules = tx.chain_rules(parent)
+        if parent_rules[:1] != [jump] or parent_rules.count(jump) != 1:
+            tx.delete(parent, jump)
+            tx.insert(parent, jump)
+
+
+def block_chain_specs(ranges):
+    """Rule specs HOTSPOT_BLOCK should contain for the compiled ranges"""
+    if IPSET_AVAILABLE:
+        return [f'-m set --match-set {IPSET_NAME} dst -j DROP']
+    return [f'-d {ip_range} -j DROP' for ip_range in ranges]
+
+
+def ipset_members():
+    """Current members of the blocklist set (one 'ipset list' call)"""
+    members = []
     try:
-        with open(BLOCKLIST, 'r') as f:
-            blocked_domains = [line.strip().lower() for line in f if line.strip()]
+        stdout, _, _ = run_root(['ipset', 'list', IPSET_NAME])
+        in_members = False
+        for line in stdout.split('\n'):
+            if line.startswith('Members:'):
+                in_members = True
+            elif in_members and line.strip():
+                network = normalize_ip_range(line.split()[0])
+                if network:
+                    members.append(network)
+    except:
+        pass
+    return members
+
+
+def rebuild_block_chain(blocked_data, persist=True):
+    """Atomically rebuild the HOTSPOT_BLOCK chain from the blocklist.
+
+    The chain is flushed and reloaded in one iptables-restore call, and a
+    single jump at the top of FORWARD (and OUTPUT) sends traffic through it.
+    Per-range rules left directly in FORWARD/OUTPUT by older versions and
+    the shell scripts are removed in the same transaction.
+
+    With the ipset backend the ranges are loaded into a fresh set that is
+    swapped in atomically, and the chain holds a single set match rule.
+    """
+    global IPSET_AVAILABLE
+    started = time.time()
+    ranges = blocklist_ranges(blocked_data)
+
+    if IPSET_AVAILABLE:
+        tmp_set = f"{IPSET_NAME}_new"
+        create = "hash:net family inet maxelem 262144"
+        lines = [f"create {IPSET_NAME} {create}", f"create {tmp_set} {create}", f"flush {tmp_set}"]
+        lines += [f"add {tmp_set} {ip_range}" for ip_range in ranges]
+        lines += [f"swap {tmp_set} {IPSET_NAME}", f"destroy {tmp_set}"]
+        ok, error = run_ipset_batch(lines)
+        if not ok:
+            print(f"ipset load failed, falling back to iptables rules: {error}")
+            IPSET_AVAILABLE = False
+
+    tx = RuleTransaction()
+    tx.started = started
+    migrate_legacy_block_rules(tx)
+
+    tx.flush_chain(BLOCK_CHAIN)
+    for spec in block_chain_specs(ranges):
+        tx.append(BLOCK_CHAIN, spec)
+
+    ensure_block_jumps(tx)
+    result = tx.commit(persist=persist)
+    if not result["success"] and IPSET_AVAILABLE:
+        # Kernel without the xt_set match - retry with plain rules
+        print(f"Set match rule failed, falling back to iptables rules: {result['error']}")
+        IPSET_AVAILABLE = False
+        return rebuild_block_chain(blocked_data, persist)
+    if IPSET_AVAILABLE:
+        result["rules_applied"] += len(ranges)
+    result["ranges"] = len(ranges)
+    return result
+
+
+def update_block_rules(old_ranges, blocked_data, persist=True):
+    """Apply one blocklist edit to the firewall.
+
+    With the ipset backend only the ranges that changed are added to or
+    removed from the set; otherwise the chain is rebuilt.
+    """
+    if not IPSET_AVAILABLE:
+        return rebuild_block_chain(blocked_data, persist)
+
+    started = time.time()
+    new_ranges = blocklist_ranges(blocked_data)
+    old_set, new_set = set(old_ranges), set(new_ranges)
+    added = [ip_range for ip_range in new_ranges if ip_range not in old_set]
+    removed = [ip_range for ip_range in old_ranges if ip_range not in new_set]
+    lines = [f"add {IPSET_NAME} {ip_range}" for ip_range in added]
+    lines += [f"del {IPSET_NAME} {ip_range}" for ip_range in removed]
+
+    ok, error = True, ""
+    if lines:
+        ok, error = run_ipset_batch(lines, persist)
+    return {"success": ok, "rules_applied": len(lines) if ok else 0,
+            "elapsed_ms": round((time.time() - started) * 1000, 1),
+            "error": error, "ranges": len(new_ranges)}
+
+
+def plan_block_chain(tx, ranges):
+    """Queue the minimal changes that make HOTSPOT_BLOCK and its jumps match the compiled ranges"""
+    migrate_legacy_block_rules(tx)
+    if not tx.has_chain(BLOCK_CHAIN):
+        tx.flush_chain(BLOCK_CHAIN)
+    desired = block_chain_specs(ranges)
+    present = tx.chain_rules(BLOCK_CHAIN)
+    for spec in set(present):
+        if spec not in desired or present.count(spec) > 1:
+            tx.delete(BLOCK_CHAIN, spec)
+    for spec in desired:
+        if not tx.exists(BLOCK_CHAIN, spec):
+            tx.append(BLOCK_CHAIN, spec)
+    ensure_block_jumps(tx)
+
+
+def plan_ipset_members(ranges):
+    """ipset add/del lines that make the live set match the compiled ranges"""
+    members = ipset_members()
+    present, wanted = set(members), set(ranges)
+    lines = [f"add {IPSET_NAME} {ip_range}" for ip_range in ranges if ip_range not in present]
+    lines += [f"del {IPSET_NAME} {ip_range}" for ip_range in members if ip_range not in wanted]
+    return lines
+
+
+def restore_block_rules(blocked_data):
+    """Bring the firewall in line with the blocklist, applying only the difference.
+
+    Reads the live ruleset once (plus the set members with the ipset
+    backend), compares it with the compiled blocklist and applies the
+    missing/stale entries in one batch. Progress is published in
+    RESTORE_STATUS for /api/health.
+    """
+    global IPSET_AVAILABLE
+    started = time.time()
+    RESTORE_STATUS.update(state="reading", started_at=started, total=0, applied=0, error="")
+    ranges = blocklist_ranges(blocked_data)
+    ipset_lines = []
+
+    if IPSET_AVAILABLE:
+        ipset_lines = plan_ipset_members(ranges)
+
+    tx = RuleTransaction()
+    tx.started = started
+    tx.snapshot()
+    RESTORE_STATUS["state"] = "diffing"
+    plan_block_chain(tx, ranges)
+
+    RESTORE_STATUS.update(state="applying", total=len(ipset_lines) + len(tx.changes))
+    if ipset_lines:
+        ok, error = run_ipset_batch(ipset_lines)
+        if not ok:
+            print(f"ipset restore failed, rebuilding with iptables rules: {error}")
+            IPSET_AVAILABLE = False
+            result = rebuild_block_chain(blocked_data, persist=False)
+            RESTORE_STATUS.update(state="done" if result["success"] else "failed",
+                                  applied=result["rules_applied"], error=result["error"],
+                                  elapsed_ms=result["elapsed_ms"], finished_at=time.time())
+            return result
+
+    result = tx.commit()
+    if not result["success"] and IPSET_AVAILABLE:
+        # Kernel without the xt_set match - rebuild with plain rules
+        IPSET_AVAILABLE = False
+        result = rebuild_block_chain(blocked_data, persist=False)
+    elif result["success"]:
+        result["rules_applied"] += len(ipset_lines)
+    result["ranges"] = len(ranges)
+
+    RESTORE_STATUS.update(state="done" if result["success"] else "failed",
+                          applied=result["rules_applied"], error=result["error"],
+                          elapsed_ms=result["elapsed_ms"], finished_at=time.time())
+    return result
+
+
+def interface_ipv4(name):
+    """IPv4 interface ("addr/prefix") of a network interface via ioctl, None if it has none"""
+    packed = struct.pack('256s', name.encode()[:15])
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            address = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), 0x8915, packed)[20:24])   # SIOCGIFADDR
+            netmask = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), 0x891b, packed)[20:24])   # SIOCGIFNETMASK
+        except OSError as e:
+            if e.errno in (errno.EADDRNOTAVAIL, errno.ENODEV):
+                return None
+            raise
+    return str(ipaddress.IPv4Interface(f"{address}/{netmask}"))
+
+
+class InterfaceRegistry:
+    """Active hotspot interfaces and their subnets, shared by everything that needs them.
+
+    The state is read from /sys/class/net and one ioctl per candidate
+    interface (falling back to a single `ip -o -4 addr show` where ioctls are
+    not permitted) and is refreshed on `ip -o monitor address link` events, or
+    every POLL_INTERVAL seconds while that stream is unavailable. Listeners are
+    called with (old, new) {iface: subnet} maps whenever the hotspot comes up,
+    goes down, moves to another interface or is recreated (new ifindex).
+    """
+
+    POLL_INTERVAL = 5
+
+    def __init__(self):
+        self.state = {}          # iface -> (subnet, ifindex)
+        self.scanned_at = 0
+        self.watching = False
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the watcher thread"""
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def _loop(self):
+        while True:
+            try:
+                proc = subprocess.Popen(['ip', '-o', 'monitor', 'address', 'link'], stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL, text=True)
+            except OSError:
+                proc = None
+            started = time.time()
+            self.scan()
+            if proc:
+                try:
+                    self.watching = True
+                    for line in proc.stdout:
+                        self.scan()
+                finally:
+                    self.watching = False
+                    proc.kill()
+                    proc.wait()
+            # Poll while the event stream is unavailable (or was only briefly up)
+            if time.time() - started < 60:
+                time.sleep(self.POLL_INTERVAL)
+
+    def _read(self):
+        """{iface: (subnet, ifindex)} for hotspot interfaces with a 192.168 address"""
+        try:
+            present = set(os.listdir('/sys/class/net'))
+        except OSError:
+            present = set(HOTSPOT_INTERFACES)
+        state = {}
+        try:
+            for iface in HOTSPOT_INTERFACES:
+                if iface not in present:
+                    continue
+                address = interface_ipv4(iface)
+                if address and address.startswith('192.168'):
+                    state[iface] = (str(ipaddress.IPv4Interface(address).network), socket.if_nametoindex(iface))
+            return state
+        except OSError:
+            pass
+        # ioctls not permitted here: one ip call for all interfaces
+        try:
+            result = subprocess.run(['ip', '-o', '-4', 'addr', 'show'], capture_output=True, text=True, timeout=5)
+            for line in result.stdout.split('\n'):
+                parts = line.split()
+                if len(parts) > 3 and parts[1] in HOTSPOT_INTERFACES and parts[3].startswith('192.168') \
+                        and parts[1] not in state:
+                    state[parts[1]] = (str(ipaddress.IPv4Interface(parts[3]).network), int(parts[0].rstrip(':')))
+        except:
+            pass
+        return state
+
+    def scan(self):
+        """Re-read the interfaces and notify listeners if the hotspot changed"""
+        state = self._read()
+        with self.lock:
+            old, self.state = self.state, state
+            first, self.scanned_at = not self.scanned_at, time.time()
+        if state != old and not first:
+            old_map = {iface: subnet for iface, (subnet, _) in old.items()}
+            new_map = {iface: subnet for iface, (subnet, _) in state.items()}
+            for listener in self.listeners:
+                try:
+                    listener(old_map, new_map)
+                except Exception as e:
+                    print(f"Interface listener error: {e}")
 
-        for blocked_domain in blocked_domains:
-            if domain and blocked_domain in domain.lower():
-                return True
+    def interfaces(self):
+        """{iface: subnet} of the active hotspot interfaces, in HOTSPOT_INTERFACES order"""
+        if not self.watching and time.time() - self.scanned_at > self.POLL_INTERVAL:
+            self.scan()
+        with self.lock:
+            return {iface: subnet for iface, (subnet, _) in self.state.items()}
+
+    def hotspot(self):
+        """Primary hotspot interface and its subnet, or (None, None)"""
+        for iface, subnet in self.interfaces().items():
+            return iface, subnet
+        return None, None
+
+
+HOTSPOT_REGISTRY = InterfaceRegistry()
+
+
+def detect_hotspot_interface():
+    """Hotspot interface and its subnet, or (None, None)"""
+    return HOTSPOT_REGISTRY.hotspot()
+
+
+def detect_hotspot_network():
+    """Hotspot subnet and upstream (mobile data) interface, or (None, None)"""
+    _, subnet = detect_hotspot_interface()
+    upstream = None
+    try:
+        result = subprocess.run(['ip', 'route', 'get', '1.1.1.1'], capture_output=True, text=True, timeout=5)
+        parts = result.stdout.split()
+        if 'dev' in parts:
+            upstream = parts[parts.index('dev') + 1]
     except:
         pass
-    return False
+    if upstream in HOTSPOT_INTERFACES:
+        upstream = None
+    return subnet, upstream
+
+
+def accounting_specs(ip, mac):
+    """Outgoing and incoming accounting rules of one device"""
+    # Return traffic carries the router's source MAC, so incoming matches on IP only
+    return f'-s {ip} -m mac --mac-source {mac}', f'-d {ip}'
+
+
+def accounting_chain(mac):
+    """Name of a device's accounting chain (ACCT_AABBCCDDEEFF)"""
+    return 'ACCT_' + mac.replace(':', '').replace('-', '').upper()
+
+
+def plan_accounting(tx, devices=None, gc=True):
+    """Queue the changes that give every device its own accounting chain.
+
+    Desired layout: one jump to HOTSPOT_ACCT in FORWARD (right after the
+    HOTSPOT_BLOCK jump, so dropped traffic is not counted); HOTSPOT_ACCT holds
+    "-s ip -j ACCT_<MAC>" and "-d ip -j ACCT_<MAC>" per device, and each
+    ACCT_<MAC> chain the device's outgoing and incoming counting rules. Only
+    client traffic reaches a device chain, and one device's counters can be
+    zeroed alone. Legacy counting rules in FORWARD are removed. With gc, chains
+    of devices not seen for ACCOUNTING_GC_AFTER seconds are deleted.
+    """
+    now = time.time()
+    if not tx.has_chain(ACCOUNTING_CHAIN):
+        tx.flush_chain(ACCOUNTING_CHAIN)
+    for spec in tx.chain_rules('FORWARD'):
+        if ACCOUNTING_RULE.match(spec):
+            tx.delete('FORWARD', spec)
+
+    jump = f'-j {ACCOUNTING_CHAIN}'
+    forward = tx.chain_rules('FORWARD')
+    position = 2 if forward[:1] == [f'-j {BLOCK_CHAIN}'] else 1
+    if forward.count(jump) != 1 or forward.index(jump) != position - 1:
+        tx.delete('FORWARD', jump)
+        tx.insert('FORWARD', jump, position)
+
+    desired = {}
+    for ip, mac in devices or []:
+        chain = accounting_chain(mac)
+        ACCOUNTING_SEEN[chain] = now
+        desired[chain] = [f'-s {ip} -j {chain}', f'-d {ip} -j {chain}']
+        if not tx.has_chain(chain):
+            tx.flush_chain(chain)
+        wanted = [normalize_rule_spec(spec) for spec in accounting_specs(ip, mac)]
+        if tx.chain_rules(chain) != wanted:
+            for spec in set(tx.chain_rules(chain)):
+                tx.delete(chain, spec)
+            for spec in wanted:
+                tx.append(chain, spec)
+
+    # Dispatch rules: exactly the desired ones for known devices (IP changes drop the old pair)
+    dispatch = tx.chain_rules(ACCOUNTING_CHAIN)
+    for spec in set(dispatch):
+        target = spec.rsplit(' -j ', 1)[-1]
+        if target in desired and (normalize_rule_spec(spec) not in map(normalize_rule_spec, desired[target])
+                                  or dispatch.count(spec) > 1):
+            tx.delete(ACCOUNTING_CHAIN, spec)
+    for specs in desired.values():
+        for spec in specs:
+            if not tx.exists(ACCOUNTING_CHAIN, spec):
+                tx.append(ACCOUNTING_CHAIN, spec)
+
+    if gc:
+        chains = [chain for chain in tx.existing_chains if chain.startswith('ACCT_') and chain not in desired]
+        for chain in chains:
+            # Chains found on the firewall get a full grace period from first sight
+            if now - ACCOUNTING_SEEN.setdefault(chain, now) < ACCOUNTING_GC_AFTER:
+                continue
+            for spec in tx.chain_rules(ACCOUNTING_CHAIN):
+                if spec.endswith(f' -j {chain}'):
+                    tx.delete(ACCOUNTING_CHAIN, spec)
+            tx.delete_chain(chain)
+            ACCOUNTING_SEEN.pop(chain, None)
+
+
+def collect_usage_counters(devices):
+    """Byte counters of all devices from one iptables-save -c snapshot.
+
+    devices is a list of (ip, mac) pairs. Accounting chains or rules missing
+    from the snapshot are added in a single iptables-restore batch (they start
+    at 0). Returns {mac (uppercase): {"bytes_in", "bytes_out"}}. Callers that
+    record the result hold BLOCKLIST_LOCK across the read and the recording.
+    """
+    state = FirewallState.load('filter', counters=True)
+    tx = RuleTransaction('filter', state)
+    plan_accounting(tx, devices, gc=False)
+    usage = {}
+    for ip, mac in devices:
+        chain = accounting_chain(mac)
+        spec_out, spec_in = accounting_specs(ip, mac)
+        usage[mac.upper()] = {"bytes_in": state.counters('filter', chain, spec_in)[1],
+                              "bytes_out": state.counters('filter', chain, spec_out)[1]}
+    if tx.changes or tx.chains:
+        result = tx.commit()
+        if not result["success"]:
+            print(f"Error adding accounting rules: {result['error']}")
+    return usage
+
+
+def read_accounting_counters(macs):
+    """Counters of existing device chains only, by listing just those chains in one root call.
+
+    Much cheaper than a full iptables-save -c when the blocklist chain is
+    large. Relies on the chain layout from plan_accounting (outgoing rule
+    first, incoming second); devices whose chain is missing are left out.
+    """
+    chains = {accounting_chain(mac): mac.upper() for mac in macs}
+    if not chains:
+        return {}
+    stdout, _, _ = run_root(['sh', '-c', '; '.join(f'iptables -w -L {chain} -v -x -n 2>/dev/null'
+                                                   for chain in chains)])
+    rows = {}
+    current = None
+    for line in stdout.split('\n'):
+        parts = line.split()
+        if line.startswith('Chain '):
+            current = chains.get(parts[1])
+            if current:
+                rows[current] = []
+        elif current and len(parts) > 1 and parts[0].isdigit():
+            rows[current].append(int(parts[1]))
+    return {mac: {"bytes_out": counts[0], "bytes_in": counts[1]} for mac, counts in rows.items() if len(counts) == 2}
+
+
+def reset_usage_counters(mac=None):
+    """Zero the accounting counters of one device (or of every device), leaving other counters alone.
+
+    Returns (success, error). A device without an accounting chain has no
+    counters to zero, which counts as success.
+    """
+    if mac:
+        if not MAC_ADDRESS.fullmatch(mac):
+            return False, f"Invalid MAC address: {mac}"
+        chains = [accounting_chain(mac)]
+    else:
+        chains = sorted(chain for chain in FirewallState.load('filter').chains('filter') if chain.startswith('ACCT_'))
+    for chain in chains:
+        _, stderr, code = run_root(['iptables', '-w', '-Z', chain])
+        if code != 0 and 'No chain' not in stderr:
+            return False, stderr.strip() or f"Could not reset the counters of {chain}"
+    return True, ""
+
+
+def reconcile_firewall(devices=None, state=None, blocked_data=None):
+    """Compare one iptables-save snapshot with the desired state and apply the minimal change set.
+
+    Desired state:
+      - HOTSPOT_BLOCK holds the compiled blocklist, with one jump at the top of FORWARD/OUTPUT
+      - HOTSPOT_ACCT jumped to once from FORWARD, with an ACCT_<MAC> chain per device (see plan_accounting)
+      - hotspot essentials: MASQUERADE to the upstream interface and the two FORWARD ACCEPTs
+
+    devices is a list of (ip, mac) pairs whose accounting chains should exist;
+    without it only the accounting layout is checked. When nothing
+    differs no root command besides the snapshot is run, so this is cheap to
+    call periodically. Returns the issues found and fixes applied.
+    """
+    started = time.time()
+    state = state or FirewallState.load()
+    report = {"success": True, "issues": [], "fixes": [], "rules_applied": 0, "elapsed_ms": 0, "error": ""}
+
+    if blocked_data is None:
+        try:
+            blocked_data = BLOCKLIST_STORE.load()
+        except:
+            blocked_data = {}
+
+    filter_tx = RuleTransaction('filter', state)
+    nat_tx = RuleTransaction('nat', state)
+
+    def check(tx, issue, fix, plan):
+        """Run one planning step and record it if it queued changes"""
+        before = len(tx.changes)
+        plan()
+        queued = len(tx.changes) - before
+        if queued:
+            report["issues"].append(issue.format(n=queued))
+            report["fixes"].append(fix.format(n=queued))
+
+    # Accounting chain: one jump, a chain per known device, stale device chains removed
+    check(filter_tx, "Found {n} out of date accounting rules", "Fixed {n} accounting rules",
+          lambda: plan_accounting(filter_tx, devices))
+
+    # Blocklist chain (ipset members are diffed separately)
+    ranges = blocklist_ranges(blocked_data)
+    ipset_lines = plan_ipset_members(ranges) if IPSET_AVAILABLE else []
+    if ipset_lines:
+        report["issues"].append(f"Found {len(ipset_lines)} blocklist set entries out of date")
+    check(filter_tx, "Blocking chain is NOT at top or out of date ({n} changes)",
+          "Restored HOTSPOT_BLOCK chain ({n} changes)", lambda: plan_block_chain(filter_tx, ranges))
+
+    # Hotspot essentials
+    subnet, upstream = detect_hotspot_network()
+    if subnet and upstream:
+        essentials = [
+            (nat_tx, 'POSTROUTING', f'-s {subnet} -o {upstream} -j MASQUERADE', "MASQUERADE rule"),
+            (filter_tx, 'FORWARD', f'-s {subnet} -o {upstream} -j ACCEPT', "FORWARD ACCEPT for outgoing"),
+            (filter_tx, 'FORWARD', f'-d {subnet} -i {upstream} -m state --state RELATED,ESTABLISHED -j ACCEPT',
+             "FORWARD ACCEPT for incoming"),
+        ]
+        for tx, chain, spec, name in essentials:
+            def plan_essential(tx=tx, chain=chain, spec=spec):
+                if tx.exists(chain, spec):
+                    tx.dedupe(chain, spec)
+                else:
+                    tx.append(chain, spec)
+            check(tx, f"Missing or duplicate {name}", f"Fixed {name}", plan_essential)
+
+    # Apply: set members first (the chain may reference the set), then one restore per table
+    if ipset_lines:
+        ok, error = run_ipset_batch(ipset_lines)
+        if ok:
+            report["fixes"].append(f"Updated {len(ipset_lines)} blocklist set entries")
+            report["rules_applied"] += len(ipset_lines)
+        else:
+            report.update(success=False, error=error)
+    for tx in (filter_tx, nat_tx):
+        if tx.changes:
+            result = tx.commit()
+            if result["success"]:
+                report["rules_applied"] += result["rules_applied"]
+            else:
+                report.update(success=False, error=result["error"])
+
+    report["elapsed_ms"] = round((time.time() - started) * 1000, 1)
+    return report
 
-def fetch_device_name_from_web(mac):
-    """Fetch device name from macvendors.com API with permanent caching"""
-    # Check cache first (permanent - never expires)
-    if mac in MAC_LOOKUP_CACHE:
-        cached = MAC_LOOKUP_CACHE[mac]
-        cached_name = cached.get('name')
-        if cached_name and cached_name != 'Unknown':
-            return cached_name
 
+def reconcile_loop():
+    """Periodically re-apply the desired firewall state (one iptables-save per run when in sync)"""
+    while True:
+        # Woken early when the hotspot interface changes
+        RECONCILE_WAKEUP.wait(RECONCILE_INTERVAL)
+        RECONCILE_WAKEUP.clear()
+        try:
+            devices = [(d["ip"], d["mac"]) for d in DEVICE_INVENTORY.snapshot()["devices"]]
+            with BLOCKLIST_LOCK:
+                report = reconcile_firewall(devices)
+            if report["rules_applied"] or not report["success"]:
+                print(f"Firewall reconcile: {', '.join(report['fixes']) or 'no fixes'} {report['error']}")
+        except Exception as e:
+            print(f"Firewall reconcile error: {e}")
+
+
+def is_ip_address(value):
+    """True for an IPv4 or IPv6 address"""
     try:
-        # Use macvendors.com API - simple and reliable
-        url = f"https://api.macvendors.com/{mac}"
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36'
+        ipaddress.ip_address(value)
+        return True
+    except ValueError:
+        return False
+
+
+def parse_blocklist_line(line):
+    """Parse one line of a hosts file, domain list or CIDR feed.
+
+    Returns a list of ('domain', name) / ('cidr', network) items; an empty
+    list for blank lines and comments, None if the line is not understood.
+    Networks that are too broad or not globally routable (private, loopback,
+    link-local, multicast, reserved) come back as ('skipped', network), and
+    local names in hosts entries (localhost) as ('skipped', name).
+    """
+    line = line.split('#', 1)[0].strip().lower()
+    if not line:
+        return []
+    tokens = line.split()
+    # hosts file: "0.0.0.0 ads.example.com [more names]"; local names such as
+    # "127.0.0.1 localhost" or "::1 ip6-localhost" are skipped
+    if len(tokens) > 1 and is_ip_address(tokens[0]):
+        names = [name.rstrip('.') for name in tokens[1:]]
+        return [('domain' if HOST_NAME.match(name) else 'skipped', name) for name in names]
+    if len(tokens) != 1:
+        return None
+    network = normalize_ip_range(tokens[0])
+    if network is not None:
+        # Refuse feed entries that would cut off most of the internet (0.0.0.0/0 etc.),
+        # the hotspot subnet or the phone itself
+        parsed = ipaddress.IPv4Network(network)
+        if (parsed.prefixlen < 8 or not parsed.is_global
+                or any(parsed.overlaps(reserved) for reserved in NON_GLOBAL_NETWORKS)):
+            return [('skipped', network)]
+        return [('cidr', network)]
+    name = re.sub(r'^(\*\.|www\.)', '', tokens[0].rstrip('.'))
+    if HOST_NAME.match(name):
+        return [('domain', name)]
+    return None
+
+
+def refresh_changes(entry, ips, complete, provenance):
+    """(added, removed) addresses of one entry after a fresh lookup.
+
+    Only ranges that came from DNS (provenance 'resolved' or 'refresh') are
+    managed here; manually entered, imported and learned ranges are never
+    removed. Addresses inside one of the entry's wider ranges are not added
+    (and resolved ones already there are removed). Otherwise nothing is
+    removed unless the lookup was complete.
+    provenance is a callable returning the entry's provenance, so it is only
+    read when a removal is possible.
+    """
+    current = entry.get("ip_ranges", entry.get("ips", []))
+    present, found = set(current), set(ips)
+    networks = [ipaddress.IPv4Network(cidr, strict=False) for cidr in current
+                if '/' in cidr and not cidr.endswith('/32')]
+
+    def covered(address):
+        if networks and ('/' not in address or address.endswith('/32')):
+            address = ipaddress.IPv4Address(address.split('/')[0])
+            return any(address in network for network in networks)
+        return False
+
+    added = [ip for ip in ips if ip not in present and not covered(ip)]
+    stale = [cidr for cidr in current if (complete and cidr not in found) or covered(cidr)]
+    removed = []
+    if stale:
+        sources = provenance()
+        removed = [cidr for cidr in stale if sources.get(cidr, {}).get("source") in REFRESH_SOURCES]
+    return added, removed
+
+
+def refresh_blocked_domain(url):
+    """Re-resolve one blocked domain; returns its pending change, or None if nothing changed.
+
+    Does not write anything: changes and refresh times are applied in
+    batches by apply_domain_refreshes(), so an unchanged domain costs one
+    lookup and one cached read.
+    """
+    ips, answers = RESOLVER.resolve_family(url, fresh=True)
+    complete = bool(ips) and all(found is not None for found in answers.values())
+
+    entry = BLOCKLIST_STORE.get(url)
+    if entry is None or entry.get("is_ip_address"):
+        return None
+    added, removed = refresh_changes(entry, ips, complete, lambda: BLOCKLIST_STORE.provenance(url))
+    if not added and not removed:
+        return None
+    return {"url": url, "ips": ips, "complete": complete}
+
+
+def apply_domain_refreshes(pending, refreshed=None):
+    """Apply collected refresh results with one firewall, index and store update.
+
+    pending maps url -> refresh_blocked_domain() result, refreshed maps every
+    looked-up url to its lookup time; the new last_refresh times are stored
+    in the same transaction as the address changes. The changes are
+    recomputed against the current entries, so edits made since the lookup
+    are kept. Returns one {url, added, removed, success} per changed entry.
+    """
+    refreshed = refreshed or {}
+    if not pending:
+        if refreshed:
+            BLOCKLIST_STORE.put_many([], refreshed)
+        return []
+    with BLOCKLIST_LOCK:
+        blocked_data = BLOCKLIST_STORE.load()
+        old_ranges = blocklist_ranges(blocked_data)
+        now = time.strftime('%Y-%m-%dT%H:%M:%S')
+        items = []
+        results = []
+        for url, change in pending.items():
+            entry = blocked_data.get(url)
+            if entry is None or entry.get("is_ip_address"):
+                continue
+            added, removed = refresh_changes(entry, change["ips"], change["complete"],
+                                             lambda: BLOCKLIST_STORE.provenance(url))
+            if not added and not removed:
+                continue
+            current = entry.get("ip_ranges", entry.get("ips", []))
+            ranges = [cidr for cidr in current if cidr not in removed] + added
+            blocked_data[url] = dict(entry, ip_ranges=ranges, ips=ranges, rules_count=len(ranges),
+                                     last_refresh=refreshed.get(url, now), last_change=now,
+                                     refresh_added=len(added), refresh_removed=len(removed))
+            items.append((url, blocked_data[url], 'refresh'))
+            results.append({"url": url, "added": added, "removed": removed, "success": True})
+        if not items:
+            BLOCKLIST_STORE.put_many([], refreshed)
+            return []
+
+        tx_result = update_block_rules(old_ranges, blocked_data)
+        if not tx_result["success"]:
+            return [dict(result, success=False, error=tx_result["error"]) for result in results]
+        BLOCKLIST_STORE.put_many(items, refreshed)
+        # Only addresses changed, the domain trie stays as it is
+        BLOCK_INDEX.rebuild_ranges(blocked_data)
+    return results
+
+
+def last_refresh_time(entry):
+    """Epoch time of an entry's stored last_refresh, 0 if it was never refreshed"""
+    try:
+        return time.mktime(time.strptime(entry.get("last_refresh", ""), '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return 0
+
+
+def refresh_loop():
+    """Re-resolve every blocked domain once per REFRESH_INTERVAL, spread out with jitter.
+
+    Entries are taken oldest refresh first, and one refreshed less than
+    REFRESH_INTERVAL ago (before a restart) waits until it is due.
+    """
+    def apply(pending, refreshed):
+        try:
+            for result in apply_domain_refreshes(pending, refreshed):
+                print(f"Refreshed {result['url']}: +{len(result['added'])} -{len(result['removed'])} "
+                      f"{result.get('error', '')}")
+        except Exception as e:
+            print(f"Blocklist refresh error: {e}")
+
+    while True:
+        try:
+            urls = [(last_refresh_time(entry), url) for url, entry in BLOCKLIST_STORE.load().items()
+                    if not entry.get("is_ip_address")]
+        except Exception as e:
+            print(f"Blocklist refresh error: {e}")
+            urls = []
+        # Spread lookups evenly over the interval; jitter avoids bursts lining up
+        spacing = REFRESH_INTERVAL / max(len(urls), 1)
+        random.shuffle(urls)
+        urls.sort(key=lambda item: item[0])
+        pending = {}
+        refreshed = {}
+        applied_at = time.time()
+        for last, url in urls:
+            delay = max(spacing * random.uniform(0.5, 1.5), last + REFRESH_INTERVAL - time.time())
+            if refreshed and time.time() + delay - applied_at >= REFRESH_APPLY_INTERVAL:
+                apply(pending, refreshed)
+                pending, refreshed, applied_at = {}, {}, time.time()
+            time.sleep(delay)
+            try:
+                change = refresh_blocked_domain(url)
+                refreshed[url] = time.strftime('%Y-%m-%dT%H:%M:%S')
+                if change:
+                    pending[url] = change
+            except Exception as e:
+                print(f"Blocklist refresh error for {url}: {e}")
+        apply(pending, refreshed)
+        if not urls:
+            time.sleep(REFRESH_INTERVAL)
+
+
+def base_domain(name):
+    """Registrable part of a host name (scontent.xx.fbcdn.net -> fbcdn.net, bbc.co.uk stays)"""
+    labels = name.lower().rstrip('.').split('.')
+    if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in ('co', 'com', 'net', 'org', 'gov', 'ac', 'edu'):
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+
+class LearningSession:
+    """Capture the destinations one hotspot client talks to and turn them into block candidates.
+
+    Runs tcpdump filtered to the client for a fixed window. Each destination
+    IP is attributed to host names seen for it in DNS answers sent to the
+    client or in TLS SNI, and counted. candidates() groups the IPs by base
+    domain into /24s (two or more addresses in it) or /32s, with hit counts,
+    so e.g. Facebook traffic can be told apart from background traffic.
+    """
+
+    MAX_DESTINATIONS = 4096
+    PACKET_HEADER = re.compile(r'^\d\d:\d\d:\d\d\.\d+ IP (\d+\.\d+\.\d+\.\d+)\.(\d+) > (\d+\.\d+\.\d+\.\d+)\.(\d+): (.*)$')
+    DNS_QUERY = re.compile(r'^(\d+)\+?\S* (?:\[\S+\] )?A\? (\S+?)\.? \(')
+    DNS_ANSWER = re.compile(r'^(\d+)\S* \d+/\d+/\d+ ')
+    DNS_A = re.compile(r'\bA (\d+\.\d+\.\d+\.\d+)')
+
+    def __init__(self, client_ip, duration):
+        self.client_ip = client_ip
+        self.duration = duration
+        self.state = 'starting'
+        self.error = ''
+        self.started_at = time.time()
+        self.finished_at = None
+        self.packets = 0
+        self.hits = {}          # destination ip -> packet count
+        self.names = {}         # destination ip -> set of host names (DNS answers, SNI)
+        self.queries = {}       # DNS id -> queried name
+        self.lock = threading.Lock()
+        self.process = None
+
+    def start(self):
+        """Start capturing in a background thread"""
+        threading.Thread(target=self._capture, daemon=True).start()
+
+    def stop(self):
+        """End the capture early; results are frozen even if tcpdump takes a moment to exit"""
+        if self.state in ('starting', 'capturing'):
+            self.state, self.finished_at = 'done', time.time()
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+
+    def _capture(self):
+        iface, _ = detect_hotspot_interface()
+        if not iface:
+            self.state, self.error, self.finished_at = 'failed', 'No hotspot interface found', time.time()
+            return
+        # timeout bounds the window even if terminating su does not reach tcpdump
+        cmd = root_command(['timeout', str(self.duration), 'tcpdump', '-i', iface, '-n', '-l', '-A', '-s', '512',
+                            'host', self.client_ip])
+        try:
+            self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                            text=True, errors='ignore', bufsize=1)
+        except Exception as e:
+            self.state, self.error, self.finished_at = 'failed', str(e), time.time()
+            return
+        timer = threading.Timer(self.duration, self.stop)
+        timer.start()
+        if self.state == 'starting':
+            self.state = 'capturing'
+        packet = []
+        for line in self.process.stdout:
+            if self.state != 'capturing':
+                break
+            if self.PACKET_HEADER.match(line):
+                self._packet(packet)
+                packet = [line]
+            elif packet and len(packet) < 16:
+                packet.append(line)
+        self._packet(packet)
+        timer.cancel()
+        self.stop()
+        self.process.wait()
+
+    def _packet(self, lines):
+        """Account one captured packet (header line + ASCII payload lines)"""
+        if not lines:
+            return
+        match = self.PACKET_HEADER.match(lines[0])
+        if not match:
+            return
+        src_ip, src_port, dst_ip, dst_port, info = match.groups()
+        with self.lock:
+            self.packets += 1
+            if src_ip == self.client_ip and dst_port == '53':
+                query = self.DNS_QUERY.match(info)
+                if query and len(self.queries) < self.MAX_DESTINATIONS:
+                    self.queries[query.group(1)] = query.group(2).lower()
+            elif dst_ip == self.client_ip and src_port == '53':
+                answer = self.DNS_ANSWER.match(info)
+                name = self.queries.get(answer.group(1)) if answer else None
+                if name:
+                    for ip in self.DNS_A.findall(info):
+                        if ip in self.names or len(self.names) < self.MAX_DESTINATIONS:
+                            self.names.setdefault(ip, set()).add(name)
+            elif src_ip == self.client_ip and ipaddress.IPv4Address(dst_ip).is_global:
+                if dst_ip in self.hits or len(self.hits) < self.MAX_DESTINATIONS:
+                    self.hits[dst_ip] = self.hits.get(dst_ip, 0) + 1
+                if dst_port == '443' and len(lines) > 1:
+                    sni = extract_sni_from_tls(''.join(lines[1:]))
+                    if sni and (dst_ip in self.names or len(self.names) < self.MAX_DESTINATIONS):
+                        self.names.setdefault(dst_ip, set()).add(sni.lower())
+
+    def candidates(self):
+        """{domain: [{cidr, hits, ips, names}]} sorted by hits; unattributed IPs under '(unknown)'"""
+        with self.lock:
+            hits = dict(self.hits)
+            names = {ip: set(found) for ip, found in self.names.items()}
+        grouped = {}
+        for ip, count in hits.items():
+            domains = set(base_domain(name) for name in names.get(ip, ())) or {'(unknown)'}
+            for domain in domains:
+                grouped.setdefault(domain, {}).setdefault(ip, count)
+        result = {}
+        for domain, ips in grouped.items():
+            subnets = {}
+            for ip in ips:
+                subnets.setdefault(ip.rsplit('.', 1)[0], []).append(ip)
+            candidates = []
+            for prefix, members in subnets.items():
+                cidr = f"{prefix}.0/24" if len(members) > 1 else f"{members[0]}/32"
+                candidates.append({
+                    "cidr": cidr,
+                    "hits": sum(ips[ip] for ip in members),
+                    "ips": sorted(members, key=lambda ip: ipaddress.IPv4Address(ip)),
+                    "names": sorted(set(name for ip in members for name in names.get(ip, ())))
+                })
+            result[domain] = sorted(candidates, key=lambda c: -c["hits"])
+        return dict(sorted(result.items(), key=lambda item: -sum(c["hits"] for c in item[1])))
+
+    def status(self):
+        """Progress and current candidates"""
+        remaining = 0
+        if self.state in ('starting', 'capturing'):
+            remaining = max(0, round(self.started_at + self.duration - time.time()))
+        return {
+            "state": self.state,
+            "error": self.error,
+            "client_ip": self.client_ip,
+            "duration": self.duration,
+            "remaining": remaining,
+            "packets": self.packets,
+            "destinations": len(self.hits),
+            "candidates": self.candidates()
         }
 
-        req = urllib.request.Request(url, headers=headers)
-        with urllib.request.urlopen(req, timeout=5) as response:
-            device_name = response.read().decode('utf-8').strip()
 
-            # Validate the response
-            if device_name and len(device_name) > 0:
-                # Check if it's an error message
-                if device_name.startswith('<!') or device_name.startswith('{') or 'error' in device_name.lower():
-                    return None
+def commit_learned_ranges(url, cidrs):
+    """Add learned CIDRs to a blocklist entry (created if needed) in one firewall transaction"""
+    url = url.strip().lower()
+    invalid = [cidr for cidr in cidrs if normalize_ip_range(cidr) is None]
+    if not url or not cidrs or invalid:
+        return {"success": False, "message": f"Invalid request{': ' + ', '.join(invalid) if invalid else ''}"}
+    import datetime
+    with BLOCKLIST_LOCK:
+        blocked_data = BLOCKLIST_STORE.load()
+        entry = blocked_data.get(url) or {"ip_ranges": [], "is_ip_address": False,
+                                          "blocked_at": datetime.datetime.now().isoformat()}
+        current = list(entry.get("ip_ranges", entry.get("ips", [])))
+        BLOCK_INDEX.refresh()
+        added = [normalize_ip_range(cidr) for cidr in dict.fromkeys(cidrs)]
+        added = [cidr for cidr in added if cidr not in current and not BLOCK_INDEX.trie.covers(cidr)]
+        if not added:
+            return {"success": True, "message": "All selected ranges are already blocked", "added": []}
+        old_ranges = blocklist_ranges(blocked_data)
+        ranges = current + added
+        entry = dict(entry, ip_ranges=ranges, ips=ranges, rules_count=len(ranges),
+                     updated_at=datetime.datetime.now().isoformat())
+        blocked_data[url] = entry
+        tx_result = update_block_rules(old_ranges, blocked_data)
+        if not tx_result["success"]:
+            return {"success": False, "message": f"Failed to block ranges: {tx_result['error']}"}
+        BLOCKLIST_STORE.put(url, entry, source='learned')
+        BLOCK_INDEX.block(url, blocked_data)
+    return {"success": True, "message": f"✓ Added {len(added)} learned range(s) to {url}", "added": added,
+            "rules_applied": tx_result["rules_applied"], "elapsed_ms": tx_result["elapsed_ms"]}
+
+
+LEARN_SESSION = None
+
+
+class OuiDatabase:
+    """Offline IEEE registry (MA-L/MA-M/MA-S) from the oui.bin file written by build_oui_db.py.
+
+    The file is memory-mapped on first use and never parsed as a whole: its
+    records are a sorted array of (prefix << 8 | length) keys that bisect
+    reads in place, so startup cost and resident memory stay near zero. The
+    rightmost record starting at or below the MAC is the longest match when
+    it covers the MAC; otherwise only the 24-bit parent can.
+    """
+
+    HEADER = struct.Struct('>4sII')
+    RECORD = struct.Struct('>QI')
+
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        self.count = 0
+        self.strings = 0
+        self.opened = False
+        self.lock = threading.Lock()
+
+    def _open(self):
+        with self.lock:
+            if self.opened:
+                return
+            self.opened = True
+            try:
+                with open(self.path, 'rb') as f:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                magic, count, strings = self.HEADER.unpack_from(data, 0)
+                if magic != b'OUI1' or strings != self.HEADER.size + self.RECORD.size * count:
+                    print(f"Ignoring {self.path}: not an oui.bin file")
+                    return
+                self.data, self.count, self.strings = data, count, strings
+            except (OSError, ValueError, struct.error):
+                pass
 
-                # Clean up the vendor name
-                device_name = device_name.replace(' Inc.', '').replace(' Co.', '').replace(' Ltd.', '')
-                device_name = device_name.replace(' Corporation', '').replace(' Corp.', '')
-                device_name = device_name.replace(' Limited', '').replace(', Ltd', '')
-                device_name = device_name.strip()
-
-                # Cache the result permanently
-                MAC_LOOKUP_CACHE[mac] = {
-                    'name': device_name,
-                    'timestamp': time.time(),
-                    'source': 'api'
-                }
-                save_mac_cache()
-                return device_name
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.RECORD.unpack_from(self.data, self.HEADER.size + i * self.RECORD.size)[0]
+
+    def _name(self, i):
+        offset = self.strings + self.RECORD.unpack_from(self.data, self.HEADER.size + i * self.RECORD.size)[1]
+        return self.data[offset + 1:offset + 1 + self.data[offset]].decode('utf-8', 'replace')
+
+    def lookup(self, mac):
+        """Vendor name for a MAC (longest registered prefix), or None"""
+        if not self.opened:
+            self._open()
+        if not self.count:
+            return None
+        try:
+            value = int(mac.replace(':', '').replace('-', ''), 16)
+        except ValueError:
+            return None
+        i = bisect.bisect_right(self, value << 8 | 0xff) - 1
+        if i >= 0:
+            key = self[i]
+            bits = key & 0xff
+            if (key >> 8) >> (48 - bits) == value >> (48 - bits):
+                return self._name(i)
+        parent = (value >> 24 << 24) << 8 | 24
+        i = bisect.bisect_left(self, parent)
+        if i < self.count and self[i] == parent:
+            return self._name(i)
+        return None
+
+
+OUI_DATABASE = OuiDatabase(OUI_DB)
+
+
+def vendor_from_mac(mac):
+    """Get device vendor from MAC address (offline IEEE registry, then the built-in table)"""
+    mac = mac.lower().replace('-', ':')
+    oui = ':'.join(mac.split(':')[:3])
+    return OUI_DATABASE.lookup(mac) or MAC_VENDORS.get(oui, 'Unknown')
+
+
+class HostnameService:
+    """Device hostnames from the DHCP leases file and reverse DNS.
+
+    The leases file is parsed only when its mtime or size changes and is
+    indexed by MAC. Reverse lookups run concurrently on a small pool with a
+    short deadline and are cached (failures for less time than answers);
+    lookups still running at the deadline keep going and fill the cache for
+    the next snapshot, and each IP has at most one lookup in flight.
+    """
+
+    POSITIVE_TTL = 600
+    NEGATIVE_TTL = 120
+    DEADLINE = 1.0
+    MAX_ENTRIES = 1024
+
+    def __init__(self, leases_path, max_workers=8):
+        self.leases_path = leases_path
+        self.leases_stamp = None
+        self.lease_names = {}
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.cache = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def leases(self):
+        """{mac: hostname} from the dnsmasq leases file, re-read only when it changes"""
+        try:
+            st = os.stat(self.leases_path)
+        except OSError:
+            return {}
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp != self.leases_stamp:
+            names = {}
+            try:
+                with open(self.leases_path, 'r') as f:
+                    for line in f:
+                        # expiry mac ip hostname client-id ('*' = no hostname)
+                        parts = line.split()
+                        if len(parts) > 3 and parts[3] != '*':
+                            names[parts[1].lower()] = parts[3]
+            except OSError:
+                return self.lease_names
+            self.lease_names, self.leases_stamp = names, stamp
+        return self.lease_names
+
+    def _reverse(self, ip):
+        """Blocking reverse lookup of one IP; caches and returns the name or None"""
+        try:
+            hostname = socket.gethostbyaddr(ip)[0]
+            hostname = hostname if hostname != ip else None
+        except (OSError, UnicodeError):
+            hostname = None
+        ttl = self.POSITIVE_TTL if hostname else self.NEGATIVE_TTL
+        with self.lock:
+            if len(self.cache) >= self.MAX_ENTRIES:
+                now = time.time()
+                self.cache = {ip: entry for ip, entry in self.cache.items() if entry[1] > now}
+                if len(self.cache) >= self.MAX_ENTRIES:
+                    self.cache.clear()
+            self.cache[ip] = (hostname, time.time() + ttl)
+            self.pending.pop(ip, None)
+        return hostname
+
+    def reverse_many(self, ips, deadline=DEADLINE):
+        """Reverse-resolve IPs concurrently: {ip: hostname or None}"""
+        results = {}
+        futures = {}
+        now = time.time()
+        for ip in dict.fromkeys(ips):
+            with self.lock:
+                entry = self.cache.get(ip)
+                if entry and entry[1] > now:
+                    results[ip] = entry[0]
+                    continue
+                future = self.pending.get(ip)
+                if future is None:
+                    future = self.pending[ip] = self.pool.submit(self._reverse, ip)
+            futures[future] = ip
+        if futures:
+            done, _ = wait(futures, timeout=deadline)
+            for future, ip in futures.items():
+                results[ip] = future.result() if future in done else None
+        return results
+
+    def hostnames(self, neighbours):
+        """{ip: hostname or None} for (ip, mac) pairs: reverse DNS first, then the DHCP lease"""
+        leases = self.leases()
+        names = self.reverse_many([ip for ip, _ in neighbours])
+        return {ip: names.get(ip) or leases.get(mac.lower()) for ip, mac in neighbours}
+
+
+HOSTNAMES = HostnameService(DHCP_LEASES_FILE)
+
+
+def conntrack_lines():
+    """Stream the conntrack table line by line (directly if readable, else through su cat)"""
+    for path in CONNTRACK_FILES:
+        if not os.path.exists(path):
+            continue
+        try:
+            with open(path, 'r') as f:
+                yield from f
+            return
+        except PermissionError:
+            pass
+        proc = subprocess.Popen(root_command(['cat', path]), stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, text=True)
+        try:
+            yield from proc.stdout
+        finally:
+            proc.kill()
+            proc.wait()
+        return
+
+
+def parse_conntrack_line(line):
+    """(protocol, src, dst, dport, bytes_out, bytes_in) of one conntrack entry.
+
+    Both nf_conntrack ("ipv4 2 tcp 6 ...") and ip_conntrack ("tcp 6 ...")
+    layouts are accepted. Addresses and ports are from the original
+    direction; byte counts are 0 unless nf_conntrack_acct is enabled.
+    """
+    head = line.split(None, 3)
+    if len(head) < 4:
+        return None
+    protocol = head[2] if head[0] in ('ipv4', 'ipv6') else head[0]
+
+    def field(key, start=0):
+        # Value of the first "key=value" token at or after start, and where it ends
+        i = line.find(key, start)
+        if i < 0:
+            return None, start
+        i += len(key)
+        j = line.find(' ', i)
+        j = len(line) if j < 0 else j
+        return line[i:j].rstrip(), j
+
+    src, end = field(' src=')
+    dst, end = field(' dst=', end)
+    if src is None or dst is None:
+        return None
+    dport, _ = field(' dport=', end)
+    bytes_out, end = field(' bytes=', end)
+    bytes_in, _ = field(' bytes=', end)
+    return protocol, src, dst, dport, int(bytes_out or 0), int(bytes_in or 0)
+
+
+def conntrack_stats(ips, top=5, max_destinations=256):
+    """Per-client flow aggregates from one streaming pass over the conntrack table.
+
+    Returns {ip: {"flows", "protocols", "bytes_out", "bytes_in", "top_destinations"}}
+    for the given client IPs (exact match on the original source address),
+    or None if the table could not be read. Only the aggregates are kept:
+    each client tracks at most max_destinations destinations, pruned to the
+    busiest half when full, so memory stays bounded however large the table is.
+    """
+    stats = {ip: {"flows": 0, "protocols": {}, "bytes_out": 0, "bytes_in": 0, "destinations": {}}
+             for ip in ips}
+    lines = 0
+    try:
+        for line in conntrack_lines():
+            lines += 1
+            # Cheap exact source check before splitting the whole line
+            i = line.find(' src=')
+            if i < 0:
+                continue
+            j = line.find(' ', i + 5)
+            client = stats.get(line[i + 5:j])
+            if client is None:
+                continue
+            entry = parse_conntrack_line(line)
+            if entry is None:
+                continue
+            protocol, _, dst, _, bytes_out, bytes_in = entry
+            client["flows"] += 1
+            client["protocols"][protocol] = client["protocols"].get(protocol, 0) + 1
+            client["bytes_out"] += bytes_out
+            client["bytes_in"] += bytes_in
+            destinations = client["destinations"]
+            counts = destinations.get(dst)
+            if counts is None:
+                if len(destinations) >= max_destinations:
+                    busiest = sorted(destinations.items(), key=lambda item: item[1][0], reverse=True)
+                    destinations = client["destinations"] = dict(busiest[:max_destinations // 2])
+                counts = destinations[dst] = [0, 0]
+            counts[0] += 1
+            counts[1] += bytes_out + bytes_in
     except Exception as e:
-        # Cache the failure to avoid repeated API calls
-        MAC_LOOKUP_CACHE[mac] = {
-            'name': None,
-            'timestamp': time.time(),
-            'source': 'failed'
-        }
-        save_mac_cache()
+        print(f"Error reading conntrack: {e}")
+        return None
+    if not lines:
+        return None
+
+    for client in stats.values():
+        busiest = sorted(client.pop("destinations").items(), key=lambda item: item[1][0], reverse=True)
+        client["top_destinations"] = [{"ip": dst, "flows": flows, "bytes": total}
+                                      for dst, (flows, total) in busiest[:top]]
+    return stats
+
+
+def connection_counts(ips):
+    """{ip: sockets with that exact peer address}, from a single netstat run (no conntrack access)"""
+    counts = dict.fromkeys(ips, 0)
+    try:
+        result = subprocess.run(['netstat', '-an'], capture_output=True, text=True, timeout=10)
+        for line in result.stdout.split('\n'):
+            parts = line.split()
+            if len(parts) < 5:
+                continue
+            for address in (parts[3], parts[4]):
+                ip = address.rsplit(':', 1)[0].replace('::ffff:', '')
+                if ip in counts:
+                    counts[ip] += 1
+                    break
+    except:
+        pass
+    return counts
+
+
+# Neighbour states that count as a connected device
+NEIGH_ACTIVE_STATES = ('REACHABLE', 'STALE', 'DELAY', 'PROBE')
+
+
+def parse_neigh_line(line):
+    """Parse one `ip neigh show` / `ip -o monitor neigh` line.
+
+    Returns (deleted, ip, dev, mac, state) for IPv4 entries, None otherwise.
+    mac is None for entries without a link-layer address (INCOMPLETE, FAILED),
+    dev is None when the line does not name one.
+    """
+    parts = line.split()
+    deleted = False
+    if parts and parts[0] in ('Deleted', 'delete'):
+        deleted = True
+        parts = parts[1:]
+    elif parts and parts[0] == 'miss':
+        parts = parts[1:]
+    # IPv4 only; 'lladdr' position varies and `ip neigh show dev X` omits "dev"
+    if len(parts) < 2 or parts[0].count('.') != 3:
+        return None
+    dev = None
+    if 'dev' in parts and parts.index('dev') + 1 < len(parts):
+        dev = parts[parts.index('dev') + 1]
+    mac = None
+    if 'lladdr' in parts:
+        lladdr_index = parts.index('lladdr')
+        if lladdr_index + 1 < len(parts):
+            mac = parts[lladdr_index + 1]
+    state = parts[-1] if parts[-1].isupper() else ''
+    return deleted, parts[0], dev, mac, state
+
+
+class NeighborWatcher:
+    """In-memory neighbour table kept current from a persistent `ip -o monitor neigh` stream.
+
+    The table is seeded with `ip neigh show` each time the monitor starts, so
+    events missed while it was down are reconciled as well. Transitions into an
+    active state emit a "connect" event, deletions and FAILED/INCOMPLETE emit a
+    "disconnect"; listeners are called with each event. feed() and replay()
+    apply lines without a subprocess, so a recorded stream can be replayed.
+    """
+
+    def __init__(self):
+        self.table = {}
+        self.events = deque(maxlen=500)
+        self.listeners = []
+        self.running = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the monitor thread"""
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def _loop(self):
+        backoff = 1
+        while True:
+            try:
+                # Start the monitor before the dump so no change falls between the two
+                proc = subprocess.Popen(['ip', '-o', 'monitor', 'neigh'], stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL, text=True)
+            except OSError as e:
+                print(f"Neighbour monitor unavailable: {e}")
+                time.sleep(60)
+                continue
+            started = time.time()
+            try:
+                self.resync()
+                self.running = True
+                for line in proc.stdout:
+                    self.feed(line)
+            except Exception as e:
+                print(f"Neighbour monitor error: {e}")
+            finally:
+                self.running = False
+                proc.kill()
+                proc.wait()
+            # Restart quickly after a long run, back off if the monitor keeps dying
+            backoff = 1 if time.time() - started > 60 else min(backoff * 2, 60)
+            time.sleep(backoff)
+
+    def resync(self):
+        """Replace the table with a fresh `ip neigh show` dump, emitting the differences"""
+        output = subprocess.run(['ip', 'neigh', 'show'], capture_output=True, text=True, timeout=5).stdout
+        seen = set()
+        for line in output.split('\n'):
+            entry = parse_neigh_line(line)
+            if entry:
+                self.apply(*entry)
+                seen.add(entry[1])
+        for ip in [ip for ip in self.table if ip not in seen]:
+            self.apply(True, ip, self.table[ip]["dev"], None, '')
+
+    def feed(self, line):
+        """Apply one monitor line; returns the event it produced, if any"""
+        entry = parse_neigh_line(line)
+        return self.apply(*entry) if entry else None
+
+    def replay(self, lines):
+        """Apply a recorded stream (iterable of lines or a file path); returns the events"""
+        if isinstance(lines, str):
+            with open(lines) as f:
+                return self.replay(f.readlines())
+        events = []
+        for line in lines:
+            event = self.feed(line)
+            if event:
+                events.append(event)
+        return events
+
+    def apply(self, deleted, ip, dev, mac, state):
+        """Update one entry and emit connect/disconnect on transitions"""
+        event = None
+        with self.lock:
+            previous = self.table.get(ip)
+            was_active = previous is not None and previous["state"] in NEIGH_ACTIVE_STATES
+            if deleted or state in ('FAILED', 'INCOMPLETE'):
+                self.table.pop(ip, None)
+                if was_active:
+                    event = {"event": "disconnect", "ip": ip, "mac": previous["mac"], "dev": previous["dev"]}
+            else:
+                mac = mac or (previous or {}).get("mac")
+                if not mac:
+                    return None
+                self.table[ip] = {"mac": mac, "dev": dev, "state": state,
+                                  "since": previous["since"] if was_active and previous["mac"] == mac else time.time()}
+                if state in NEIGH_ACTIVE_STATES and (not was_active or previous["mac"] != mac):
+                    event = {"event": "connect", "ip": ip, "mac": mac, "dev": dev}
+            if event:
+                event["time"] = time.time()
+                self.events.append(event)
+        if event:
+            for listener in self.listeners:
+                try:
+                    listener(event)
+                except Exception as e:
+                    print(f"Neighbour listener error: {e}")
+        return event
+
+    def neighbours(self, dev=None):
+        """Active (ip, mac, state) entries, optionally for one interface"""
+        with self.lock:
+            return [(ip, entry["mac"], entry["state"]) for ip, entry in self.table.items()
+                    if entry["state"] in NEIGH_ACTIVE_STATES and (dev is None or entry["dev"] == dev)]
+
+    def recent_events(self, since=0):
+        """Events newer than the given timestamp, oldest first"""
+        with self.lock:
+            return [event for event in self.events if event["time"] > since]
+
+
+NEIGHBOR_WATCHER = NeighborWatcher()
+
+
+def poll_neighbours(dev):
+    """Active (ip, mac, state) entries from a one-off `ip neigh show dev <dev>`"""
+    try:
+        output = subprocess.run(['ip', 'neigh', 'show', 'dev', dev],
+                                capture_output=True, text=True, timeout=5).stdout
+    except:
+        return []
+    neighbours = []
+    for line in output.split('\n'):
+        entry = parse_neigh_line(line)
+        if entry and entry[3] and entry[4] in NEIGH_ACTIVE_STATES:
+            neighbours.append((entry[1], entry[3], entry[4]))
+    return neighbours
+
+
+def collect_devices():
+    """Build one device snapshot: neighbours on the hotspot interface with vendor/hostname/connections.
+
+    The interface, hostnames and the conntrack table are read once per
+    snapshot rather than once per device.
+    """
+    devices = []
+    hotspot_iface, _ = detect_hotspot_interface()
+    if not hotspot_iface:
+        return {"devices": [], "interface": "none"}
+
+    # Neighbour table from the watcher; poll only while the monitor is not running
+    if NEIGHBOR_WATCHER.running:
+        neighbours = NEIGHBOR_WATCHER.neighbours(hotspot_iface)
+    else:
+        neighbours = poll_neighbours(hotspot_iface)
+
+    hostnames = HOSTNAMES.hostnames([(ip, mac) for ip, mac, _ in neighbours])
+    ips = [ip for ip, _, _ in neighbours]
+    traffic = conntrack_stats(ips)
+    if traffic is None:
+        connections = connection_counts(ips)
+    else:
+        connections = {ip: stats["flows"] for ip, stats in traffic.items()}
+    for ip, mac, state in neighbours:
+        registered = OUI_DATABASE.lookup(mac)
+        devices.append({
+            "ip": ip,
+            "mac": mac,
+            "vendor": vendor_from_mac(mac),
+            # Registry name, else the web lookup queue (filled in on a later snapshot)
+            "web_name": registered or MAC_VENDOR_LOOKUP.name(mac),
+            "system_hostname": hostnames.get(ip),
+            "state": state,
+            "connections": str(connections.get(ip, 0)),
+            "traffic": traffic.get(ip) if traffic else None
+        })
+
+    return {"devices": devices, "interface": hotspot_iface}
+
+
+class DeviceInventory:
+    """Device list collected in the background on a fixed cadence.
+
+    /api/devices returns the latest snapshot immediately together with its
+    age, so request latency and CPU cost no longer depend on the number of
+    clients or open dashboards. Custom names and notes are applied when the
+    snapshot is read, so edits show up without waiting for a new collection.
+    """
+
+    def __init__(self, interval=5):
+        self.interval = interval
+        self.data = None
+        self.updated_at = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def start(self):
+        """Start the collector thread"""
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def _loop(self):
+        while True:
+            self.collect()
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def refresh_soon(self, event=None):
+        """Collect now instead of at the next tick (neighbour listener)"""
+        self.wakeup.set()
+
+    def collect(self):
+        """Take one snapshot now"""
+        try:
+            data = collect_devices()
+        except Exception as e:
+            print(f"Device collection error: {e}")
+            return
+        with self.lock:
+            self.data = data
+            self.updated_at = time.time()
+
+    def snapshot(self):
+        """Latest snapshot in the /api/devices format, plus its age in seconds"""
+        with self.lock:
+            data, updated_at = self.data, self.updated_at
+        if data is None:
+            return {"devices": [], "interface": "none", "age": None, "updated_at": None}
+
+        devices = []
+        for device in data["devices"]:
+            # Build device name (priority: custom > web lookup > hostname > vendor)
+            custom_info = DEVICE_INFO.get(device["mac"], {})
+            custom_name = custom_info.get('name')
+            device_name = (custom_name or device["web_name"] or device["system_hostname"]
+                           or f"{device['vendor']} Device")
+            devices.append({
+                "ip": device["ip"],
+                "mac": device["mac"],
+                "hostname": device_name,
+                "vendor": device["vendor"],
+                "state": device["state"],
+                "connections": device["connections"],
+                "traffic": device["traffic"],
+                "custom_name": custom_name or "",
+                "notes": custom_info.get('notes', '')
+            })
+        return {"devices": devices, "interface": data["interface"],
+                "age": round(time.time() - updated_at, 1), "updated_at": updated_at}
+
+
+DEVICE_INVENTORY = DeviceInventory()
+
+
+class DeviceSeries:
+    """Fixed-size ring buffer of one device's counter deltas, plus its current rates.
+
+    Timestamps and byte deltas live in preallocated arrays (not lists of
+    dicts), so a device costs the same memory after an hour as after a minute.
+    """
+
+    def __init__(self, capacity):
+        self.times = array.array('d', bytes(8 * capacity))
+        self.bytes_in = array.array('Q', bytes(8 * capacity))
+        self.bytes_out = array.array('Q', bytes(8 * capacity))
+        self.capacity = capacity
+        self.pos = 0
+        self.count = 0
+        self.last = None            # (time, counter in, counter out) of the previous sample
+        self.ip = ''
+        self.hostname = ''
+        self.seen_at = 0
+        self.rate_in = self.rate_out = 0.0
+        self.ewma_in = self.ewma_out = 0.0
+        self.total_in = self.total_out = 0
+
+    def add(self, now, counter_in, counter_out, tau):
+        """Record one counter reading; returns the (delta in, delta out) since the previous one"""
+        if self.last is None:
+            self.last = (now, counter_in, counter_out)
+            return 0, 0
+        then, last_in, last_out = self.last
+        # A counter below its last value was reset (reboot, reset-usage, chain recreated)
+        delta_in = counter_in - last_in if counter_in >= last_in else counter_in
+        delta_out = counter_out - last_out if counter_out >= last_out else counter_out
+        self.last = (now, counter_in, counter_out)
+        dt = max(now - then, 0.001)
+
+        self.times[self.pos] = now
+        self.bytes_in[self.pos] = delta_in
+        self.bytes_out[self.pos] = delta_out
+        self.pos = (self.pos + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+        self.rate_in, self.rate_out = delta_in / dt, delta_out / dt
+        alpha = 1 - math.exp(-dt / tau)
+        self.ewma_in += alpha * (self.rate_in - self.ewma_in)
+        self.ewma_out += alpha * (self.rate_out - self.ewma_out)
+        self.total_in += delta_in
+        self.total_out += delta_out
+        return delta_in, delta_out
+
+    def history(self):
+        """[[time, bytes in, bytes out], ...] oldest first"""
+        start = (self.pos - self.count) % self.capacity
+        return [[self.times[i], self.bytes_in[i], self.bytes_out[i]]
+                for i in ((start + k) % self.capacity for k in range(self.count))]
+
+
+class UsageSampler:
+    """Reads all accounting counters every INTERVAL seconds in the background.
+
+    Samples list only the device accounting chains; a full
+    collect_usage_counters() snapshot (which also adds missing rules) is taken
+    when the device set changes and every PLAN_INTERVAL seconds. Per-device
+    deltas go into DeviceSeries ring buffers (an hour at the default settings) together
+    with instantaneous and EWMA (time constant EWMA_TAU) rates, so current
+    throughput is known without anyone polling and no interval is lost.
+    The top-talkers ranking is computed once per sample and served from
+    memory. Listeners are called with (timestamp, counters) for each
+    sample, counters being {mac: {"bytes_in", "bytes_out"}} as read; they
+    run under BLOCKLIST_LOCK and must be quick.
+    """
+
+    INTERVAL = 5
+    PLAN_INTERVAL = 60
+    CAPACITY = 720
+    EWMA_TAU = 30
+    FORGET_AFTER = 3600
+
+    def __init__(self):
+        self.series = {}
+        self.sampled_at = None
+        self.planned = None
+        self.planned_at = 0
+        self.ranking = []
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the sampler thread"""
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def _loop(self):
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"Usage sampler error: {e}")
+            time.sleep(self.INTERVAL)
+
+    def sample(self):
+        """Take one counters snapshot and update every device's series"""
+        devices = DEVICE_INVENTORY.snapshot()["devices"]
+        pairs = sorted((d["ip"], d["mac"].upper()) for d in devices)
+        counters = {}
+        # Read and hand on the counters under the lock that accounting replans and chain
+        # rebuilds take, so a chain recreated in between cannot pass for a counter reset
+        with BLOCKLIST_LOCK:
+            if pairs and pairs == self.planned and time.time() - self.planned_at < self.PLAN_INTERVAL:
+                counters = read_accounting_counters([mac for _, mac in pairs])
+            if pairs and len(counters) < len(pairs):
+                counters = collect_usage_counters(pairs)
+                self.planned, self.planned_at = pairs, time.time()
+            now = time.time()
+            for listener in self.listeners:
+                try:
+                    listener(now, counters)
+                except Exception as e:
+                    print(f"Usage listener error: {e}")
+        with self.lock:
+            for device in devices:
+                mac = device["mac"].upper()
+                if mac not in counters:
+                    continue
+                series = self.series.get(mac)
+                if series is None:
+                    series = self.series[mac] = DeviceSeries(self.CAPACITY)
+                series.ip, series.hostname, series.seen_at = device["ip"], device["hostname"], now
+                series.add(now, counters[mac]["bytes_in"], counters[mac]["bytes_out"], self.EWMA_TAU)
+            decay = math.exp(-self.INTERVAL / self.EWMA_TAU)
+            for mac, series in list(self.series.items()):
+                if series.seen_at == now:
+                    continue
+                if now - series.seen_at > self.FORGET_AFTER:
+                    del self.series[mac]
+                else:
+                    # Gone (or no counters this round): no current traffic
+                    series.rate_in = series.rate_out = 0.0
+                    series.ewma_in *= decay
+                    series.ewma_out *= decay
+            self.sampled_at = now
+            self.ranking = sorted((self._entry(mac, series, now) for mac, series in self.series.items()),
+                                  key=lambda entry: entry["ewma_in"] + entry["ewma_out"], reverse=True)
+
+    @staticmethod
+    def _entry(mac, series, now):
+        return {"mac": mac, "ip": series.ip, "hostname": series.hostname,
+                "rate_in": round(series.rate_in), "rate_out": round(series.rate_out),
+                "ewma_in": round(series.ewma_in), "ewma_out": round(series.ewma_out),
+                "bytes_in": series.total_in, "bytes_out": series.total_out,
+                "connected": series.seen_at == now}
+
+    def top_talkers(self, n=5):
+        """Busiest devices by EWMA rate (in + out), from the last sample"""
+        return self.ranking[:n]
+
+    def history(self, mac):
+        """Delta history of one device, or None if it has no series"""
+        with self.lock:
+            series = self.series.get(mac.upper())
+            return series.history() if series else None
+
+
+USAGE_SAMPLER = UsageSampler()
+
+
+class UsageStore:
+    """SQLite (WAL) usage totals built from counter deltas, replacing device_usage.json.
+
+    Tables:
+      usage    - bytes in/out per (mac, resolution, bucket start) for minute,
+                 hour, day and month buckets (day/month in local time)
+      counters - the last counter values seen per device, so a server
+                 restart continues where it left off
+      meta     - the kernel boot id of those counter values, and the devices
+                 imported from device_usage.json still waiting for a baseline
+
+    record() turns raw counter readings into deltas: a reading below the
+    previous one, a new boot id or a device without history counts from
+    zero, so reboots and counter resets lose nothing. The exception are
+    devices imported from device_usage.json, whose live counters are already
+    part of the imported totals: their first reading only sets the baseline. Deltas accumulate in
+    memory and flush() writes them in one transaction every FLUSH_INTERVAL
+    seconds from its own thread; reads add the unflushed part, so requests
+    never write. Old minute/hour/day buckets are pruned per RETENTION.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS usage (
+            mac TEXT NOT NULL,
+            resolution TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            bytes_in INTEGER NOT NULL DEFAULT 0,
+            bytes_out INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (mac, resolution, bucket)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS counters (
+            mac TEXT PRIMARY KEY,
+            bytes_in INTEGER NOT NULL,
+            bytes_out INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+    # Seconds each resolution is kept (None = forever)
+    RETENTION = {'minute': 2 * 86400, 'hour': 62 * 86400, 'day': 400 * 86400, 'month': None}
+    FLUSH_INTERVAL = 60
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.last = {}           # mac -> (counter in, counter out)
+        self.fresh = set()       # macs whose stored counters are from a previous boot
+        self.baseline = set()    # imported macs whose next reading is a baseline, not usage
+        self.pending = {}        # (mac, resolution, bucket) -> [bytes in, bytes out]
+        self.dirty = set()       # macs whose counters changed since the last flush
+        self.pruned_at = 0
+        self.lock = threading.RLock()
+
+    def _connect(self):
+        """Open the database on first use, importing device_usage.json once"""
+        if self.conn is not None:
+            return self.conn
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+        boot_id = self._boot_id()
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'boot_id'").fetchone()
+        for mac, bytes_in, bytes_out in self.conn.execute("SELECT mac, bytes_in, bytes_out FROM counters"):
+            self.last[mac] = (bytes_in, bytes_out)
+        if row and row[0] != boot_id:
+            # Rebooted since these counters were read: the firewall counts from zero again
+            self.fresh = set(self.last)
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'baseline'").fetchone()
+        if row:
+            self.baseline = set(json.loads(row[0]))
+
+        if self.conn.execute("SELECT COUNT(*) FROM usage").fetchone()[0] == 0 and os.path.exists(USAGE_JSON):
+            try:
+                print(f"Imported {self._import_json(USAGE_JSON)} monthly totals from {USAGE_JSON}")
+            except Exception as e:
+                print(f"Could not import {USAGE_JSON}: {e}")
+        return self.conn
+
+    @staticmethod
+    def _boot_id():
+        try:
+            with open('/proc/sys/kernel/random/boot_id') as f:
+                return f.read().strip()
+        except OSError:
+            return ''
+
+    def _import_json(self, path):
+        """Load the old {mac: {"December 2025": bytes}} totals as month buckets (as download bytes)"""
+        with open(path, 'r') as f:
+            saved = json.load(f)
+        rows = {}
+        for mac, months in saved.items():
+            for month, total in months.items():
+                try:
+                    start = time.mktime(time.strptime(month, '%B %Y'))
+                except ValueError:
+                    continue
+                key = (mac.upper(), 'month', int(start))
+                rows[key] = max(rows.get(key, 0), int(total))
+        # The old totals were the live counters themselves, so those must not be counted again
+        self.baseline = set(mac for mac, _, _ in rows) - set(self.last)
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany("INSERT OR REPLACE INTO usage VALUES (?, ?, ?, ?, 0)",
+                                  [key + (total,) for key, total in rows.items()])
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('baseline', ?)",
+                              (json.dumps(sorted(self.baseline)),))
+        return len(rows)
+
+    @staticmethod
+    def buckets(now):
+        """Start of the minute, hour, day and month containing now, all in local time"""
+        t = time.localtime(now)
+        # tm_isdst keeps the repeated hour at the end of daylight saving time apart
+        return {'minute': int(time.mktime((t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, 0, 0, 0, t.tm_isdst))),
+                'hour': int(time.mktime((t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, 0, 0, 0, 0, t.tm_isdst))),
+                'day': int(time.mktime((t.tm_year, t.tm_mon, t.tm_mday, 0, 0, 0, 0, 0, -1))),
+                'month': int(time.mktime((t.tm_year, t.tm_mon, 1, 0, 0, 0, 0, 0, -1)))}
+
+    def record(self, now, counters):
+        """Add the usage since the previous reading of each device's counters (no disk I/O)"""
+        buckets = self.buckets(now)
+        with self.lock:
+            self._connect()
+            for mac, counts in counters.items():
+                counter_in, counter_out = counts["bytes_in"], counts["bytes_out"]
+                if mac in self.baseline:
+                    self.baseline.discard(mac)
+                    self.last[mac] = (counter_in, counter_out)
+                    self.dirty.add(mac)
+                    continue
+                last = self.last.get(mac)
+                if last is None or mac in self.fresh:
+                    last = (0, 0)
+                    self.fresh.discard(mac)
+                delta_in = counter_in - last[0] if counter_in >= last[0] else counter_in
+                delta_out = counter_out - last[1] if counter_out >= last[1] else counter_out
+                self.last[mac] = (counter_in, counter_out)
+                self.dirty.add(mac)
+                if not delta_in and not delta_out:
+                    continue
+                for resolution, bucket in buckets.items():
+                    totals = self.pending.setdefault((mac, resolution, bucket), [0, 0])
+                    totals[0] += delta_in
+                    totals[1] += delta_out
+
+    def flush(self):
+        """Write pending deltas and counters in one transaction, pruning expired buckets hourly"""
+        with self.lock:
+            if not self.pending and not self.dirty:
+                return
+            conn = self._connect()
+            pending, self.pending = self.pending, {}
+            dirty, self.dirty = self.dirty, set()
+            now = time.time()
+            try:
+                with conn:
+                    conn.execute("BEGIN")
+                    conn.executemany(
+                        "INSERT INTO usage VALUES (?, ?, ?, ?, ?) ON CONFLICT(mac, resolution, bucket) DO UPDATE "
+                        "SET bytes_in = bytes_in + excluded.bytes_in, bytes_out = bytes_out + excluded.bytes_out",
+                        [key + tuple(totals) for key, totals in pending.items()])
+                    conn.executemany("INSERT OR REPLACE INTO counters VALUES (?, ?, ?, ?)",
+                                     [(mac,) + self.last[mac] + (now,) for mac in dirty if mac in self.last])
+                    conn.execute("INSERT OR REPLACE INTO meta VALUES ('boot_id', ?)", (self._boot_id(),))
+                    conn.execute("INSERT OR REPLACE INTO meta VALUES ('baseline', ?)",
+                                 (json.dumps(sorted(self.baseline)),))
+                    if now - self.pruned_at > 3600:
+                        for resolution, keep in self.RETENTION.items():
+                            if keep:
+                                conn.execute("DELETE FROM usage WHERE resolution = ? AND bucket < ?",
+                                             (resolution, int(now - keep)))
+                        self.pruned_at = now
+            except sqlite3.Error as e:
+                # Keep the deltas for the next attempt
+                for key, totals in pending.items():
+                    merged = self.pending.setdefault(key, [0, 0])
+                    merged[0] += totals[0]
+                    merged[1] += totals[1]
+                self.dirty |= dirty
+                print(f"Error saving usage: {e}")
+
+    def start(self):
+        """Start the flush thread"""
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.FLUSH_INTERVAL)
+            self.flush()
+
+    def totals(self, resolution='month', bucket=None):
+        """{mac: (bytes in, bytes out)} for one bucket (default: the current one), including unflushed usage"""
+        bucket = self.buckets(time.time())[resolution] if bucket is None else bucket
+        with self.lock:
+            conn = self._connect()
+            totals = {mac: [bytes_in, bytes_out] for mac, bytes_in, bytes_out in conn.execute(
+                "SELECT mac, bytes_in, bytes_out FROM usage WHERE resolution = ? AND bucket = ?",
+                (resolution, bucket))}
+            for (mac, res, start), (bytes_in, bytes_out) in self.pending.items():
+                if res == resolution and start == bucket:
+                    entry = totals.setdefault(mac, [0, 0])
+                    entry[0] += bytes_in
+                    entry[1] += bytes_out
+        return {mac: tuple(entry) for mac, entry in totals.items()}
+
+    def history(self, mac, resolution='hour', since=0):
+        """[[bucket start, bytes in, bytes out], ...] of one device, oldest first"""
+        mac = mac.upper()
+        with self.lock:
+            conn = self._connect()
+            rows = {bucket: [bytes_in, bytes_out] for bucket, bytes_in, bytes_out in conn.execute(
+                "SELECT bucket, bytes_in, bytes_out FROM usage WHERE mac = ? AND resolution = ? AND bucket >= ?",
+                (mac, resolution, since))}
+            for (m, res, bucket), (bytes_in, bytes_out) in self.pending.items():
+                if m == mac and res == resolution and bucket >= since:
+                    entry = rows.setdefault(bucket, [0, 0])
+                    entry[0] += bytes_in
+                    entry[1] += bytes_out
+        return [[bucket] + rows[bucket] for bucket in sorted(rows)]
+
+    def reset(self, mac=None):
+        """Forget the usage of one device (or of all devices); their counters restart from zero"""
+        with self.lock:
+            conn = self._connect()
+            macs = [mac.upper()] if mac else list(self.last)
+            self.pending = {key: totals for key, totals in self.pending.items() if mac and key[0] != mac.upper()}
+            for m in macs:
+                self.last[m] = (0, 0)
+                self.dirty.add(m)
+            self.baseline = self.baseline - set(macs) if mac else set()
+            with conn:
+                conn.execute("BEGIN")
+                if mac:
+                    conn.execute("DELETE FROM usage WHERE mac = ?", (mac.upper(),))
+                else:
+                    conn.execute("DELETE FROM usage")
+
+
+USAGE_STORE = UsageStore(USAGE_DB)
 
-    return None
 
 class HotspotHandler(BaseHTTPRequestHandler):
     def log_message(self, format, *args):
         """Suppress default logging"""
         pass
 
-    def _send_json(self, data):
+    def _send_json(self, data, status=200):
         """Send JSON response"""
-        self.send_response(200)
+        self.send_response(status)
         self.send_header('Content-Type', 'application/json')
         self.send_header('Access-Control-Allow-Origin', '*')
         self.end_headers()
@@ -954,138 +4072,44 @@ class HotspotHandler(BaseHTTPRequestHandler):
         except Exception as e:
             return str(e), 1
 
-    def _get_vendor_from_mac(self, mac):
-        """Get device vendor from MAC address"""
-        mac = mac.lower().replace('-', ':')
-        oui = ':'.join(mac.split(':')[:3])
-        return MAC_VENDORS.get(oui, 'Unknown')
-
-    def _get_device_hostname(self, ip):
-        """Try to get hostname from IP"""
-        try:
-            hostname = socket.gethostbyaddr(ip)[0]
-            return hostname if hostname != ip else None
-        except:
-            return None
-
-    def _get_connection_info(self, ip):
-        """Get connection statistics for device"""
-        try:
-            # Get connection count
-            output, _ = self._run_command(f"netstat -an 2>/dev/null | grep {ip} | wc -l")
-            conn_count = output.strip() or "0"
-
-            # Get traffic stats if available
-            output, _ = self._run_command(f"iptables -L -v -n 2>/dev/null | grep {ip}")
-
-            return {"connections": conn_count}
-        except:
-            return {"connections": "0"}
+    def _run_root(self, argv, input_data=None):
+        """Run argv-style command as root over the persistent helper channel"""
+        stdout, _, code = run_root(argv, input_data)
+        return stdout, code
 
     def _get_devices(self):
-        """Get connected hotspot devices with enhanced information"""
-        devices = []
-
-        # Detect hotspot interface
-        hotspot_iface = None
-        for iface in ['wlan0', 'swlan0', 'ap0', 'softap0']:
-            output, _ = self._run_command(f"ip addr show {iface} 2>/dev/null | grep 'inet '")
-            if output and '192.168' in output:
-                hotspot_iface = iface
-                break
-
-        if not hotspot_iface:
-            return {"devices": [], "interface": "none"}
-
-        # Get devices from ARP table
-        output, _ = self._run_command(f"ip neigh show dev {hotspot_iface}")
-
-        for line in output.strip().split('\n'):
-            if not line:
-                continue
+        """Get connected hotspot devices (latest background snapshot, never blocks)"""
+        return DEVICE_INVENTORY.snapshot()
 
-            parts = line.split()
-            if len(parts) >= 4:
-                ip = parts[0]
-                # Check if this is an IPv4 address (skip IPv6)
-                if not ':' in ip or ip.count(':') < 2:
-                    # Find 'lladdr' keyword in the line (position varies)
-                    try:
-                        lladdr_index = parts.index('lladdr')
-                        if len(parts) > lladdr_index + 2:
-                            mac = parts[lladdr_index + 1]
-                            state = parts[lladdr_index + 2]
-                        else:
-                            continue
-                    except (ValueError, IndexError):
-                        continue
-
-                    # Only show active connections
-                    if state in ['REACHABLE', 'STALE', 'DELAY', 'PROBE']:
-                        # Get vendor from MAC
-                        vendor = self._get_vendor_from_mac(mac)
-
-                        # Try to fetch accurate device name from web
-                        web_device_name = fetch_device_name_from_web(mac)
-
-                        # Try to get hostname from system
-                        hostname = self._get_device_hostname(ip)
-
-                        # Try DHCP leases
-                        if not hostname and os.path.exists('/data/misc/dhcp/dnsmasq.leases'):
-                            lease_output, _ = self._run_command(f"grep -i {mac} /data/misc/dhcp/dnsmasq.leases 2>/dev/null")
-                            if lease_output:
-                                parts = lease_output.split()
-                                if len(parts) > 3:
-                                    hostname = parts[3]
-
-                        # Get connection info
-                        conn_info = self._get_connection_info(ip)
-
-                        # Build device name (priority: custom > web lookup > hostname > vendor)
-                        # Check if we have custom info for this device (by MAC address)
-                        custom_info = DEVICE_INFO.get(mac, {})
-                        custom_name = custom_info.get('name')
-                        custom_notes = custom_info.get('notes', '')
-
-                        if custom_name:
-                            device_name = custom_name
-                        elif web_device_name:
-                            device_name = web_device_name
-                        elif hostname:
-                            device_name = hostname
-                        else:
-                            device_name = f"{vendor} Device"
-
-                        devices.append({
-                            "ip": ip,
-                            "mac": mac,
-                            "hostname": device_name,
-                            "vendor": vendor,
-                            "state": state,
-                            "connections": conn_info.get("connections", "0"),
-                            "custom_name": custom_name or "",
-                            "notes": custom_notes
-                        })
-
-        return {"devices": devices, "interface": hotspot_iface}
-
-    def _get_blocked_urls(self):
-        """Get list of blocked URLs with their IP addresses"""
+    def _get_blocked_urls(self, offset=0, limit=100, search='', include_cidrs=False):
+        """Get one page of blocked URLs with their IP addresses"""
         blocked_list = []
+        total = 0
+        compiled = {"input_ranges": 0, "rules": 0, "cidrs": []}
         try:
-            # Load from JSON (includes IPs)
-            with open(BLOCKLIST_JSON, 'r') as f:
-                blocked_data = json.load(f)
+            page, total = BLOCKLIST_STORE.page(offset, limit, search)
+
+            # Compiled rule set: which merged CIDR covers which domains' ranges
+            BLOCK_INDEX.refresh()
+            cidrs, owners = BLOCK_INDEX.compiled
+            compiled = {
+                "input_ranges": sum(len(covered) for covered in owners.values()),
+                "rules": len(cidrs),
+                "cidrs": [{"cidr": cidr, "owners": sorted(set(url for url, _ in owners[cidr]))}
+                          for cidr in cidrs] if include_cidrs else []
+            }
 
-            for url, data in blocked_data.items():
+            for url, data in page:
                 blocked_list.append({
                     "url": url,
                     "ips": data.get("ips", []),
                     "ip_ranges": data.get("ip_ranges", data.get("ips", [])),
                     "is_ip_address": data.get("is_ip_address", False),
                     "blocked_at": data.get("blocked_at", ""),
-                    "rules_count": data.get("rules_count", 0)
+                    "rules_count": data.get("rules_count", 0),
+                    "last_refresh": data.get("last_refresh", ""),
+                    "refresh_added": data.get("refresh_added", 0),
+                    "refresh_removed": data.get("refresh_removed", 0)
                 })
         except:
             # Fallback to old text file
@@ -1094,26 +4118,16 @@ class HotspotHandler(BaseHTTPRequestHandler):
                     urls = [line.strip() for line in f if line.strip()]
                     for url in urls:
                         blocked_list.append({"url": url, "ips": [], "is_ip_address": False, "blocked_at": "", "rules_count": 0})
+                    total = len(blocked_list)
             except:
                 pass
 
-        return {"blocked_urls": blocked_list}
+        return {"blocked_urls": blocked_list, "total": total, "offset": offset, "limit": limit,
+                "compiled": compiled}
 
     def _resolve_domain_to_ips(self, domain):
-        """Resolve domain to IP addresses using Python socket"""
-        ips = []
-        try:
-            import socket
-            # Get all IPv4 addresses for the domain
-            addr_info = socket.getaddrinfo(domain, 80, socket.AF_INET)
-            # Extract unique IPs
-            ip_set = set()
-            for info in addr_info:
-                ip = info[4][0]
-                ip_set.add(ip)
-            ips = list(ip_set)
-        except:
-            pass
+        """Resolve domain and its known variations to IP addresses (cached, bounded latency)"""
+        ips, _ = RESOLVER.resolve_family(domain)
         return ips
 
     def _is_valid_ip(self, address):
@@ -1141,8 +4155,7 @@ class HotspotHandler(BaseHTTPRequestHandler):
 
         # Load existing blocks
         try:
-            with open(BLOCKLIST_JSON, 'r') as f:
-                blocked_data = json.load(f)
+            blocked_data = BLOCKLIST_STORE.load()
         except:
             blocked_data = {}
 
@@ -1167,20 +4180,13 @@ class HotspotHandler(BaseHTTPRequestHandler):
                 blocked_ips = []
 
         # FAST LAYER: Block by IP (90% of traffic blocked here, super fast)
-        for ip in blocked_ips:
-            # Remove old rule if exists (try both REJECT and DROP for cleanup)
-            self._run_command(f'su -c "iptables -D FORWARD -d {ip} -j REJECT --reject-with icmp-host-unreachable" 2>/dev/null')
-            self._run_command(f'su -c "iptables -D FORWARD -d {ip} -j DROP" 2>/dev/null')
-            # Add IP block rule (VERY FAST - no deep packet inspection)
-            result, code = self._run_command(f'su -c "iptables -I FORWARD 1 -d {ip} -j DROP" 2>&1')
-            if code == 0:
-                rules_added += 1
-
         # NO DNS STRING MATCHING - it slows down internet!
         # IP-only blocking for maximum speed
+        rules_added = len(blocked_ips)
 
         # Save to JSON with IP mapping
         import datetime
+        old_ranges = blocklist_ranges(blocked_data)
         blocked_data[url] = {
             "ips": blocked_ips,
             "is_ip_address": is_ip,
@@ -1188,24 +4194,18 @@ class HotspotHandler(BaseHTTPRequestHandler):
             "rules_count": rules_added
         }
 
-        with open(BLOCKLIST_JSON, 'w') as f:
-            json.dump(blocked_data, f, indent=2)
+        # Apply in one transaction and save rules for persistence
+        tx_result = update_block_rules(old_ranges, blocked_data)
+        if not tx_result["success"]:
+            return {"success": False, "message": f"Failed to block {url}: {tx_result['error']}",
+                    "rules_applied": 0, "elapsed_ms": tx_result["elapsed_ms"]}
 
-        # Also save to old blocklist file for compatibility
-        try:
-            with open(BLOCKLIST, 'r') as f:
-                existing = [line.strip() for line in f]
-        except:
-            existing = []
-        if url not in existing:
-            with open(BLOCKLIST, 'a') as f:
-                f.write(url + '\n')
-
-        # Save iptables rules for persistence
-        self._run_command('su -c "iptables-save > /data/data/com.termux/files/home/iptables-rules.txt"')
+        BLOCKLIST_STORE.put(url, blocked_data[url], source='manual' if is_ip else 'resolved')
+        BLOCK_INDEX.block(url, blocked_data)
 
         ip_msg = f" ({len(blocked_ips)} IPs)" if blocked_ips else ""
-        return {"success": True, "message": f"✓ Blocked {url}{ip_msg} - {rules_added} fast rules added"}
+        return {"success": True, "message": f"✓ Blocked {url}{ip_msg} - {rules_added} fast rules added",
+                "rules_applied": tx_result["rules_applied"], "elapsed_ms": tx_result["elapsed_ms"]}
 
     def _block_url_advanced(self, url, ip_ranges):
         """Advanced blocking with custom IP ranges - NO DNS string matching for speed!"""
@@ -1215,41 +4215,44 @@ class HotspotHandler(BaseHTTPRequestHandler):
         url = url.strip().lower()
 
         try:
-            with open(BLOCKLIST_JSON, 'r') as f:
-                blocked_data = json.load(f)
+            blocked_data = BLOCKLIST_STORE.load()
         except:
             blocked_data = {}
 
         if url in blocked_data:
             return {"success": False, "message": f"{url} is already blocked. Use Edit to modify."}
 
-        rules_added = 0
-
         # If no IP ranges provided, auto-resolve
+        source = 'manual' if ip_ranges else 'resolved'
         if not ip_ranges:
             resolved_ips = self._resolve_domain_to_ips(url)
             ip_ranges = resolved_ips if resolved_ips else []
 
         # Block each IP/range (CIDR supported: 157.240.0.0/16)
-        for ip_range in ip_ranges:
-            self._run_command(f'su -c "iptables -D FORWARD -d {ip_range} -j DROP" 2>/dev/null')
-            result, code = self._run_command(f'su -c "iptables -I FORWARD 1 -d {ip_range} -j DROP" 2>&1')
-            if code == 0:
-                rules_added += 1
+        invalid = [ip_range for ip_range in ip_ranges if normalize_ip_range(ip_range) is None]
+        if invalid:
+            return {"success": False, "message": f"Invalid IP range(s): {', '.join(invalid)}"}
 
         import datetime
+        old_ranges = blocklist_ranges(blocked_data)
         blocked_data[url] = {
             "ip_ranges": ip_ranges,
             "ips": ip_ranges,
             "is_ip_address": self._is_valid_ip(url),
             "blocked_at": datetime.datetime.now().isoformat(),
-            "rules_count": rules_added
+            "rules_count": len(ip_ranges)
         }
 
-        with open(BLOCKLIST_JSON, 'w') as f:
-            json.dump(blocked_data, f, indent=2)
+        tx_result = update_block_rules(old_ranges, blocked_data)
+        if not tx_result["success"]:
+            return {"success": False, "message": f"Failed to block {url}: {tx_result['error']}",
+                    "rules_applied": 0, "elapsed_ms": tx_result["elapsed_ms"]}
+
+        BLOCKLIST_STORE.put(url, blocked_data[url], source=source)
+        BLOCK_INDEX.block(url, blocked_data)
 
-        return {"success": True, "message": f"✓ Blocked {url} with {len(ip_ranges)} IP range(s)"}
+        return {"success": True, "message": f"✓ Blocked {url} with {len(ip_ranges)} IP range(s)",
+                "rules_applied": tx_result["rules_applied"], "elapsed_ms": tx_result["elapsed_ms"]}
 
     def _update_blocked_url(self, url, ip_ranges):
         """Update IP ranges for blocked URL"""
@@ -1259,143 +4262,221 @@ class HotspotHandler(BaseHTTPRequestHandler):
         url = url.strip().lower()
 
         try:
-            with open(BLOCKLIST_JSON, 'r') as f:
-                blocked_data = json.load(f)
+            blocked_data = BLOCKLIST_STORE.load()
         except:
             return {"success": False, "message": "Error loading blocked URLs"}
 
         if url not in blocked_data:
             return {"success": False, "message": f"{url} is not blocked"}
 
-        # Remove old rules
-        old_ranges = blocked_data[url].get("ip_ranges", blocked_data[url].get("ips", []))
-        for ip_range in old_ranges:
-            for i in range(10):
-                result, code = self._run_command(f'su -c "iptables -D FORWARD -d {ip_range} -j DROP" 2>&1')
-                if code != 0:
-                    break
-
-        # Add new rules
-        rules_added = 0
-        for ip_range in ip_ranges:
-            result, code = self._run_command(f'su -c "iptables -I FORWARD 1 -d {ip_range} -j DROP" 2>&1')
-            if code == 0:
-                rules_added += 1
+        invalid = [ip_range for ip_range in ip_ranges if normalize_ip_range(ip_range) is None]
+        if invalid:
+            return {"success": False, "message": f"Invalid IP range(s): {', '.join(invalid)}"}
 
         import datetime
+        old_ranges = blocklist_ranges(blocked_data)
         blocked_data[url]["ip_ranges"] = ip_ranges
         blocked_data[url]["ips"] = ip_ranges
-        blocked_data[url]["rules_count"] = rules_added
+        blocked_data[url]["rules_count"] = len(ip_ranges)
         blocked_data[url]["updated_at"] = datetime.datetime.now().isoformat()
 
-        with open(BLOCKLIST_JSON, 'w') as f:
-            json.dump(blocked_data, f, indent=2)
+        # Old and new ranges are swapped in one transaction
+        tx_result = update_block_rules(old_ranges, blocked_data)
+        if not tx_result["success"]:
+            return {"success": False, "message": f"Failed to update {url}: {tx_result['error']}",
+                    "rules_applied": 0, "elapsed_ms": tx_result["elapsed_ms"]}
 
-        return {"success": True, "message": f"✓ Updated {url} with {len(ip_ranges)} IP range(s)"}
+        BLOCKLIST_STORE.put(url, blocked_data[url], source='manual')
+        BLOCK_INDEX.block(url, blocked_data)
+
+        return {"success": True, "message": f"✓ Updated {url} with {len(ip_ranges)} IP range(s)",
+                "rules_applied": tx_result["rules_applied"], "elapsed_ms": tx_result["elapsed_ms"]}
 
     def _get_domain_variations(self, url):
         """Get known domain variations for popular sites"""
-        variations = []
-
-        # YouTube variations
-        if 'youtube' in url:
-            variations.extend(['youtu.be', 'youtubei.googleapis.com', 'ytimg.com', 'yt3.ggpht.com'])
-
-        # Facebook variations
-        elif 'facebook' in url:
-            variations.extend(['fb.com', 'fbcdn.net', 'facebook.net', 'fb.me'])
-
-        # Instagram variations
-        elif 'instagram' in url:
-            variations.extend(['cdninstagram.com', 'ig.me'])
-
-        # Twitter/X variations
-        elif 'twitter' in url or url == 'x.com':
-            variations.extend(['twitter.com', 'x.com', 't.co', 'twimg.com'])
-
-        # TikTok variations
-        elif 'tiktok' in url:
-            variations.extend(['tiktokcdn.com', 'tiktokv.com', 'musical.ly'])
-
-        # WhatsApp variations
-        elif 'whatsapp' in url:
-            variations.extend(['wa.me'])
-
-        # Netflix variations
-        elif 'netflix' in url:
-            variations.extend(['nflxext.com', 'nflximg.net', 'nflxvideo.net'])
-
-        return variations
+        return get_domain_variations(url)
 
     def _unblock_url(self, url):
         """FAST URL unblocking - removes IP and DNS rules"""
         if not url:
             return {"success": False, "message": "No URL provided"}
 
-        # Clean and normalize URL
-        url = url.strip().lower()
-        url = re.sub(r'^https?://', '', url)
-        url = re.sub(r'/.*$', '', url)
-        url = re.sub(r':.*$', '', url)
-        url = re.sub(r'^www\.', '', url)
+        try:
+            # IP and CIDR entries are keyed by their network (the bare address for a /32)
+            url = str(ipaddress.ip_network(url.strip(), strict=False)).replace('/32', '')
+        except ValueError:
+            # Clean and normalize URL
+            url = url.strip().lower()
+            url = re.sub(r'^https?://', '', url)
+            url = re.sub(r'/.*$', '', url)
+            url = re.sub(r':.*$', '', url)
+            url = re.sub(r'^www\.', '', url)
 
         # Load blocked data to get IPs
         try:
-            with open(BLOCKLIST_JSON, 'r') as f:
-                blocked_data = json.load(f)
+            blocked_data = BLOCKLIST_STORE.load()
         except:
             blocked_data = {}
 
         if url not in blocked_data:
             return {"success": False, "message": f"{url} is not in blocklist"}
 
-        blocked_ips = blocked_data[url].get("ips", [])
-        rules_removed = 0
-
-        # Remove IP-based blocks (fast rules) - try both REJECT and DROP
-        for ip in blocked_ips:
-            for i in range(5):  # Try REJECT rules (old format)
-                result, code = self._run_command(f'su -c "iptables -D FORWARD -d {ip} -j REJECT --reject-with icmp-host-unreachable" 2>&1')
-                if code == 0:
-                    rules_removed += 1
-                else:
-                    break
-            for i in range(5):  # Try DROP rules (new format)
-                result, code = self._run_command(f'su -c "iptables -D FORWARD -d {ip} -j DROP" 2>&1')
-                if code == 0:
-                    rules_removed += 1
-                else:
-                    break
+        rules_removed = len(blocked_data[url].get("ip_ranges", blocked_data[url].get("ips", [])))
 
+        # Drop this URL's ranges in one transaction - no need to probe with repeated -D
         # DNS string blocking disabled for performance (IP-only blocking)
-
-        # Remove from JSON
+        old_ranges = blocklist_ranges(blocked_data)
         del blocked_data[url]
-        with open(BLOCKLIST_JSON, 'w') as f:
-            json.dump(blocked_data, f, indent=2)
+        tx_result = update_block_rules(old_ranges, blocked_data)
+        if not tx_result["success"]:
+            return {"success": False, "message": f"Failed to unblock {url}: {tx_result['error']}",
+                    "rules_applied": 0, "elapsed_ms": tx_result["elapsed_ms"]}
+
+        BLOCKLIST_STORE.delete(url)
+        BLOCK_INDEX.unblock(url, blocked_data)
+
+        return {"success": True, "message": f"✓ Unblocked {url} ({rules_removed} rules removed)",
+                "rules_applied": tx_result["rules_applied"], "elapsed_ms": tx_result["elapsed_ms"]}
+
+    def _bulk_import(self):
+        """Stream a hosts file / domain list / CIDR feed from the request body into the blocklist.
+
+        The body is read line by line, so memory grows with the number of new
+        unique entries rather than the upload size. Progress is streamed back
+        as JSON lines and mirrored in IMPORT_STATUS for /api/import-status.
+        Domains are resolved concurrently until IMPORT_RESOLVE_DEADLINE; the
+        rest are stored without addresses and filled in by the background
+        refresh. Everything is applied in one firewall transaction.
+        """
+        started = time.time()
+        params = parse_qs(urlparse(self.path).query)
+        resolve = params.get('resolve', ['1'])[0] != '0'
+        content_length = int(self.headers.get('Content-Length', 0))
 
-        # Remove from old blocklist file
-        try:
-            with open(BLOCKLIST, 'r') as f:
-                lines = [line.strip() for line in f if line.strip()]
-            with open(BLOCKLIST, 'w') as f:
-                for line in lines:
-                    if line != url:
-                        f.write(line + '\n')
-        except:
-            pass
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.close_connection = True
 
-        # Save iptables rules for persistence
-        self._run_command('su -c "iptables-save > /data/data/com.termux/files/home/iptables-rules.txt"')
+        def progress(**fields):
+            IMPORT_STATUS.update(fields, elapsed_ms=round((time.time() - started) * 1000, 1))
+            try:
+                self.wfile.write((json.dumps(IMPORT_STATUS) + '\n').encode())
+                self.wfile.flush()
+            except OSError:
+                pass
 
-        return {"success": True, "message": f"✓ Unblocked {url} ({rules_removed} rules removed)"}
+        if not IMPORT_LOCK.acquire(blocking=False):
+            self.wfile.write(json.dumps({"state": "busy", "error": "Another import is already running"}).encode())
+            return
+        try:
+            self._import_stream(started, content_length, resolve, progress)
+        except Exception as e:
+            progress(state='failed', error=str(e), finished_at=time.time())
+        finally:
+            IMPORT_LOCK.release()
+
+    def _import_stream(self, started, content_length, resolve, progress):
+        """Parse, resolve and apply one bulk import (see _bulk_import)"""
+        IMPORT_STATUS.update(state='reading', lines=0, domains=0, cidrs=0, duplicates=0, invalid=0, skipped=0,
+                             resolved=0, unresolved=0, rules_applied=0, error='',
+                             started_at=started, finished_at=None)
+
+        # Phase 1: parse and deduplicate while streaming the body
+        existing = BLOCKLIST_STORE.load()
+        BLOCK_INDEX.refresh()
+        domains = {}
+        cidrs = set()
+        remaining = content_length
+        while remaining > 0:
+            raw = self.rfile.readline(min(remaining, 65536))
+            if not raw:
+                break
+            remaining -= len(raw)
+            IMPORT_STATUS['lines'] += 1
+            items = parse_blocklist_line(raw.decode('utf-8', errors='ignore'))
+            if items is None:
+                IMPORT_STATUS['invalid'] += 1
+                continue
+            for kind, value in items:
+                if kind == 'skipped':
+                    IMPORT_STATUS['skipped'] += 1
+                elif value in existing or value in domains or value in cidrs:
+                    IMPORT_STATUS['duplicates'] += 1
+                elif kind == 'cidr' and BLOCK_INDEX.trie.covers(value):
+                    IMPORT_STATUS['duplicates'] += 1
+                elif len(domains) + len(cidrs) >= IMPORT_MAX_ENTRIES:
+                    IMPORT_STATUS['invalid'] += 1
+                elif kind == 'domain':
+                    domains[value] = []
+                else:
+                    cidrs.add(value)
+            if IMPORT_STATUS['lines'] % 5000 == 0:
+                progress(domains=len(domains), cidrs=len(cidrs))
+        progress(state='resolving' if resolve and domains else 'applying', domains=len(domains), cidrs=len(cidrs))
+
+        # Phase 2: resolve domains concurrently in chunks until the deadline
+        if resolve and domains:
+            deadline = started + IMPORT_RESOLVE_DEADLINE
+            names = list(domains)
+            for i in range(0, len(names), 256):
+                if time.time() >= deadline:
+                    break
+                answers = RESOLVER.resolve_many(names[i:i + 256], deadline=deadline - time.time())
+                for name, ips in answers.items():
+                    # Hosts files map names like localhost.localdomain to local addresses
+                    domains[name] = [ip for ip in ips or [] if ipaddress.IPv4Address(ip).is_global]
+                    IMPORT_STATUS['resolved' if domains[name] else 'unresolved'] += 1
+                progress()
+            IMPORT_STATUS['unresolved'] = len(domains) - IMPORT_STATUS['resolved']
+
+        # Phase 3: one store transaction and one firewall transaction
+        progress(state='applying')
+        import datetime
+        now = datetime.datetime.now().isoformat()
+        items = [(cidr.replace('/32', ''), {"ip_ranges": [cidr], "ips": [cidr], "is_ip_address": True,
+                                            "blocked_at": now, "rules_count": 1}, 'import')
+                 for cidr in sorted(cidrs)]
+        items += [(name, {"ip_ranges": ips, "ips": ips, "is_ip_address": False,
+                          "blocked_at": now, "rules_count": len(ips)}, 'resolved')
+                  for name, ips in domains.items()]
+        if not items:
+            progress(state='done', finished_at=time.time())
+            return
+        with BLOCKLIST_LOCK:
+            blocked_data = BLOCKLIST_STORE.load()
+            old_ranges = blocklist_ranges(blocked_data)
+            for url, entry, _ in items:
+                blocked_data[url] = entry
+            tx_result = update_block_rules(old_ranges, blocked_data)
+            if not tx_result["success"]:
+                progress(state='failed', error=tx_result["error"], finished_at=time.time())
+                return
+            BLOCKLIST_STORE.put_many(items)
+            BLOCK_INDEX.rebuild(blocked_data)
+        progress(state='done', rules_applied=tx_result["rules_applied"], finished_at=time.time())
+
+    def _start_learning(self, client_ip, duration):
+        """Start a learning session for one hotspot client"""
+        global LEARN_SESSION
+        try:
+            ipaddress.IPv4Address(client_ip)
+            duration = min(max(int(duration), 5), 300)
+        except (ValueError, TypeError):
+            return {"success": False, "message": "Invalid client IP or duration"}
+        if LEARN_SESSION and LEARN_SESSION.state in ('starting', 'capturing'):
+            return {"success": False, "message": f"Already learning for {LEARN_SESSION.client_ip}"}
+        LEARN_SESSION = LearningSession(client_ip, duration)
+        LEARN_SESSION.start()
+        return {"success": True, "message": f"Learning traffic of {client_ip} for {duration}s"}
 
     def _get_wifi_settings(self):
         """Get current WiFi hotspot settings"""
         try:
             # Read config with root access
             config_path = '/data/vendor/wifi/hostapd/hostapd_wlan0.conf'
-            config, code = self._run_command(f'su -c "cat {config_path}"')
+            config, code = self._run_root(['cat', config_path])
 
             if code != 0 or not config:
                 return {"success": False, "message": "Could not read hostapd config"}
@@ -1420,7 +4501,7 @@ class HotspotHandler(BaseHTTPRequestHandler):
             # If tx_power not found in config, add it with default value
             if tx_power is None:
                 tx_power = 20
-                self._run_command(f'su -c "echo \'tx_power={tx_power}\' >> {config_path}"')
+                self._run_root(['sh', '-c', f"echo 'tx_power={tx_power}' >> {config_path}"])
 
             return {
                 "success": True,
@@ -1440,20 +4521,20 @@ class HotspotHandler(BaseHTTPRequestHandler):
         try:
             # Read current config
             config_path = '/data/vendor/wifi/hostapd/hostapd_wlan0.conf'
-            result, code = self._run_command(f'su -c "cat {config_path}"')
+            result, code = self._run_root(['cat', config_path])
             if code != 0 or not result:
                 return {"success": False, "message": "Could not read hostapd config"}
 
             # Replace channel value using sed
-            sed_result, sed_code = self._run_command(f'su -c "sed -i \'s/^channel=.*/channel={channel}/\' {config_path}"')
+            sed_result, sed_code = self._run_root(['sed', '-i', f's/^channel=.*/channel={channel}/', config_path])
 
             # Update op_class based on channel (2.4GHz band)
             if channel <= 11:
                 op_class = 81 + ((channel - 1) // 4)  # 81-83 for channels 1-11
-                self._run_command(f'su -c "sed -i \'s/^op_class=.*/op_class={op_class}/\' {config_path}"')
+                self._run_root(['sed', '-i', f's/^op_class=.*/op_class={op_class}/', config_path])
 
             # Verify the channel was set correctly
-            verify, _ = self._run_command(f'su -c "grep \'^channel=\' {config_path}"')
+            verify, _ = self._run_root(['grep', '^channel=', config_path])
             actual_channel = None
             if verify:
                 try:
@@ -1496,7 +4577,7 @@ class HotspotHandler(BaseHTTPRequestHandler):
 
         try:
             config_path = '/data/vendor/wifi/hostapd/hostapd_wlan0.conf'
-            result, code = self._run_command(f'su -c "cat {config_path}"')
+            result, code = self._run_root(['cat', config_path])
 
             if code != 0 or not result:
                 return {"success": False, "message": "Could not read hostapd config"}
@@ -1504,13 +4585,13 @@ class HotspotHandler(BaseHTTPRequestHandler):
             # Check if tx_power line exists
             if 'tx_power=' in result:
                 # Update existing tx_power line using sed
-                self._run_command(f'su -c "sed -i \'s/^tx_power=.*/tx_power={power}/\' {config_path}"')
+                self._run_root(['sed', '-i', f's/^tx_power=.*/tx_power={power}/', config_path])
             else:
                 # Add tx_power parameter after wpa_passphrase line (or at end)
-                self._run_command(f'su -c "sed -i \'/^wpa_passphrase=/a tx_power={power}\' {config_path}"')
+                self._run_root(['sed', '-i', f'/^wpa_passphrase=/a tx_power={power}', config_path])
 
             # Verify it was set
-            verify, _ = self._run_command(f'su -c "grep \'^tx_power=\' {config_path}"')
+            verify, _ = self._run_root(['grep', '^tx_power=', config_path])
             actual_power = None
             if verify:
                 try:
@@ -1547,11 +4628,23 @@ class HotspotHandler(BaseHTTPRequestHandler):
             return {"success": False, "message": f"Error setting TX power: {str(e)}"}
 
     def _block_device(self, mac, ip):
-        """Block a device"""
-        self._run_command(f"iptables -D FORWARD -m mac --mac-source {mac} -j DROP 2>/dev/null")
-        self._run_command(f"iptables -I FORWARD -m mac --mac-source {mac} -j DROP")
-        self._run_command(f"iptables -D FORWARD -s {ip} -j DROP 2>/dev/null")
-        self._run_command(f"iptables -I FORWARD -s {ip} -j DROP")
+        """Block a device (mac and ip must already be validated)"""
+        tx = RuleTransaction()
+        specs = [f'-m mac --mac-source {mac} -j DROP', f'-s {ip} -j DROP']
+        for spec in specs:
+            tx.delete('FORWARD', spec)
+        # Right after the HOTSPOT_BLOCK/HOTSPOT_ACCT jumps (which the reconciler keeps at
+        # the top) and before the hotspot ACCEPTs
+        position = 1
+        for spec in tx.chain_rules('FORWARD'):
+            if spec not in (f'-j {BLOCK_CHAIN}', f'-j {ACCOUNTING_CHAIN}'):
+                break
+            position += 1
+        for spec in reversed(specs):
+            tx.insert('FORWARD', spec, position)
+        result = tx.commit()
+        if not result["success"]:
+            return {"success": False, "message": f"Failed to block device: {result['error']}"}
         return {"success": True, "message": "Blocked device"}
 
     def _save_device_info(self, mac, name, notes):
@@ -1588,63 +4681,33 @@ class HotspotHandler(BaseHTTPRequestHandler):
         MONITOR_RUNNING = False
         print("Stopped traffic monitoring")
 
-    def _get_active_connections(self):
-        """Get active connections from conntrack or netstat"""
-        connections = []
-        try:
-            # Try to get connection tracking info
-            output, code = self._run_command("cat /proc/net/ip_conntrack 2>/dev/null || cat /proc/net/nf_conntrack 2>/dev/null | head -100")
-
-            if code == 0 and output:
-                for line in output.strip().split('\n')[:50]:  # Limit to 50 most recent
-                    parts = line.split()
-                    if len(parts) > 4:
-                        try:
-                            # Parse conntrack entry
-                            protocol = parts[0] if len(parts) > 0 else 'unknown'
-                            src_ip = dst_ip = port = 'N/A'
-
-                            # Extract src and dst from the line
-                            for part in parts:
-                                if part.startswith('src='):
-                                    src_ip = part.split('=')[1]
-                                elif part.startswith('dst=') and dst_ip == 'N/A':
-                                    dst_ip = part.split('=')[1]
-                                elif part.startswith('dport='):
-                                    port = part.split('=')[1]
-
-                            # Only log connections from hotspot clients (192.168.x.x)
-                            if src_ip.startswith('192.168'):
-                                log_request(src_ip, dst_ip, protocol, port)
-                        except:
-                            pass
-        except:
-            pass
-
-        return {"success": True}
-
     def _boost_internet(self):
         """Internet Booster/Fixer - runs comprehensive optimization script"""
         try:
-            # Run the ultimate booster script
-            output, code = self._run_command("/data/data/com.termux/files/home/ultimate-internet-booster.sh 2>&1")
+            # Reconcile firewall rules in-process against one iptables-save snapshot
+            devices = [(d["ip"], d["mac"]) for d in DEVICE_INVENTORY.snapshot()["devices"]]
+            with BLOCKLIST_LOCK:
+                report = reconcile_firewall(devices)
+
+            # Run the ultimate booster script for the sysctl/network tweaks
+            output, code = self._run_command("HOTSPOT_RECONCILED=1 /data/data/com.termux/files/home/ultimate-internet-booster.sh 2>&1")
 
             if code != 0:
                 return {"success": False, "message": "Booster script failed", "issues": [], "fixes": []}
 
             # Parse the result
-            issues_count = 0
-            fixes_count = 0
-            issues_list = []
-            fixes_list = []
+            issues_count = len(report["issues"])
+            fixes_count = 1 if report["rules_applied"] else 0
+            issues_list = list(report["issues"])
+            fixes_list = list(report["fixes"])
 
             # Extract RESULT line
             for line in output.split('\n'):
                 if line.startswith('RESULT:'):
                     parts = line.split(':')
                     if len(parts) >= 3:
-                        issues_count = int(parts[1])
-                        fixes_count = int(parts[2])
+                        issues_count += int(parts[1])
+                        fixes_count += int(parts[2])
 
             # Parse log for details
             log_lines = output.split('\n')
@@ -1680,33 +4743,53 @@ class HotspotHandler(BaseHTTPRequestHandler):
             self._send_html(os.path.join(WEBROOT, 'index.html'))
         elif path == '/blocked':
             self._send_html(os.path.join(WEBROOT, 'blocked.html'))
+        elif path == '/api/health':
+            self._send_json({
+                "status": "ok",
+                "uptime": round(time.time() - SERVER_STARTED, 1),
+                "blocklist_backend": "ipset" if IPSET_AVAILABLE else "iptables",
+                "restore": RESTORE_STATUS,
+                "import": IMPORT_STATUS,
+                "hotspot_interfaces": HOTSPOT_REGISTRY.interfaces()
+            })
+        elif path == '/api/import-status':
+            self._send_json(IMPORT_STATUS)
+        elif path == '/api/learn/status':
+            self._send_json(LEARN_SESSION.status() if LEARN_SESSION else {"state": "idle"})
         elif path == '/api/devices':
             self._send_json(self._get_devices())
+        elif path == '/api/device-events':
+            params = parse_qs(urlparse(self.path).query)
+            try:
+                since = float(params.get('since', ['0'])[0])
+            except ValueError:
+                since = 0
+            self._send_json({"events": NEIGHBOR_WATCHER.recent_events(since),
+                             "watching": NEIGHBOR_WATCHER.running})
+        elif path == '/api/top-talkers':
+            params = parse_qs(urlparse(self.path).query)
+            try:
+                n = min(max(int(params.get('n', ['5'])[0]), 1), 100)
+            except ValueError:
+                n = 5
+            self._send_json({"sampled_at": USAGE_SAMPLER.sampled_at, "interval": UsageSampler.INTERVAL,
+                             "devices": USAGE_SAMPLER.top_talkers(n)})
+        elif path == '/api/usage-history':
+            params = parse_qs(urlparse(self.path).query)
+            mac = params.get('mac', [''])[0]
+            history = USAGE_SAMPLER.history(mac)
+            if history is None:
+                self._send_json({"success": False, "error": "No samples for this device"})
+            else:
+                self._send_json({"success": True, "mac": mac.upper(), "interval": UsageSampler.INTERVAL,
+                                 "samples": history})
         elif path == '/api/data-usage':
             devices = self._get_devices()['devices']
             import datetime
             current_month = datetime.datetime.now().strftime('%B %Y')
 
-            # Load saved usage data
-            usage_file = '/data/data/com.termux/files/home/device_usage.json'
-            try:
-                with open(usage_file, 'r') as f:
-                    raw_usage = json.load(f)
-                # Normalize all MACs to uppercase and merge duplicates
-                saved_usage = {}
-                for mac, months in raw_usage.items():
-                    mac_upper = mac.upper()
-                    if mac_upper not in saved_usage:
-                        saved_usage[mac_upper] = {}
-                    for month, bytes_val in months.items():
-                        if month not in saved_usage[mac_upper]:
-                            saved_usage[mac_upper][month] = bytes_val
-                        else:
-                            saved_usage[mac_upper][month] = max(saved_usage[mac_upper][month], bytes_val)
-            except:
-                saved_usage = {}
-
-            # DEVICE_INFO is already loaded globally, contains custom names
+            # Totals of the current month, kept by USAGE_STORE from the sampled counters
+            month_usage = USAGE_STORE.totals('month')
 
             # Format bytes function
             def format_bytes(b):
@@ -1725,117 +4808,77 @@ class HotspotHandler(BaseHTTPRequestHandler):
             # Process currently connected devices
             for device in devices:
                 mac = device['mac'].upper()  # Normalize to uppercase
-                ip = device['ip']
                 processed_macs.add(mac)
-
-                # Ensure counting rules exist for this MAC (both directions)
-                # FIXED: Incoming traffic doesn't have client MAC as source!
-                # Outgoing: Match source IP + source MAC (client sending data)
-                _, code_out = self._run_command(f"su -c 'iptables -C FORWARD -s {ip} -m mac --mac-source {mac} 2>/dev/null'")
-                if code_out != 0:
-                    self._run_command(f"su -c 'iptables -I FORWARD -s {ip} -m mac --mac-source {mac}'")
-
-                # Incoming: Match destination IP only (return traffic has router's source MAC, not client's!)
-                _, code_in = self._run_command(f"su -c 'iptables -C FORWARD -d {ip} 2>/dev/null'")
-                if code_in != 0:
-                    self._run_command(f"su -c 'iptables -I FORWARD -d {ip}'")
-
-                # Get byte counters for this device
-                result_in, _ = self._run_command(f"su -c 'iptables -L FORWARD -v -n -x 2>/dev/null | grep -w {ip} | grep -v \"0     0\"'")
-
-                bytes_in = 0
-                bytes_out = 0
-                bytes_total = 0
-
-                if result_in:
-                    for line in result_in.strip().split('\n'):
-                        parts = line.split()
-                        # iptables format: pkts bytes target prot opt in out source destination [MAC MAC_ADDR]
-                        if len(parts) >= 8:
-                            try:
-                                bytes_val = int(parts[1])
-                                source_ip = parts[6]  # Column 7: source IP
-                                dest_ip = parts[7]     # Column 8: destination IP
-
-                                # Incoming: destination is this device
-                                if dest_ip == ip or dest_ip.startswith(ip + '/'):
-                                    bytes_in += bytes_val
-                                # Outgoing: source is this device
-                                elif source_ip == ip or source_ip.startswith(ip + '/'):
-                                    bytes_out += bytes_val
-                            except (ValueError, IndexError):
-                                pass
-
-                bytes_total = bytes_in + bytes_out
-
-                # Initialize MAC in saved usage
-                if mac not in saved_usage:
-                    saved_usage[mac] = {}
-                if current_month not in saved_usage[mac]:
-                    saved_usage[mac][current_month] = 0
-
-                # Update with maximum value seen (counters only increase)
-                if bytes_total > saved_usage[mac][current_month]:
-                    saved_usage[mac][current_month] = bytes_total
-                else:
-                    bytes_total = saved_usage[mac][current_month]
+                bytes_in, bytes_out = month_usage.get(mac, (0, 0))
 
                 usage_data.append({
-                    'ip': ip,
+                    'ip': device['ip'],
                     'mac': mac,
                     'hostname': device.get('hostname', 'Unknown'),
                     'custom_name': device.get('custom_name', ''),
-                    'usage': format_bytes(bytes_total),
-                    'bytes': bytes_total,
+                    'usage': format_bytes(bytes_in + bytes_out),
+                    'bytes': bytes_in + bytes_out,
+                    'bytes_in': bytes_in,
+                    'bytes_out': bytes_out,
                     'status': 'connected'
                 })
 
-            # Add offline devices from saved usage
-            for mac, months in saved_usage.items():
-                mac_upper = mac.upper()  # Normalize for comparison
-                if mac_upper not in processed_macs and current_month in months:
-                    bytes_total = months[current_month]
-
+            # Add offline devices with usage this month
+            for mac, (bytes_in, bytes_out) in month_usage.items():
+                if mac not in processed_macs:
                     # Get custom name from DEVICE_INFO (try multiple cases)
-                    mac_lower = mac_upper.lower()
-                    device_info = DEVICE_INFO.get(mac_lower) or DEVICE_INFO.get(mac_upper) or DEVICE_INFO.get(mac) or {}
+                    device_info = DEVICE_INFO.get(mac.lower()) or DEVICE_INFO.get(mac) or {}
                     custom_name = device_info.get('name', '')
 
                     usage_data.append({
                         'ip': 'N/A',
-                        'mac': mac_upper,
+                        'mac': mac,
                         'hostname': custom_name if custom_name else 'Offline Device',
                         'custom_name': custom_name,
-                        'usage': format_bytes(bytes_total),
-                        'bytes': bytes_total,
+                        'usage': format_bytes(bytes_in + bytes_out),
+                        'bytes': bytes_in + bytes_out,
+                        'bytes_in': bytes_in,
+                        'bytes_out': bytes_out,
                         'status': 'offline'
                     })
 
-            # Save updated usage
-            try:
-                with open(usage_file, 'w') as f:
-                    json.dump(saved_usage, f, indent=2)
-            except:
-                pass
-
             self._send_json({'month': current_month, 'devices': usage_data})
+        elif path == '/api/usage-rollup':
+            params = parse_qs(urlparse(self.path).query)
+            mac = params.get('mac', [''])[0]
+            resolution = params.get('resolution', ['hour'])[0]
+            if resolution not in UsageStore.RETENTION:
+                self._send_json({"success": False, "error": "resolution must be minute, hour, day or month"})
+                return
+            try:
+                since = float(params.get('since', ['0'])[0])
+            except ValueError:
+                since = 0
+            self._send_json({"success": True, "mac": mac.upper(), "resolution": resolution,
+                             "buckets": USAGE_STORE.history(mac, resolution, since)})
         elif path == '/api/blocked-urls':
-            self._send_json(self._get_blocked_urls())
+            params = parse_qs(urlparse(self.path).query)
+            try:
+                offset = max(int(params.get('offset', ['0'])[0]), 0)
+                limit = min(max(int(params.get('limit', ['100'])[0]), 1), 1000)
+            except ValueError:
+                self._send_json({"success": False, "message": "offset and limit must be integers"})
+                return
+            self._send_json(self._get_blocked_urls(offset, limit, params.get('q', [''])[0],
+                                                   params.get('compiled', ['0'])[0] == '1'))
         elif path.startswith('/api/get-blocked-url'):
-            from urllib.parse import parse_qs
             query = urlparse(self.path).query
             params = parse_qs(query)
             url = params.get('url', [''])[0]
             try:
-                with open(BLOCKLIST_JSON, 'r') as f:
-                    blocked_data = json.load(f)
-                if url in blocked_data:
-                    info = blocked_data[url]
+                info = BLOCKLIST_STORE.get(url)
+                if info is not None:
                     self._send_json({
                         "success": True,
                         "url": url,
                         "ip_ranges": info.get("ip_ranges", info.get("ips", [])),
-                        "blocked_at": info.get("blocked_at", "")
+                        "blocked_at": info.get("blocked_at", ""),
+                        "provenance": BLOCKLIST_STORE.provenance(url)
                     })
                 else:
                     self._send_json({"success": False, "message": "URL not found"})
@@ -1956,6 +4999,11 @@ class HotspotHandler(BaseHTTPRequestHandler):
         """Handle POST requests"""
         path = urlparse(self.path).path
 
+        # Bulk import streams its (possibly large) body itself
+        if path == '/api/bulk-import':
+            self._bulk_import()
+            return
+
         # Read POST data
         content_length = int(self.headers.get('Content-Length', 0))
         post_data = self.rfile.read(content_length).decode('utf-8') if content_length > 0 else '{}'
@@ -1966,53 +5014,72 @@ class HotspotHandler(BaseHTTPRequestHandler):
             data = {}
 
         if path == '/api/block-url':
-            result = self._block_url(data.get('url', ''))
+            with BLOCKLIST_LOCK:
+                result = self._block_url(data.get('url', ''))
             self._send_json(result)
         elif path == '/api/block-url-advanced':
-            result = self._block_url_advanced(data.get('url', ''), data.get('ip_ranges', []))
+            with BLOCKLIST_LOCK:
+                result = self._block_url_advanced(data.get('url', ''), data.get('ip_ranges', []))
             self._send_json(result)
         elif path == '/api/update-blocked-url':
-            result = self._update_blocked_url(data.get('url', ''), data.get('ip_ranges', []))
+            with BLOCKLIST_LOCK:
+                result = self._update_blocked_url(data.get('url', ''), data.get('ip_ranges', []))
             self._send_json(result)
         elif path == '/api/unblock-url':
-            result = self._unblock_url(data.get('url', ''))
+            with BLOCKLIST_LOCK:
+                result = self._unblock_url(data.get('url', ''))
             self._send_json(result)
+        elif path == '/api/learn/start':
+            self._send_json(self._start_learning(data.get('client_ip', ''), data.get('duration', 30)))
+        elif path == '/api/learn/stop':
+            if LEARN_SESSION:
+                LEARN_SESSION.stop()
+            self._send_json({"success": True})
+        elif path == '/api/learn/commit':
+            self._send_json(commit_learned_ranges(data.get('url', ''), data.get('cidrs', [])))
         elif path == '/api/block-device':
-            result = self._block_device(data.get('mac', ''), data.get('ip', ''))
+            mac, ip = str(data.get('mac', '')), str(data.get('ip', ''))
+            try:
+                ipaddress.IPv4Address(ip)
+            except ValueError:
+                self._send_json({"success": False, "message": "Invalid IP address"}, 400)
+                return
+            if not MAC_ADDRESS.fullmatch(mac):
+                self._send_json({"success": False, "message": "Invalid MAC address"}, 400)
+                return
+            with BLOCKLIST_LOCK:
+                result = self._block_device(mac, ip)
             self._send_json(result)
         elif path == '/api/save-device-info':
             result = self._save_device_info(data.get('mac', ''), data.get('name', ''), data.get('notes', ''))
             self._send_json(result)
         elif path == '/api/reset-usage-all':
-            # Reset iptables counters for all devices
-            self._run_command('su -c "iptables -Z FORWARD"')
-            # Clear usage file
-            usage_file = '/data/data/com.termux/files/home/device_usage.json'
-            try:
-                with open(usage_file, 'w') as f:
-                    json.dump({}, f)
-            except:
-                pass
-            self._send_json({'success': True, 'message': 'All usage data reset'})
+            # Reset the accounting counters of all devices (block rule counters are kept).
+            # The store only forgets its baseline once the counters really are zero,
+            # otherwise the next sample would count them again.
+            with BLOCKLIST_LOCK, USAGE_STORE.lock:
+                ok, error = reset_usage_counters()
+                if ok:
+                    USAGE_STORE.reset()
+            if ok:
+                self._send_json({'success': True, 'message': 'All usage data reset'})
+            else:
+                self._send_json({'success': False, 'message': error}, 500)
         elif path.startswith('/api/reset-usage/'):
             # Reset usage for specific MAC address
             mac = path.split('/')[-1].upper()  # Normalize to uppercase
-            # Reset iptables counters for this MAC
-            self._run_command(f'su -c "iptables -Z FORWARD"')  # Reset all (can't reset per-MAC)
-            # Remove from usage file
-            usage_file = '/data/data/com.termux/files/home/device_usage.json'
-            try:
-                with open(usage_file, 'r') as f:
-                    saved_usage = json.load(f)
-                # Remove all case variations
-                keys_to_remove = [k for k in saved_usage.keys() if k.upper() == mac]
-                for key in keys_to_remove:
-                    del saved_usage[key]
-                with open(usage_file, 'w') as f:
-                    json.dump(saved_usage, f, indent=2)
-            except:
-                pass
-            self._send_json({'success': True, 'message': 'Device usage reset'})
+            if not MAC_ADDRESS.fullmatch(mac):
+                self._send_json({'success': False, 'message': 'Invalid MAC address'}, 400)
+                return
+            # Reset the counters of this device's accounting chain only
+            with BLOCKLIST_LOCK, USAGE_STORE.lock:
+                ok, error = reset_usage_counters(mac)
+                if ok:
+                    USAGE_STORE.reset(mac)
+            if ok:
+                self._send_json({'success': True, 'message': 'Device usage reset'})
+            else:
+                self._send_json({'success': False, 'message': error}, 500)
         elif path == '/api/set-channel':
             channel = data.get('channel', 0)
             result = self._set_wifi_channel(channel)
@@ -2074,57 +5141,115 @@ nohup python3 server.py > /dev/null 2>&1 &
 def reload_blocked_urls():
     """Reload all blocked URLs from blocklist file and apply iptables rules"""
     print("Reloading blocked URLs from blocklist...")
+    detect_ipset()
     try:
-        # Load blocked URLs from JSON file
-        if not os.path.exists(BLOCKLIST_JSON):
-            print("No blocked URLs file found")
-            return
-
-        with open(BLOCKLIST_JSON, 'r') as f:
-            blocked_urls = json.load(f)
+        with BLOCKLIST_LOCK:
+            # Load blocked URLs from the blocklist store
+            blocked_urls = BLOCKLIST_STORE.load()
+            BLOCK_INDEX.rebuild(blocked_urls)
 
-        if not blocked_urls:
-            print("No URLs currently blocked")
-            return
-
-        # Re-apply iptables rules for each blocked URL
-        for url, info in blocked_urls.items():
-            ips = info.get('ips', [])
-            if not ips:
-                print(f"  Skipping {url} - no IPs resolved")
-                continue
-
-            print(f"  Restoring blocks for {url} ({len(ips)} IPs)...")
-
-            # Apply iptables rules for each IP
-            for ip in ips:
-                # Block both INPUT and FORWARD chains
-                subprocess.run(f'su -c "iptables -D FORWARD -d {ip} -j DROP 2>/dev/null"', shell=True, capture_output=True)
-                subprocess.run(f'su -c "iptables -I FORWARD -d {ip} -j DROP"', shell=True, capture_output=True)
+            if not blocked_urls:
+                print("No URLs currently blocked")
 
-                subprocess.run(f'su -c "iptables -D OUTPUT -d {ip} -j DROP 2>/dev/null"', shell=True, capture_output=True)
-                subprocess.run(f'su -c "iptables -I OUTPUT -d {ip} -j DROP"', shell=True, capture_output=True)
+            # Diff the live ruleset against the blocklist and apply only what is missing
+            # (DNS string blocking disabled for performance)
+            for url, info in blocked_urls.items():
+                if not info.get('ip_ranges', info.get('ips', [])):
+                    print(f"  Skipping {url} - no IPs resolved")
 
-            # DNS string blocking disabled for performance
+            result = restore_block_rules(blocked_urls)
 
-            print(f"    ✓ Restored {len(ips)} IP blocks for {url}")
+        if not result["success"]:
+            print(f"Error restoring {BLOCK_CHAIN} chain: {result['error']}")
+            return
 
-        print(f"✓ Reloaded {len(blocked_urls)} blocked URLs with {sum(len(info.get('ips', [])) for info in blocked_urls.values())} total IP blocks")
+        print(f"✓ Reloaded {len(blocked_urls)} blocked URLs into {BLOCK_CHAIN} with {result['ranges']} IP blocks "
+              f"({result['rules_applied']} changes applied in {result['elapsed_ms']} ms)")
     except Exception as e:
+        RESTORE_STATUS.update(state="failed", error=str(e), finished_at=time.time())
         print(f"Error reloading blocked URLs: {e}")
 
+def hotspot_changed(old, new):
+    """Interface listener: drop state tied to the previous hotspot interface"""
+    print(f"Hotspot interfaces changed: {old or 'none'} -> {new or 'none'}")
+    # Accounting and NAT rules are derived from the subnet; device list from the interface
+    RECONCILE_WAKEUP.set()
+    DEVICE_INVENTORY.refresh_soon()
+    # Captures are bound to the old interface
+    if MONITOR_RUNNING and MONITOR_PROCESS and MONITOR_PROCESS.poll() is None:
+        MONITOR_RESTART.set()
+        MONITOR_PROCESS.terminate()
+    session = LEARN_SESSION
+    if session and session.state in ('starting', 'capturing'):
+        session.error = 'Hotspot interface changed during capture'
+        session.stop()
+
+
 def run_server():
-    # Reload blocked URLs on startup
-    reload_blocked_urls()
+    # Threaded so a long bulk import or slow lookup does not stall the UI
+    server = ThreadingHTTPServer(('0.0.0.0', PORT), HotspotHandler)
+
+    # Restore blocked URLs in the background so the web UI is up immediately
+    threading.Thread(target=reload_blocked_urls, daemon=True).start()
+    threading.Thread(target=reconcile_loop, daemon=True).start()
+    threading.Thread(target=refresh_loop, daemon=True).start()
+    HOTSPOT_REGISTRY.listeners.append(hotspot_changed)
+    HOTSPOT_REGISTRY.start()
+    NEIGHBOR_WATCHER.listeners.append(DEVICE_INVENTORY.refresh_soon)
+    NEIGHBOR_WATCHER.start()
+    DEVICE_INVENTORY.start()
+    USAGE_SAMPLER.listeners.append(USAGE_STORE.record)
+    USAGE_SAMPLER.start()
+    USAGE_STORE.start()
 
-    server = HTTPServer(('0.0.0.0', PORT), HotspotHandler)
     print(f"Hotspot GUI Server running on port {PORT}")
     print(f"Access at: http://localhost:{PORT}")
     try:
         server.serve_forever()
     except KeyboardInterrupt:
+        USAGE_STORE.flush()
         print("\nServer stopped")
 
+def cli_path(flag, default):
+    """Optional path argument following a command line flag"""
+    i = sys.argv.index(flag)
+    if i + 1 < len(sys.argv) and not sys.argv[i + 1].startswith('--'):
+        return sys.argv[i + 1]
+    return default
+
+
 if __name__ == '__main__':
-    run_server()
+    import sys
+    if '--export-blocklist' in sys.argv or '--import-blocklist' in sys.argv:
+        # Used by the shell scripts: export blocked_urls.json, edit it, import it back
+        # (add --reload-blocklist to apply the imported blocklist to the firewall)
+        if '--export-blocklist' in sys.argv:
+            path = cli_path('--export-blocklist', BLOCKLIST_JSON)
+            print(f"Exported {BLOCKLIST_STORE.export_json(path)} blocked URLs to {path}")
+        if '--import-blocklist' in sys.argv:
+            path = cli_path('--import-blocklist', BLOCKLIST_JSON)
+            print(f"Imported {path}: {BLOCKLIST_STORE.import_json(path)} entries changed")
+        if '--reload-blocklist' in sys.argv:
+            reload_blocked_urls()
+    elif '--reload-blocklist' in sys.argv:
+        # Used by the shell scripts to restore the block chain without starting the server
+        reload_blocked_urls()
+    elif '--replay-neigh' in sys.argv:
+        # Replay a recorded `ip -o monitor neigh` stream and print the events and final table
+        watcher = NeighborWatcher()
+        for event in watcher.replay(cli_path('--replay-neigh', '/dev/stdin')):
+            print(f"{event['event']} {event['ip']} {event['mac']} {event['dev']}")
+        for ip, mac, state in watcher.neighbours():
+            print(f"  {ip} {mac} {state}")
+    elif '--reconcile' in sys.argv:
+        # Used by cleanup-duplicate-rules.sh: fix firewall drift and print what changed
+        detect_ipset()
+        report = reconcile_firewall()
+        for issue in report["issues"]:
+            print(issue)
+        for fix in report["fixes"]:
+            print(f"✓ {fix}")
+        print(f"RESULT:{len(report['issues'])}:{report['rules_applied']}")
+    else:
+        run_server()
 
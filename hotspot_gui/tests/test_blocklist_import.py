@@ -0,0 +1,56 @@
+"""Bulk import parsing and the import -> unblock round trip"""
+
+import io
+import os
+import sys
+import time
+
+os.environ.setdefault('HOTSPOT_ROOT_HELPER', 'fake')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+FEED = b"""# test feed
+0.0.0.0 ads.example.com
+127.0.0.1 localhost
+::1 ip6-localhost
+31.13.24.0/21
+157.240.1.1
+192.168.43.0/24
+not a valid line
+"""
+
+
+def handler(body=b''):
+    h = object.__new__(server.HotspotHandler)
+    h.rfile = io.BytesIO(body)
+    return h
+
+
+def blocklist(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'BLOCKLIST_JSON', str(tmp_path / 'blocked_urls.json'))
+    monkeypatch.setattr(server, 'BLOCKLIST_STORE', server.BlocklistStore(str(tmp_path / 'blocklist.db')))
+    monkeypatch.setattr(server, 'BLOCK_INDEX', server.BlockIndex())
+    monkeypatch.setattr(server, 'update_block_rules', lambda old_ranges, blocked_data, persist=True: {
+        "success": True, "rules_applied": 0, "elapsed_ms": 0, "error": ""})
+
+
+def test_parse_skips_local_and_reserved_entries():
+    assert server.parse_blocklist_line('127.0.0.1 localhost') == [('skipped', 'localhost')]
+    assert server.parse_blocklist_line('0.0.0.0 ads.example.com') == [('domain', 'ads.example.com')]
+    assert server.parse_blocklist_line('10.0.0.0/8') == [('skipped', '10.0.0.0/8')]
+    assert server.parse_blocklist_line('not a valid line') is None
+
+
+def test_imported_ranges_can_be_unblocked(tmp_path, monkeypatch):
+    blocklist(tmp_path, monkeypatch)
+    server.IMPORT_STATUS.update(state='idle')
+    handler(FEED)._import_stream(time.time(), len(FEED), False, lambda **fields: server.IMPORT_STATUS.update(fields))
+    assert server.IMPORT_STATUS['state'] == 'done'
+    assert server.IMPORT_STATUS['skipped'] == 3
+    assert server.IMPORT_STATUS['invalid'] == 1
+    assert {'31.13.24.0/21', '157.240.1.1', 'ads.example.com'} <= set(server.BLOCKLIST_STORE.load())
+
+    assert handler()._unblock_url('31.13.24.0/21')['success']
+    assert handler()._unblock_url('157.240.1.1')['success']
+    assert set(server.BLOCKLIST_STORE.load()) == {'ads.example.com'}
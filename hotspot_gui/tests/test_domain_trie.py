@@ -0,0 +1,58 @@
+"""DomainTrie matching and copy-on-write updates"""
+
+import os
+import sys
+import threading
+
+os.environ.setdefault('HOTSPOT_ROOT_HELPER', 'fake')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+def test_match_add_remove():
+    trie = server.DomainTrie([('facebook.com', ['facebook.com', 'fb.com'])])
+    assert trie.match('m.facebook.com') == ['facebook.com']
+    assert trie.match('notfb.company.net') == []
+    trie.add('fbcdn.net', ['fbcdn.net'])
+    trie.add('facebook.com', ['facebook.com'])
+    assert trie.match('fb.com') == []
+    trie.remove('facebook.com')
+    assert trie.match('www.facebook.com') == []
+    assert trie.match('scontent.fbcdn.net') == ['fbcdn.net']
+    assert set(trie.root) == {'net'}
+
+
+def test_updates_leave_published_nodes_untouched():
+    trie = server.DomainTrie((f'd{i}.com', [f'd{i}.com']) for i in range(100))
+    old_root = trie.root
+    old_com = dict(old_root['com'])
+    trie.add('x.com', ['x.com'])
+    trie.remove('d1.com')
+    assert old_root['com'] == old_com
+    assert 'x' not in old_root['com'] and 'd1' in old_root['com']
+    assert trie.match('x.com') == ['x.com'] and trie.match('d1.com') == []
+
+
+def test_concurrent_match_during_updates():
+    trie = server.DomainTrie((f'd{i}.com', [f'd{i}.com', f'www.d{i}.com']) for i in range(2000))
+    errors = []
+    done = threading.Event()
+
+    def read():
+        try:
+            while not done.is_set():
+                for i in range(0, 2000, 7):
+                    assert trie.match(f'a.www.d{i}.com') in ([], [f'd{i}.com'])
+        except Exception as e:
+            errors.append(e)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    for _ in range(3):
+        for i in range(2000):
+            trie.remove(f'd{i}.com')
+            trie.add(f'd{i}.com', [f'd{i}.com', f'www.d{i}.com'])
+    done.set()
+    reader.join()
+    assert errors == []
@@ -0,0 +1,76 @@
+"""Reconciler checks against iptables-save output as the kernel prints it"""
+
+import os
+import sys
+
+os.environ.setdefault('HOTSPOT_ROOT_HELPER', 'fake')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+SUBNET = '192.168.43.0/24'
+UPSTREAM = 'rmnet_data0'
+DEVICE = ('192.168.43.10', 'aa:bb:cc:00:00:01')
+
+# iptables-save of a hotspot that is fully in sync (basic matches in save order: -s -d -i -o)
+IN_SYNC = f"""# Generated by iptables-save v1.8.7 on Sun Oct 18 12:00:00 2026
+*nat
+:PREROUTING ACCEPT [0:0]
+:INPUT ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+:POSTROUTING ACCEPT [0:0]
+-A POSTROUTING -s {SUBNET} -o {UPSTREAM} -j MASQUERADE
+COMMIT
+# Completed on Sun Oct 18 12:00:00 2026
+# Generated by iptables-save v1.8.7 on Sun Oct 18 12:00:00 2026
+*filter
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+:ACCT_AABBCC000001 - [0:0]
+:HOTSPOT_ACCT - [0:0]
+:HOTSPOT_BLOCK - [0:0]
+-A FORWARD -j HOTSPOT_BLOCK
+-A FORWARD -j HOTSPOT_ACCT
+-A FORWARD -s {SUBNET} -o {UPSTREAM} -j ACCEPT
+-A FORWARD -d {SUBNET} -i {UPSTREAM} -m state --state RELATED,ESTABLISHED -j ACCEPT
+-A OUTPUT -j HOTSPOT_BLOCK
+-A ACCT_AABBCC000001 -s 192.168.43.10/32 -m mac --mac-source AA:BB:CC:00:00:01
+-A ACCT_AABBCC000001 -d 192.168.43.10/32
+-A HOTSPOT_ACCT -s 192.168.43.10/32 -j ACCT_AABBCC000001
+-A HOTSPOT_ACCT -d 192.168.43.10/32 -j ACCT_AABBCC000001
+-A HOTSPOT_BLOCK -d 31.13.24.0/21 -j DROP
+COMMIT
+# Completed on Sun Oct 18 12:00:00 2026
+"""
+BLOCKED = {"facebook.com": {"ips": ["31.13.24.0/21"]}}
+
+
+def reconcile(monkeypatch, text):
+    monkeypatch.setattr(server, 'IPSET_AVAILABLE', False)
+    monkeypatch.setattr(server, 'detect_hotspot_network', lambda: (SUBNET, UPSTREAM))
+    commits = []
+    monkeypatch.setattr(server.RuleTransaction, 'commit',
+                        lambda tx: commits.append(tx) or {"success": True, "rules_applied": len(tx.changes)})
+    report = server.reconcile_firewall([DEVICE], server.FirewallState(text), BLOCKED)
+    return report, commits
+
+
+def test_in_sync_ruleset_needs_no_changes(monkeypatch):
+    report, commits = reconcile(monkeypatch, IN_SYNC)
+    assert report["issues"] == []
+    assert report["rules_applied"] == 0
+    assert commits == []
+
+
+def test_duplicate_incoming_accept_is_removed(monkeypatch):
+    incoming = f'-A FORWARD -d {SUBNET} -i {UPSTREAM} -m state --state RELATED,ESTABLISHED -j ACCEPT\n'
+    report, _ = reconcile(monkeypatch, IN_SYNC.replace(incoming, incoming * 2))
+    assert report["fixes"] == ["Fixed FORWARD ACCEPT for incoming"]
+    assert report["rules_applied"] == 1
+
+
+def test_normalize_rule_spec_uses_save_order():
+    assert (server.normalize_rule_spec(f'-i {UPSTREAM} -d {SUBNET} -m state --state RELATED,ESTABLISHED -j ACCEPT')
+            == f'-d {SUBNET} -i {UPSTREAM} -m state --state RELATED,ESTABLISHED -j ACCEPT')
+    assert server.normalize_rule_spec('-o wlan0 ! -s 10.0.0.1 -j DROP') == '! -s 10.0.0.1/32 -o wlan0 -j DROP'
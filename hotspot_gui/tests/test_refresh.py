@@ -0,0 +1,53 @@
+"""Background re-resolution of blocked domains"""
+
+import os
+import sys
+import time
+
+os.environ.setdefault('HOTSPOT_ROOT_HELPER', 'fake')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+class Resolver:
+    def __init__(self, answers):
+        self.answers = answers
+
+    def resolve_family(self, domain, deadline=5.0, fresh=False):
+        ips = self.answers.get(domain, [])
+        return ips, {domain: ips or None}
+
+
+def blocklist(tmp_path, monkeypatch, answers):
+    monkeypatch.setattr(server, 'BLOCKLIST_JSON', str(tmp_path / 'blocked_urls.json'))
+    monkeypatch.setattr(server, 'BLOCKLIST_STORE', server.BlocklistStore(str(tmp_path / 'blocklist.db')))
+    monkeypatch.setattr(server, 'BLOCK_INDEX', server.BlockIndex())
+    monkeypatch.setattr(server, 'RESOLVER', Resolver(answers))
+    monkeypatch.setattr(server, 'update_block_rules', lambda old_ranges, blocked_data, persist=True: {
+        "success": True, "rules_applied": 0, "elapsed_ms": 0, "error": ""})
+    server.BLOCKLIST_STORE.put('example.com', {"ip_ranges": ["93.184.0.0/16"], "blocked_at": "x"}, source='manual')
+    server.BLOCKLIST_STORE.put('example.org', {"ip_ranges": ["1.2.3.4"], "blocked_at": "x"}, source='resolved')
+
+
+def refresh(urls):
+    pending = {url: change for url in urls for change in [server.refresh_blocked_domain(url)] if change}
+    return server.apply_domain_refreshes(pending, {url: '2026-10-18T12:00:00' for url in urls})
+
+
+def test_addresses_inside_existing_ranges_are_not_added(tmp_path, monkeypatch):
+    blocklist(tmp_path, monkeypatch, {'example.com': ['93.184.216.34', '5.6.7.8']})
+    results = refresh(['example.com'])
+    assert results == [{"url": 'example.com', "added": ['5.6.7.8'], "removed": [], "success": True}]
+    assert server.BLOCKLIST_STORE.get('example.com')['ip_ranges'] == ['93.184.0.0/16', '5.6.7.8']
+
+
+def test_refresh_time_is_stored_with_or_without_changes(tmp_path, monkeypatch):
+    blocklist(tmp_path, monkeypatch, {'example.com': ['93.184.216.34'], 'example.org': ['1.2.3.4']})
+    assert refresh(['example.com', 'example.org']) == []
+    # A new store instance reads it back from the database
+    store = server.BlocklistStore(server.BLOCKLIST_STORE.path)
+    assert store.get('example.com')['last_refresh'] == '2026-10-18T12:00:00'
+    assert store.get('example.org')['last_refresh'] == '2026-10-18T12:00:00'
+    assert store.get('example.org')['ip_ranges'] == ['1.2.3.4']
+    assert server.last_refresh_time(store.get('example.org')) == time.mktime((2026, 10, 18, 12, 0, 0, 0, 0, -1))
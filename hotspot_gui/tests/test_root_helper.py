@@ -0,0 +1,47 @@
+"""RootHelper request bookkeeping and /api/block-device rule placement"""
+
+import os
+import sys
+
+os.environ.setdefault('HOTSPOT_ROOT_HELPER', 'fake')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+HELPER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'root_helper.py')
+
+
+def test_helper_runs_commands():
+    helper = server.RootHelper([sys.executable, '-u', HELPER])
+    assert helper.run(['echo', 'hi']) == ('hi\n', '', 0)
+    assert helper.pending == {}
+
+
+def test_failed_start_leaves_no_pending_request():
+    helper = server.RootHelper(['/nonexistent/helper'])
+    stdout, stderr, code = helper.run(['true'])
+    assert code == 1 and stderr
+    assert helper.pending == {}
+    assert helper.process is None
+
+
+def test_block_device_rules_go_after_the_managed_jumps(monkeypatch):
+    state = server.FirewallState("""*filter
+:FORWARD ACCEPT [0:0]
+:HOTSPOT_ACCT - [0:0]
+:HOTSPOT_BLOCK - [0:0]
+-A FORWARD -j HOTSPOT_BLOCK
+-A FORWARD -j HOTSPOT_ACCT
+-A FORWARD -s 192.168.43.0/24 -o rmnet_data0 -j ACCEPT
+COMMIT
+""")
+    monkeypatch.setattr(server.FirewallState, 'load', classmethod(lambda cls, *args, **kwargs: state))
+    committed = []
+    monkeypatch.setattr(server.RuleTransaction, 'commit',
+                        lambda tx: committed.append(tx) or {"success": True, "rules_applied": len(tx.changes)})
+    handler = object.__new__(server.HotspotHandler)
+    assert handler._block_device('AA:BB:CC:00:00:01', '192.168.43.10')['success']
+    assert committed[0].chain_rules('FORWARD') == [
+        '-j HOTSPOT_BLOCK', '-j HOTSPOT_ACCT',
+        '-m mac --mac-source AA:BB:CC:00:00:01 -j DROP', '-s 192.168.43.10/32 -j DROP',
+        '-s 192.168.43.0/24 -o rmnet_data0 -j ACCEPT']
@@ -0,0 +1,87 @@
+"""UsageStore delta accounting, including the device_usage.json migration"""
+
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault('HOTSPOT_ROOT_HELPER', 'fake')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+MAC = 'AA:BB:CC:00:00:01'
+NEW_MAC = 'AA:BB:CC:00:00:02'
+
+
+def counters(bytes_in, bytes_out=0, mac=MAC):
+    return {mac: {"bytes_in": bytes_in, "bytes_out": bytes_out}}
+
+
+def store(tmp_path, monkeypatch, legacy=None):
+    usage_json = tmp_path / 'device_usage.json'
+    if legacy is not None:
+        usage_json.write_text(json.dumps(legacy))
+    monkeypatch.setattr(server, 'USAGE_JSON', str(usage_json))
+    return server.UsageStore(str(tmp_path / 'usage.db'))
+
+
+def test_counter_reset_counts_from_zero(tmp_path, monkeypatch):
+    usage = store(tmp_path, monkeypatch)
+    now = time.time()
+    usage.record(now, counters(100, 10))
+    usage.record(now + 5, counters(300, 20))
+    usage.record(now + 10, counters(50, 5))
+    assert usage.totals('month') == {MAC: (350, 25)}
+
+
+def test_restart_continues_from_stored_counters(tmp_path, monkeypatch):
+    usage = store(tmp_path, monkeypatch)
+    now = time.time()
+    usage.record(now, counters(100))
+    usage.flush()
+    restarted = store(tmp_path, monkeypatch)
+    restarted.record(now + 5, counters(130))
+    assert restarted.totals('month') == {MAC: (130, 0)}
+
+
+def test_migration_does_not_count_live_counters_twice(tmp_path, monkeypatch):
+    month = time.strftime('%B %Y')
+    # The old code saved the live counter total (in + out) of the month
+    usage = store(tmp_path, monkeypatch, {MAC.lower(): {month: 5000}})
+    now = time.time()
+    usage.record(now, dict(counters(4000, 1000), **counters(700, mac=NEW_MAC)))
+    assert usage.totals('month') == {MAC: (5000, 0), NEW_MAC: (700, 0)}
+    usage.record(now + 5, counters(4100, 1000))
+    assert usage.totals('month') == {MAC: (5100, 0), NEW_MAC: (700, 0)}
+
+
+def test_migration_baseline_survives_restart(tmp_path, monkeypatch):
+    month = time.strftime('%B %Y')
+    usage = store(tmp_path, monkeypatch, {MAC: {month: 5000}})
+    assert usage.totals('month') == {MAC: (5000, 0)}
+    # Restarted before the first sample: the import is not repeated, the baseline is still pending
+    restarted = store(tmp_path, monkeypatch, {MAC: {month: 5000}})
+    restarted.record(time.time(), counters(5000))
+    assert restarted.totals('month') == {MAC: (5000, 0)}
+
+
+def test_hours_add_up_to_the_local_day(tmp_path, monkeypatch):
+    # Half-hour offset from UTC: UTC-aligned hours would straddle local days
+    monkeypatch.setenv('TZ', 'Asia/Kolkata')
+    time.tzset()
+    try:
+        usage = store(tmp_path, monkeypatch)
+        start = time.mktime((2026, 10, 18, 0, 0, 0, 0, 0, -1))
+        total = 0
+        for step in range(-12, 60):
+            total += 1000
+            usage.record(start + step * 1800, counters(total))
+        day = usage.buckets(start)['day']
+        hours = usage.history(MAC, 'hour', since=day)
+        assert all(time.localtime(bucket).tm_min == 0 for bucket, _, _ in hours)
+        in_day = sum(bytes_in for bucket, bytes_in, _ in hours if bucket < day + 86400)
+        assert in_day == usage.totals('day', day)[MAC][0]
+    finally:
+        monkeypatch.delenv('TZ')
+        time.tzset()
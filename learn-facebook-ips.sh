@@ -1,108 +1,95 @@
 #!/data/data/com.termux/files/usr/bin/bash
 #
 # Facebook IP Learning Tool
-# Captures actual IPs you connect to and lets you block them
+# Captures the IPs one device connects to and lets you block them
+# (uses the learning mode of the Hotspot GUI server, which must be running)
 #
 
+API="http://localhost:8080/api"
+
 echo "=========================================="
 echo "Facebook IP Learning Tool"
 echo "=========================================="
 echo ""
 echo "Instructions:"
-echo "1. This will monitor your network for 30 seconds"
-echo "2. Open Facebook on your PC during this time"
+echo "1. This will monitor one device for 30 seconds"
+echo "2. Open Facebook on that device during this time"
 echo "3. Visit facebook.com, fb.com, web.facebook.com"
-echo "4. Script will show you the IPs you connected to"
+echo "4. Connections are matched to DNS answers and TLS names,"
+echo "   so only Facebook addresses are offered for blocking"
 echo ""
+
+if ! curl -s "$API/health" > /dev/null; then
+    echo "Hotspot GUI server is not running on port 8080"
+    exit 1
+fi
+
+echo "Connected devices:"
+su -c "ip neigh show" 2>/dev/null | grep "lladdr" | grep "192.168" | awk '{print "  " $1}'
+echo ""
+read -p "IP address of the device to monitor: " CLIENT_IP
+
 read -p "Press ENTER when ready to start monitoring..."
 
+START=$(curl -s -X POST "$API/learn/start" -H 'Content-Type: application/json' \
+    -d "{\"client_ip\": \"$CLIENT_IP\", \"duration\": 30}")
+if ! echo "$START" | grep -q '"success": true'; then
+    echo "$START"
+    exit 1
+fi
+
 echo ""
 echo "Monitoring for 30 seconds..."
-echo "ACCESS FACEBOOK NOW from your PC!"
+echo "ACCESS FACEBOOK NOW on $CLIENT_IP!"
 echo ""
+sleep 31
 
-# Capture all destination IPs on port 80 and 443
-TEMP_FILE="/tmp/captured_ips.txt"
-timeout 30 su -c "tcpdump -i wlan0 -n -l 'tcp port 80 or tcp port 443' 2>/dev/null" | \
-    grep -oE 'IP [0-9]+\.[0-9]+\.[0-9]+\.[0-9]+ > ([0-9]+\.[0-9]+\.[0-9]+\.[0-9]+)' | \
-    awk '{print $4}' | sort -u > "$TEMP_FILE"
+# Facebook-related candidates: {cidr, hits, names} per line
+STATUS_FILE="/tmp/learn_status.json"
+curl -s "$API/learn/status" > "$STATUS_FILE"
+CANDIDATES=$(python3 - "$STATUS_FILE" << 'PYEOF'
+import json, sys
+
+with open(sys.argv[1]) as f:
+    status = json.load(f)
+
+for domain, candidates in status.get("candidates", {}).items():
+    if any(key in domain for key in ("facebook", "fbcdn", "fb.", "fbsbx")):
+        for candidate in candidates:
+            print(f"{candidate['cidr']} {candidate['hits']} {','.join(candidate['names'])}")
+PYEOF
+)
 
-echo ""
 echo "=========================================="
-echo "Captured IPs:"
+echo "Captured Facebook IPs:"
 echo "=========================================="
 
-if [ -s "$TEMP_FILE" ]; then
-    cat -n "$TEMP_FILE"
+if [ -n "$CANDIDATES" ]; then
+    echo "$CANDIDATES" | awk '{printf "  %-20s %5s hits  %s\n", $1, $2, $3}'
 
-    echo ""
-    echo "=========================================="
-    echo "Which IPs are Facebook?"
-    echo "=========================================="
     echo ""
     echo "Options:"
-    echo "1. Add ALL captured IPs to Facebook blocking"
-    echo "2. Let me select specific IPs"
-    echo "3. Exit (manual selection via web interface)"
+    echo "1. Add ALL captured Facebook ranges to Facebook blocking"
+    echo "2. Exit (manual selection via web interface)"
     echo ""
-    read -p "Choose (1-3): " choice
+    read -p "Choose (1-2): " choice
 
     case $choice in
         1)
-            echo ""
-            echo "Adding all IPs to Facebook blocking..."
-
-            # Read IPs and add to Facebook block
-            python3 << PYEOF
-import json
-
-# Load blocked URLs
-try:
-    with open('/data/data/com.termux/files/home/blocked_urls.json', 'r') as f:
-        blocked = json.load(f)
-except:
-    blocked = {}
-
-# Read captured IPs
-with open('$TEMP_FILE', 'r') as f:
-    ips = [line.strip() for line in f if line.strip()]
-
-# Add to facebook.com
-if 'facebook.com' not in blocked:
-    blocked['facebook.com'] = {'ip_ranges': [], 'ips': [], 'is_ip_address': False, 'blocked_at': '', 'rules_count': 0}
-
-for ip in ips:
-    if ip not in blocked['facebook.com']['ip_ranges']:
-        blocked['facebook.com']['ip_ranges'].append(ip)
-        blocked['facebook.com']['ips'].append(ip)
-
-# Save
-with open('/data/data/com.termux/files/home/blocked_urls.json', 'w') as f:
-    json.dump(blocked, f, indent=2)
-
-print(f"Added {len(ips)} IPs to Facebook blocking")
-PYEOF
-
-            # Add iptables rules
-            while IFS= read -r ip; do
-                su -c "iptables -I FORWARD 1 -d $ip -j DROP" 2>/dev/null
-                echo "  ✓ Blocked $ip"
-            done < "$TEMP_FILE"
+            CIDRS=$(echo "$CANDIDATES" | awk '{printf "%s\"%s\"", (NR > 1 ? "," : ""), $1}')
+            curl -s -X POST "$API/learn/commit" -H 'Content-Type: application/json' \
+                -d "{\"url\": \"facebook.com\", \"cidrs\": [$CIDRS]}" | \
+                python3 -c "import json, sys; print(json.load(sys.stdin).get('message', ''))"
 
             echo ""
             echo "Done! Try accessing Facebook now - it should be blocked!"
             ;;
-        2)
-            echo ""
-            echo "Use the web interface Edit button to add specific IPs"
-            echo "Go to: URL Blocking > facebook.com > Edit"
-            ;;
         *)
             echo "Exiting. Use web interface to add IPs manually."
             ;;
     esac
 else
-    echo "No IPs captured! Make sure you accessed Facebook during monitoring."
+    echo "No Facebook IPs captured! Make sure you accessed Facebook during monitoring."
 fi
 
-rm -f "$TEMP_FILE"
+rm -f "$STATUS_FILE"
@@ -18,93 +18,25 @@ ISSUES=0
 FIXES=0
 
 # ============================================
-# FIX 1: Remove Duplicate FORWARD ACCEPT Rules
-# ============================================
-log "Checking for duplicate FORWARD ACCEPT rules..."
-DUPLICATE_ACCEPTS=$(su -c "iptables -L FORWARD -n --line-numbers" 2>/dev/null | grep "ACCEPT.*rmnet_data.*RELATED,ESTABLISHED" | wc -l)
-if [ "$DUPLICATE_ACCEPTS" -gt 2 ]; then
-    log "Found $DUPLICATE_ACCEPTS duplicate ACCEPT rules (should be 2)"
-    ISSUES=$((ISSUES + 1))
-
-    # Keep only unique ACCEPT rules
-    su -c "iptables -D FORWARD -i rmnet_data1 -d 192.168.5.0/24 -m state --state RELATED,ESTABLISHED -j ACCEPT" 2>/dev/null
-    su -c "iptables -D FORWARD -i rmnet_data2 -d 192.168.5.0/24 -m state --state RELATED,ESTABLISHED -j ACCEPT" 2>/dev/null
-    su -c "iptables -D FORWARD -s 192.168.5.0/24 -o rmnet_data1 -j ACCEPT" 2>/dev/null
-    su -c "iptables -D FORWARD -s 192.168.5.0/24 -o rmnet_data2 -j ACCEPT" 2>/dev/null
-
-    # Re-add only once at the end
-    su -c "iptables -A FORWARD -i rmnet_data1 -d 192.168.5.0/24 -m state --state RELATED,ESTABLISHED -j ACCEPT" 2>/dev/null
-    su -c "iptables -A FORWARD -s 192.168.5.0/24 -o rmnet_data1 -j ACCEPT" 2>/dev/null
-
-    FIXES=$((FIXES + 1))
-    log "✓ Removed duplicate ACCEPT rules"
-fi
-
-# ============================================
-# FIX 2: Move Blocking Rules to TOP (Critical!)
-# ============================================
-log "Ensuring blocking rules are at TOP..."
-
-# Save all current DROP/REJECT rules to temp file
-mkdir -p /tmp 2>/dev/null
-su -c "iptables-save" 2>/dev/null | grep "FORWARD.*\(DROP\|REJECT\)" > /tmp/blocking_rules.txt
-
-# Count blocking rules
-BLOCKING_COUNT=$(cat /tmp/blocking_rules.txt | wc -l)
-if [ "$BLOCKING_COUNT" -gt 0 ]; then
-    log "Found $BLOCKING_COUNT blocking rules - ensuring they're at top..."
-    ISSUES=$((ISSUES + 1))
-
-    # Delete all existing DROP/REJECT rules from FORWARD
-    su -c "iptables-save" 2>/dev/null | grep "FORWARD.*\(DROP\|REJECT\)" | sed 's/-A /-D /' | while read rule; do
-        su -c "iptables $rule" 2>/dev/null
-    done
-
-    # Re-insert all blocking rules at position 1 (top priority)
-    tac /tmp/blocking_rules.txt | while read rule; do
-        # Convert from iptables-save format to iptables -I format
-        CLEAN_RULE=$(echo "$rule" | sed 's/-A FORWARD/-I FORWARD 1/')
-        su -c "iptables $CLEAN_RULE" 2>/dev/null
-    done
-
-    FIXES=$((FIXES + 1))
-    log "✓ Moved $BLOCKING_COUNT blocking rules to TOP priority"
-fi
-
-# Reload blocked URLs to ensure all blocks are in place
-if [ -f /data/data/com.termux/files/home/blocked_urls.json ]; then
-    log "Reloading blocked URLs to ensure completeness..."
-    python3 -c "
-import json, subprocess
-try:
-    with open('/data/data/com.termux/files/home/blocked_urls.json', 'r') as f:
-        blocked = json.load(f)
-    for url, info in blocked.items():
-        for ip in info.get('ips', []):
-            subprocess.run(f'su -c \"iptables -I FORWARD 1 -d {ip} -j DROP\"', shell=True, capture_output=True)
-        if not info.get('is_ip_address', False):
-            subprocess.run(f'su -c \"iptables -I FORWARD 1 -p udp --dport 53 -m string --string \\\"{url}\\\" --algo bm -j DROP\"', shell=True, capture_output=True)
-except: pass
-" 2>/dev/null
-    log "✓ Reloaded blocked URLs"
-fi
-
-# ============================================
-# FIX 3: Remove Duplicate MAC Counting Rules
-# ============================================
-DUPLICATE_MACS=$(su -c "iptables -L FORWARD -n" 2>/dev/null | grep "MAC" | grep -v "DROP\|REJECT\|ACCEPT" | wc -l)
-if [ "$DUPLICATE_MACS" -gt 0 ]; then
-    log "Found $DUPLICATE_MACS duplicate MAC counting rules"
-    ISSUES=$((ISSUES + 1))
-
-    while true; do
-        LINE=$(su -c "iptables -L FORWARD -n --line-numbers" 2>/dev/null | grep "MAC" | grep -v "DROP\|REJECT\|ACCEPT" | tail -1 | awk '{print $1}')
-        [ -z "$LINE" ] && break
-        su -c "iptables -D FORWARD $LINE" 2>/dev/null || break
-    done
-
-    FIXES=$((FIXES + 1))
-    log "✓ Removed $DUPLICATE_MACS duplicate MAC rules"
+# FIX 1-3: Reconcile Firewall Rules
+# ============================================
+# server.py compares one iptables-save snapshot with the desired state
+# (HOTSPOT_BLOCK jump at the top, blocklist chain contents, the per-device
+# accounting chains, MASQUERADE and FORWARD ACCEPT rules) and applies only the
+# difference in a single iptables-restore. When the server runs this script
+# it has already reconciled and sets HOTSPOT_RECONCILED=1.
+if [ "$HOTSPOT_RECONCILED" != "1" ]; then
+    log "Reconciling firewall rules..."
+    RECONCILE=$(cd /data/data/com.termux/files/home/hotspot_gui && python3 server.py --reconcile 2>/dev/null)
+    while IFS= read -r LINE; do
+        case "$LINE" in
+            RESULT:*)
+                ISSUES=$((ISSUES + $(echo "$LINE" | cut -d: -f2)))
+                [ "$(echo "$LINE" | cut -d: -f3)" -gt 0 ] && FIXES=$((FIXES + 1))
+                ;;
+            ?*) log "$LINE" ;;
+        esac
+    done <<< "$RECONCILE"
 fi
 
 # ============================================
@@ -119,17 +51,6 @@ if [ "$FORWARD_STATUS" -eq 0 ]; then
     log "✓ Enabled IP forwarding"
 fi
 
-# ============================================
-# FIX 5: Check MASQUERADE Rule
-# ============================================
-if ! su -c "iptables -t nat -C POSTROUTING -s 192.168.5.0/24 -o rmnet_data1 -j MASQUERADE" 2>/dev/null; then
-    log "Missing MASQUERADE rule"
-    ISSUES=$((ISSUES + 1))
-    su -c "iptables -t nat -A POSTROUTING -s 192.168.5.0/24 -o rmnet_data1 -j MASQUERADE" 2>/dev/null
-    FIXES=$((FIXES + 1))
-    log "✓ Added MASQUERADE rule"
-fi
-
 # ============================================
 # BOOST 1: Enable TCP BBR Congestion Control (HUGE speed boost)
 # ============================================
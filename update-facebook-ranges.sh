@@ -3,10 +3,8 @@
 
 echo "Adding 91.33.0.0/16 to Facebook blocking..."
 
-# Add to iptables
-su -c "iptables -I FORWARD 1 -d 91.33.0.0/16 -j DROP" 2>/dev/null
-
-# Update JSON
+# Update JSON (exported from the server's blocklist store, imported back below)
+(cd /data/data/com.termux/files/home/hotspot_gui && python3 server.py --export-blocklist > /dev/null 2>&1)
 python3 << 'PYEOF'
 import json
 
@@ -25,4 +23,7 @@ if 'facebook.com' in blocked:
     print("✓ Added 91.33.0.0/16 to Facebook blocking")
 PYEOF
 
+# Import the edited JSON and rebuild the HOTSPOT_BLOCK chain from it
+(cd /data/data/com.termux/files/home/hotspot_gui && python3 server.py --import-blocklist --reload-blocklist > /dev/null 2>&1)
+
 echo "Done! Facebook should be blocked now."